@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+
+"""Measure concurrent large-file downloads through get_file in each media delivery mode.
+
+The application runs in a threaded werkzeug server with the testing configuration. In the offload modes
+the measured time is what the Python worker spends per request, the bytes themselves being left to nginx.
+
+    python benchmark/download.py --size 512 --clients 8
+"""
+
+
+import os
+import sys
+import time
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hallelujah import create_app, db, User, Media
+from hallelujah.utility import MediaType
+
+
+DELIVERY_MODES = ['python', 'x-accel', 'x-sendfile']
+
+
+def prepare(app, media_dir, size):
+    app.config['SYS_MEDIA'] = media_dir
+    app.config['SYS_MEDIA_ORIGINAL'] = os.path.join(media_dir, 'original')
+    os.makedirs(os.path.join(media_dir, 'original', 'bench'))
+    with open(os.path.join(media_dir, 'original', 'bench', 'movie.mp4'), 'wb') as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size):
+            f.write(block)
+    with app.app_context():
+        db.create_all()
+        user = User(name='bench', email='bench@bench.com', password='bench')
+        db.session.add(user)
+        db.session.commit()
+        media = Media.add_media(user.id, 'bench', 'movie.mp4', datetime.datetime.now(), media_type=MediaType.VIDEO, is_public=True)
+        return media.uuidname
+
+
+def download(url, headers=None):
+    start, received = time.perf_counter(), 0
+    with requests.get(url, headers=headers, stream=True) as response:
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            received += len(chunk)
+    return time.perf_counter() - start, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=256, help='file size in MiB')
+    parser.add_argument('--clients', type=int, default=8, help='number of concurrent downloads')
+    parser.add_argument('--port', type=int, default=4199, help='local port of the benchmark server')
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    with tempfile.TemporaryDirectory() as media_dir:
+        uuidname = prepare(app, media_dir, args.size)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', args.port, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{args.port}/file/{uuidname}'
+        print(f'{args.clients} clients downloading {args.size} MiB each')
+        print(f'{"mode":<11} {"wall s":>8} {"MiB/s":>9} {"worker s/req":>13} {"bytes/req":>12}')
+        for mode in DELIVERY_MODES:
+            app.config['SYS_MEDIA_DELIVERY'] = mode
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as executor:
+                results = list(executor.map(lambda _: download(url), range(args.clients)))
+            wall = time.perf_counter() - start
+            received = sum(result[1] for result in results)
+            per_request = sum(result[0] for result in results) / len(results)
+            print(f'{mode:<11} {wall:>8.2f} {received / wall / 1024 / 1024:>9.1f} {per_request:>13.4f} {received // len(results):>12}')
+        # Seeking in a video player: many small single ranges, then one multi-range request.
+        app.config['SYS_MEDIA_DELIVERY'] = 'python'
+        seeks = [f'bytes={offset * 1024 * 1024}-{offset * 1024 * 1024 + 65535}' for offset in range(0, args.size, max(1, args.size // 64))]
+        start = time.perf_counter()
+        for seek in seeks:
+            download(url, headers={'Range': seek})
+        elapsed = time.perf_counter() - start
+        print(f'python single-range seeks: {len(seeks)} in {elapsed:.2f}s, {elapsed / len(seeks) * 1000:.1f} ms/seek')
+        elapsed, received = download(url, headers={'Range': 'bytes=' + ','.join(seek[6:] for seek in seeks[:16])})
+        print(f'python multi-range request: 16 ranges, {received} bytes in {elapsed * 1000:.1f} ms')
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+
+"""Compare loading the thumbnails of gallery pages one request each with the single bundle request per page.
+
+The application runs in a threaded werkzeug server with the testing configuration. Like a browser, the
+per-thumbnail path uses a few parallel connections; one page of ITEMS_PER_PAGE thumbnails is one gallery scroll.
+
+    python benchmark/gallery.py --pages 20 --connections 6
+"""
+
+
+import os
+import sys
+import time
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+import requests
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hallelujah import create_app, db, User, Media
+from hallelujah.utility import MediaType
+
+
+def prepare(app, media_dir, count):
+    app.config['SYS_MEDIA_THUMBNAIL'] = os.path.join(media_dir, 'thumbnail')
+    os.makedirs(os.path.join(media_dir, 'thumbnail', 'bench'))
+    with app.app_context():
+        db.create_all()
+        user = User(name='bench', email='bench@bench.com', password='bench')
+        db.session.add(user)
+        db.session.commit()
+        uuidnames = []
+        for index in range(count):
+            filename = f'IMG_{index:05d}.jpg'
+            pixels = np.random.randint(0, 255, (200, 300, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(os.path.join(media_dir, 'thumbnail', 'bench', filename), quality=80)
+            media = Media.add_media(user.id, 'bench', filename, datetime.datetime.now(), 300, 200, MediaType.IMAGE, True)
+            uuidnames.append(media.uuidname)
+        return uuidnames
+
+
+def fetch(session, url):
+    response = session.get(url)
+    return len(response.content)
+
+
+def load_separately(base_url, page, connections):
+    # One session per connection, as a browser keeps a few keep-alive connections to the same host.
+    sessions = [requests.Session() for _ in range(connections)]
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        sizes = executor.map(lambda item: fetch(sessions[item[0] % connections], f'{base_url}/thumbnail/{item[1]}'), enumerate(page))
+        return len(page), sum(sizes)
+
+
+def load_bundle(base_url, page, connections):
+    with requests.Session() as session:
+        return 1, fetch(session, f'{base_url}/thumbnails?uuids={",".join(page)}')
+
+
+MODES = {
+    'separate': load_separately,
+    'bundle': load_bundle,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=10, help='number of gallery pages scrolled through')
+    parser.add_argument('--connections', type=int, default=6, help='parallel connections of the per-thumbnail path')
+    parser.add_argument('--port', type=int, default=4199, help='local port of the benchmark server')
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    page_size = app.config['ITEMS_PER_PAGE']
+    with tempfile.TemporaryDirectory() as media_dir:
+        print(f'Generating {args.pages * page_size} thumbnails ...')
+        uuidnames = prepare(app, media_dir, args.pages * page_size)
+        pages = [uuidnames[index:index + page_size] for index in range(0, len(uuidnames), page_size)]
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', args.port, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{args.port}'
+        print(f'{len(pages)} scrolls of {page_size} thumbnails')
+        print(f'{"mode":<9} {"req/scroll":>11} {"ms/scroll":>10} {"bytes/scroll":>13}')
+        for name, load in MODES.items():
+            load(base_url, pages[0], args.connections)
+            start, total_requests, total_bytes = time.perf_counter(), 0, 0
+            for page in pages:
+                request_count, received = load(base_url, page, args.connections)
+                total_requests += request_count
+                total_bytes += received
+            elapsed = time.perf_counter() - start
+            print(f'{name:<9} {total_requests / len(pages):>11.1f} {elapsed / len(pages) * 1000:>10.1f} {total_bytes // len(pages):>13}')
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+
+"""Compare the legacy full-decode thumbnail path with the draft-mode one on a corpus of large JPEGs.
+
+Each engine runs in its own process so that the reported peak RSS is not shared between them.
+
+    python benchmark/thumbnail.py --count 20 --width 8000 --height 6000
+    python benchmark/thumbnail.py --corpus ~/Pictures
+"""
+
+
+import os
+import sys
+import time
+import glob
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+from PIL import Image, ImageOps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hallelujah.utility import _save_image_thumbnail, get_thumbnail_size, EXIF_TAG_MAP
+
+
+def legacy_thumbnail(image_file, thumbnail_file, height):
+    image = Image.open(image_file)
+    image._getexif()
+    image.close()
+    image = Image.open(image_file)
+    image = ImageOps.exif_transpose(image)
+    image_size = image.size
+    thumbnail_size = get_thumbnail_size(image_size, height)
+    if thumbnail_size != image_size:
+        image = image.resize(thumbnail_size, Image.Resampling.LANCZOS)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.save(thumbnail_file)
+    image.close()
+    return image_size
+
+
+ENGINES = {
+    'legacy': legacy_thumbnail,
+    'draft': _save_image_thumbnail,
+}
+
+
+def create_corpus(path, count, width, height):
+    files = []
+    for index in range(count):
+        # Smooth gradients plus noise compress like real photos instead of flat colors.
+        gradient = np.linspace(0, 255, width, dtype=np.uint8)[np.newaxis, :, np.newaxis]
+        pixels = np.broadcast_to(gradient, (height, width, 3)).copy()
+        pixels[::7, ::5] = np.random.randint(0, 255, pixels[::7, ::5].shape, dtype=np.uint8)
+        image = Image.fromarray(pixels)
+        exif = image.getexif()
+        exif[EXIF_TAG_MAP['Orientation']] = 6 if index % 2 else 1
+        filename = os.path.join(path, f'IMG_{index:04d}.jpg')
+        image.save(filename, quality=90, exif=exif)
+        files.append(filename)
+    return files
+
+
+def run_engine(name, files, height, output, queue):
+    engine = ENGINES[name]
+    start = time.perf_counter()
+    for index, filename in enumerate(files):
+        engine(filename, os.path.join(output, f'{name}_{index}.jpg'), height)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((name, elapsed, peak))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', help='directory of JPEG files, a synthetic corpus is generated if omitted')
+    parser.add_argument('--count', type=int, default=10, help='number of synthetic images')
+    parser.add_argument('--width', type=int, default=8000, help='width of synthetic images')
+    parser.add_argument('--height', type=int, default=6000, help='height of synthetic images')
+    parser.add_argument('--thumbnail_height', type=int, default=200, help='thumbnail height')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.corpus:
+            files = sorted(glob.glob(os.path.join(args.corpus, '*.jp*g')) + glob.glob(os.path.join(args.corpus, '*.JP*G')))
+        else:
+            print(f'Generating {args.count} images of {args.width}x{args.height} ...')
+            # The corpus is built in a child process: ru_maxrss survives fork and exec, so a bloated parent would skew the peaks.
+            with context.Pool(1) as pool:
+                files = pool.apply(create_corpus, (workdir, args.count, args.width, args.height))
+        if not files:
+            print('No JPEG files found.')
+            return
+        results = {}
+        for name in ENGINES:
+            queue = context.Queue()
+            process = context.Process(target=run_engine, args=(name, files, args.thumbnail_height, workdir, queue))
+            process.start()
+            results[name] = queue.get()
+            process.join()
+        baseline = results['legacy']
+        print(f'{"engine":<8} {"seconds":>9} {"img/s":>8} {"peak MiB":>9} {"speedup":>8}')
+        for name, elapsed, peak in results.values():
+            print(f'{name:<8} {elapsed:>9.2f} {len(files) / elapsed:>8.1f} {peak:>9.0f} {baseline[1] / elapsed:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
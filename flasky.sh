@@ -22,6 +22,7 @@ TRAVERSE_PATH=${SCRIPT_PATH}
 APP_NAME=hallelujah
 SERVICE_PATH=/etc/systemd/system
 SERVICE_NAME=${APP_NAME}.service
+WORKER_SERVICE_NAME=${APP_NAME}-worker.service
 
 function clean () {
     find ${SCRIPT_PATH} -type d -name '__pycache__' -exec rm -rf {} +
@@ -167,9 +168,15 @@ elif [ ${OPTION} == 'deploy' ]; then
     sudo sed -i "s|NUM_WORKERS|${NUM_WORKERS}|g" ${SERVICE_PATH}/${SERVICE_NAME}
     SECRET_KEY=$(echo ${RANDOM} | md5sum | head -c 32)
     sudo sed -i "s|SECRET_KEY = .*|SECRET_KEY = '${SECRET_KEY}'|g" ${SCRIPT_PATH}/hallelujah/config.py
+    sudo cp ${SCRIPT_PATH}/worker.conf ${SERVICE_PATH}/${WORKER_SERVICE_NAME}
+    sudo sed -i "s|USER_NAME|${USER}|g" ${SERVICE_PATH}/${WORKER_SERVICE_NAME}
+    sudo sed -i "s|PROJECT_PATH|${SCRIPT_PATH}|g" ${SERVICE_PATH}/${WORKER_SERVICE_NAME}
+    sudo sed -i "s|PYTHON_PATH|${PYTHON_PATH}|g" ${SERVICE_PATH}/${WORKER_SERVICE_NAME}
     sudo systemctl daemon-reload
     sudo systemctl enable ${SERVICE_NAME}
     sudo systemctl restart ${SERVICE_NAME}
+    sudo systemctl enable ${WORKER_SERVICE_NAME}
+    sudo systemctl restart ${WORKER_SERVICE_NAME}
 elif [ ${OPTION} == 'cron' ]; then
     CRON_CMD=${2}
     if [[ ${CRON_CMD} == 'add_backup' ]]; then
@@ -187,6 +194,7 @@ elif [ ${OPTION} == 'run' ]; then
     cd ${SCRIPT_PATH}
     source ${PYTHON_ENV}
     nohup gunicorn -w 1 -b 127.0.0.1:4100 'hallelujah:create_app()' > /dev/null 2>&1 &
+    FLASK_APP='hallelujah:create_app()' nohup flask worker > /dev/null 2>&1 &
 elif [ ${OPTION} == 'backup' ]; then
     cd ${SCRIPT_PATH}
     source ${PYTHON_ENV}
@@ -3,14 +3,16 @@
 
 
 import os
+import json
 import click
 import unittest
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask import Flask, request, jsonify
 
 from .config import configs
-from .extensions import db, migrate, bootstrap, login_manager, mail, moment, session
-from .models import User, AnonymousUser, Article, Media, Resource
+from .extensions import db, migrate, bootstrap, login_manager, mail, moment, session, cache, media_cache, variant_cache
+from .models import User, AnonymousUser, Article, Media, MediaFolder, MediaTask, Resource
+from .watcher import MediaWatcher
 from .utility import get_request_ip, redirect_back, sqlite_in_use, db_is_exist, db_drop, db_create, db_backup, db_restore, send_email
 from .main.views import bp_main
 from .auth.views import bp_auth
@@ -47,6 +49,9 @@ def register_extensions(app):
     mail.init_app(app)
     moment.init_app(app)
     session.init_app(app)
+    cache.init_app(app)
+    media_cache.init_app(app)
+    variant_cache.init_app(app)
 
 def register_blueprints(app):
     app.register_blueprint(bp_main)
@@ -95,7 +100,7 @@ def register_shell_context_processor(app):
     @app.shell_context_processor
     def make_shell_context():
         return dict(db=db, User=User, Article=Article,
-                    Media=Media, Resource=Resource)
+                    Media=Media, MediaFolder=MediaFolder, MediaTask=MediaTask, Resource=Resource)
 
 def register_commands(app):
     @app.cli.command()
@@ -112,8 +117,159 @@ def register_commands(app):
         db_restore()
 
     @app.cli.command()
-    def check():
-        Media.check_media()
+    @click.option('--jobs', type=int, default=None,
+                  help='number of checking threads, defaults to the number of cores')
+    @click.option('--hash', 'verify_hash', is_flag=True,
+                  help='hash new and changed originals and compare them with the recorded content hash')
+    @click.option('--repair', is_flag=True,
+                  help='regenerate missing thumbnails and import unrecorded files')
+    @click.option('--report', type=click.File('w'), default=None,
+                  help='write the findings as JSON to this file, - for stdout')
+    def check(jobs, verify_hash, repair, report):
+        result = Media.check_media(jobs=jobs, verify_hash=verify_hash, repair=repair)
+        if report:
+            json.dump(result, report, indent=2)
+        app.logger.info(', '.join(f'{len(value) if isinstance(value, list) else value} {name}' for name, value in result.items()))
+
+    @app.cli.command()
+    def cachestats():
+        stats = cache.stats()
+        total = stats['hit'] + stats['miss']
+        ratio = stats['hit'] / total if total else 0.0
+        app.logger.info(f'Response cache: {stats["hit"]} hits, {stats["miss"]} misses, hit ratio {ratio:.2%}')
+
+    @app.cli.command()
+    def reindex():
+        app.logger.info('Rebuilding article search index ...')
+        count = Article.reindex()
+        app.logger.info(f'{count} articles indexed.')
+
+    @app.cli.command()
+    @click.option('--all', 'all_articles', is_flag=True, default=False,
+                  help='recompute summaries of all articles, not only missing ones')
+    def summarize(all_articles):
+        app.logger.info('Generating article summaries ...')
+        count = Article.summarize(all_articles=all_articles)
+        app.logger.info(f'{count} articles summarized.')
+
+    @app.cli.command()
+    @click.option('--jobs', type=int, default=None,
+                  help='number of render processes, defaults to the number of cores')
+    @click.option('--batch_size', type=int, default=500,
+                  help='number of articles fetched and updated per transaction')
+    @click.option('--force', is_flag=True, default=False,
+                  help='re-render every article, even up to date ones')
+    def rerender(jobs, batch_size, force):
+        app.logger.info('Re-rendering stale articles ...')
+        count = Article.rerender(jobs=jobs, batch_size=batch_size, force=force)
+        app.logger.info(f'{count} articles re-rendered.')
+
+    @app.cli.command()
+    @click.option('--user', 'username', required=True,
+                  help='user whose media directory is imported')
+    @click.option('--jobs', type=int, default=None,
+                  help='number of decoding processes, defaults to the number of cores')
+    @click.option('--batch_size', type=int, default=500,
+                  help='number of files probed and inserted per transaction')
+    @click.option('--public', is_flag=True, default=False,
+                  help='mark imported media as public')
+    def import_media(username, jobs, batch_size, public):
+        app.logger.info(f'Importing media of user {username} ...')
+        result = User.import_medias(username, jobs=jobs, batch_size=batch_size, is_public=public)
+        if result is None:
+            app.logger.error(f'User[{username}] is not exists')
+            return
+        count, failed = result
+        if failed:
+            app.logger.error(f'{count} media imported, {failed} failed.')
+            raise SystemExit(1)
+        app.logger.info(f'{count} media imported.')
+
+    @app.cli.command()
+    @click.option('--jobs', type=int, default=None,
+                  help='number of decoding processes, defaults to the number of cores')
+    @click.option('--batch_size', type=int, default=500,
+                  help='number of media decoded and updated per transaction')
+    def placeholders(jobs, batch_size):
+        app.logger.info('Computing media placeholders ...')
+        count = Media.fill_placeholders(jobs=jobs, batch_size=batch_size)
+        app.logger.info(f'{count} media updated.')
+
+    @app.cli.command()
+    @click.option('--batch_size', type=int, default=500,
+                  help='number of media updated per transaction')
+    def uuidstems(batch_size):
+        app.logger.info('Filling media uuid stems ...')
+        count = Media.fill_uuidstems(batch_size=batch_size)
+        app.logger.info(f'{count} media updated.')
+
+    @app.cli.command()
+    @click.option('--user', 'username', default=None,
+                  help='user whose media folders are synchronized, defaults to every user')
+    def sync_folders(username):
+        users = User.query.filter(User.name==username).all() if username else User.query.all()
+        for user in users:
+            app.logger.info(f'Synchronizing media folders of user {user.name} ...')
+            MediaFolder.sync_user_folders(user)
+        app.logger.info(f'{len(users)} users synchronized.')
+
+    @app.cli.command()
+    @click.option('--jobs', type=int, default=None,
+                  help='number of hashing processes, defaults to the number of cores')
+    @click.option('--batch_size', type=int, default=500,
+                  help='number of media hashed and updated per transaction')
+    def dedupe(jobs, batch_size):
+        app.logger.info('Deduplicating media ...')
+        hashed, linked, reclaimed = Media.dedupe(jobs=jobs, batch_size=batch_size)
+        app.logger.info(f'{hashed} media hashed, {linked} duplicates linked, {reclaimed / 1024 / 1024:.1f} MiB reclaimed.')
+
+    @app.cli.command()
+    @click.option('--user', 'username', required=True,
+                  help='user whose media are compared')
+    @click.option('--distance', type=int, default=None,
+                  help='maximum number of differing perceptual hash bits, defaults to SYS_MEDIA_SIMILAR_DISTANCE')
+    @click.option('--report', type=click.File('w'), default='-',
+                  help='write the similar pairs as JSON to this file, - for stdout')
+    def similar_media(username, distance, report):
+        user = User.query.filter(User.name==username).first()
+        if not user:
+            app.logger.error(f'User[{username}] is not exists')
+            return
+        distance = app.config.get('SYS_MEDIA_SIMILAR_DISTANCE') if distance is None else distance
+        app.logger.info(f'Finding similar media of user {username} ...')
+        pairs = Media.find_similar_media(user.id, distance)
+        names = Media.get_relative_names({media_id for pair in pairs for media_id in pair[:2]})
+        json.dump([{'distance': d, 'media': [names[a], names[b]]} for a, b, d in sorted(pairs, key=lambda pair: pair[2])], report, indent=2)
+        app.logger.info(f'{len(pairs)} similar pairs found.')
+
+    @app.cli.command()
+    @click.option('--jobs', type=int, default=None,
+                  help='number of media processes, defaults to the number of cores')
+    @click.option('--once', is_flag=True, default=False,
+                  help='exit when the queue is drained instead of polling forever')
+    def worker(jobs, once):
+        app.logger.info('Processing uploaded media ...')
+        count = MediaTask.run_worker(jobs=jobs, once=once)
+        app.logger.info(f'{count} media processed.')
+
+    @app.cli.command()
+    @click.option('--jobs', type=int, default=None,
+                  help='number of media processes, defaults to the number of cores')
+    @click.option('--public', is_flag=True, default=False,
+                  help='mark imported media as public')
+    def watch_media(jobs, public):
+        try:
+            watcher = MediaWatcher(app.config.get('SYS_MEDIA_ORIGINAL'), app.config.get('WATCH_SETTLE_TIME'))
+        except OSError as e:
+            app.logger.error(f'Media watcher is not available: {e}')
+            return
+        app.logger.info('Watching media directories ...')
+        try:
+            watcher.run(jobs=jobs, is_public=public)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
 
     @app.cli.command()
     @click.option('--username', prompt=True, required=True,
@@ -2,68 +2,136 @@
 # -*- coding:utf-8 -*-
 
 
+import datetime
 from flask_login import current_user
 from flask import Blueprint, current_app, request, jsonify
 
-from ..utility import MediaType
-from ..extensions import db
-from ..models import Article, User, Media, Resource
+from ..utility import MediaType, TaskStatus, encode_cursor, decode_cursor, make_etag, is_not_modified, set_validators, not_modified_response
+from ..extensions import db, cache
+from ..models import Article, User, Media, MediaFolder, MediaTask, Resource
 
 
 bp_api = Blueprint('api', __name__)
 
+def _keyset_after(keys, values):
+    key, value = keys[0], values[0]
+    if len(keys) == 1:
+        return key < value
+    return db.or_(key < value, db.and_(key == value, _keyset_after(keys[1:], values[1:])))
+
+def _parse_cursor_value(key, value):
+    # A cursor comes from the client, every component must have the type of its key before reaching the query.
+    if isinstance(key.type, db.DateTime):
+        return datetime.datetime.fromisoformat(value)
+    try:
+        python_type = key.type.python_type
+    except NotImplementedError:
+        python_type = None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise TypeError(f'invalid cursor value {value!r}')
+    if python_type is float and isinstance(value, (int, float)):
+        return float(value)
+    if python_type in (int, float, str) and not isinstance(value, python_type):
+        raise TypeError(f'invalid cursor value {value!r}')
+    return value
+
+def _get_page(query, *keys):
+    """Fetch one page ordered by descending keys, resuming after the request cursor if any.
+
+    The legacy offset parameter is still honored for clients which do not send a cursor.
+    """
+    limit = current_app.config.get('ITEMS_PER_PAGE')
+    labels = [key.label(f'cursor_{index}') for index, key in enumerate(keys)]
+    query = query.add_columns(*labels).order_by(*[key.desc() for key in keys])
+    cursor = decode_cursor(request.args.get('cursor'))
+    if cursor and len(cursor) == len(keys):
+        try:
+            values = [_parse_cursor_value(key, value) for key, value in zip(keys, cursor)]
+        except (TypeError, ValueError):
+            values = None
+        if values:
+            query = query.filter(_keyset_after(keys, values))
+    else:
+        query = query.offset(max(request.args.get('offset', 0, type=int), 0) * limit)
+    rows = query.limit(limit).all()
+    next_cursor = encode_cursor(*rows[-1][-len(keys):]) if len(rows) == limit else None
+    return rows, next_cursor
+
+def _jsonify_page(rows, next_cursor, rows_to_json):
+    # The page is identified by the request and the user, its version by the selected rows themselves.
+    user_id = current_user.id if current_user.is_authenticated else None
+    etag = make_etag(request.full_path, user_id, *[tuple(row) for row in rows])
+    if is_not_modified(etag):
+        response = not_modified_response(etag)
+    else:
+        response = set_validators(jsonify(rows_to_json(rows)), etag)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
 @bp_api.route('/search')
 def search():
-    keywords = request.args.get('keywords', None)
+    keywords = request.args.get('keywords', '').split()
     if not keywords:
         return jsonify([])
-    keywords = keywords.split()
-    offset = int(request.args.get('offset', 0)) * current_app.config.get('ITEMS_PER_PAGE', 1)
-    limit = current_app.config.get('ITEMS_PER_PAGE')
     user_id = current_user.id if current_user.is_authenticated else -1
-    articles = Article.query.filter(db.or_(Article.user_id == user_id, Article.is_public == True))
-    for keyword in keywords:
-        articles = articles.filter(db.or_(Article.title.like(f'%{keyword}%'), Article.content.like(f'%{keyword}%')))
-    articles = articles.order_by(Article.timestamp.desc()).offset(offset).limit(limit)
-    return jsonify([article.to_json() for article in articles])
+    articles, score = Article.search_articles(keywords, user_id, Article.query_json_rows())
+    articles, next_cursor = _get_page(articles, score, Article.id)
+    return _jsonify_page(articles, next_cursor, Article.rows_to_json)
 
 @bp_api.route('/get_articles')
+@cache.cached('articles')
 def get_articles():
-    offset = int(request.args.get('offset', 0)) * current_app.config.get('ITEMS_PER_PAGE', 1)
-    limit = current_app.config.get('ITEMS_PER_PAGE')
-    articles = Article.query.filter(Article.is_public == True).order_by(Article.timestamp.desc()).offset(offset).limit(limit)
-    return jsonify([article.to_json() for article in articles])
+    articles = Article.query_json_rows().filter(Article.is_public == True)
+    articles, next_cursor = _get_page(articles, Article.timestamp, Article.id)
+    return _jsonify_page(articles, next_cursor, Article.rows_to_json)
 
 @bp_api.route('/get_user_articles')
+@cache.cached('articles')
 def get_user_articles():
     user_name = request.args.get('name', '')
     user = User.query.filter(User.name == user_name).first()
     user_id = user.id if user else -1
-    offset = int(request.args.get('offset', 0)) * current_app.config.get('ITEMS_PER_PAGE', 1)
-    limit = current_app.config.get('ITEMS_PER_PAGE')
-    articles = Article.query.filter(db.and_(Article.is_public == True, Article.user_id == user_id)).order_by(Article.timestamp.desc()).offset(offset).limit(limit)
-    return jsonify([article.to_json() for article in articles])
+    articles = Article.query_json_rows().filter(db.and_(Article.is_public == True, Article.user_id == user_id))
+    articles, next_cursor = _get_page(articles, Article.timestamp, Article.id)
+    return _jsonify_page(articles, next_cursor, Article.rows_to_json)
 
 @bp_api.route('/get_self_articles')
 def get_self_articles():
     user_id = current_user.id if current_user.is_authenticated else -1
-    offset = int(request.args.get('offset', 0)) * current_app.config.get('ITEMS_PSER_PAGE', 1)
-    limit = current_app.config.get('ITEMS_PER_PAGE')
-    articles = Article.query.filter(Article.user_id == user_id).order_by(Article.timestamp.desc()).offset(offset).limit(limit)
-    return jsonify([article.to_json() for article in articles])
+    articles = Article.query_json_rows().filter(Article.user_id == user_id)
+    articles, next_cursor = _get_page(articles, Article.timestamp, Article.id)
+    return _jsonify_page(articles, next_cursor, Article.rows_to_json)
 
 @bp_api.route('/get_self_medias/<path:current_path>')
 def get_self_medias(current_path):
     user_id = current_user.id if current_user.is_authenticated else -1
-    offset = int(request.args.get('offset', 0)) * current_app.config.get('ITEMS_PER_PAGE', 1)
-    limit = current_app.config.get('ITEMS_PER_PAGE')
-    excludes = current_app.config.get('SYS_MEDIA_EXCLUDES').split(',')
-    medias = Media.query.filter((Media.user_id == user_id) & (Media.media_type >= MediaType.IMAGE))
-    medias = medias.filter(Media.path.like(f'{current_path}%'))
-    for exclude_dir in excludes:
-        medias = medias.filter(Media.path.notlike(f'{current_path}%{exclude_dir}%'))
-    medias = medias.order_by(Media.timestamp.desc()).offset(offset).limit(limit)
-    return jsonify([media.to_json() for media in medias])
+    folder_ids = MediaFolder.query_subtree_ids(user_id, current_path)
+    medias = Media.query_json_rows().filter((Media.folder_id.in_(folder_ids)) & (Media.media_type >= MediaType.IMAGE))
+    medias, next_cursor = _get_page(medias, Media.timestamp, Media.id)
+    return _jsonify_page(medias, next_cursor, Media.rows_to_json)
+
+@bp_api.route('/get_similar_medias')
+def get_similar_medias():
+    user_id = current_user.id if current_user.is_authenticated else -1
+    distance = request.args.get('distance', current_app.config.get('SYS_MEDIA_SIMILAR_DISTANCE'), type=int)
+    if not 0 <= distance <= current_app.config.get('SYS_MEDIA_SIMILAR_MAX_DISTANCE'):
+        return 'bad request', 400
+    pairs = Media.find_similar_media(user_id, distance, request.args.get('uuid'))
+    rows = Media.query_json_rows().filter(Media.id.in_({media_id for pair in pairs for media_id in pair[:2]})).all()
+    medias = dict(zip([row.id for row in rows], Media.rows_to_json(rows)))
+    return jsonify([{'distance': d, 'medias': [medias[a], medias[b]]} for a, b, d in sorted(pairs, key=lambda pair: pair[2])])
+
+@bp_api.route('/get_media_tasks')
+def get_media_tasks():
+    user_id = current_user.id if current_user.is_authenticated else -1
+    tasks = MediaTask.query.filter(MediaTask.user_id == user_id)
+    task_ids = [int(task_id) for task_id in request.args.get('ids', '').split(',') if task_id.isdigit()]
+    if task_ids:
+        tasks = tasks.filter(MediaTask.id.in_(task_ids))
+    else:
+        tasks = tasks.filter(MediaTask.status.in_([TaskStatus.PENDING, TaskStatus.RUNNING]))
+    return jsonify([task.to_json() for task in tasks.order_by(MediaTask.id.asc())])
 
 @bp_api.route('/get_self_resources')
 def get_self_resources():
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+
+import os
+import json
+import time
+import uuid
+import pickle
+import functools
+import threading
+from collections import OrderedDict
+from redis import RedisError
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+
+
+class NullBackend:
+    def get(self, key):
+        return None
+
+    def get_many(self, *keys):
+        return [None] * len(keys)
+
+    def set(self, key, value, timeout=None, nx=False):
+        return True
+
+    def incr(self, key):
+        return 0
+
+    def delete(self, *keys):
+        pass
+
+
+class SimpleBackend:
+    def __init__(self):
+        self._data = dict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        value, expires = self._data.get(key, (None, None))
+        if expires and expires < time.time():
+            self._data.pop(key, None)
+            return None
+        return value
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def get_many(self, *keys):
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def set(self, key, value, timeout=None, nx=False):
+        with self._lock:
+            if nx and self._get(key) is not None:
+                return False
+            self._data[key] = (value, time.time() + timeout if timeout else None)
+            return True
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._get(key) or 0) + 1
+            self._data[key] = (value, None)
+            return value
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+
+class RedisBackend:
+    def __init__(self, client):
+        self._client = client
+
+    def _call(self, func, *args, default=None, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except RedisError as e:
+            current_app.logger.error('cache: {}'.format(str(e)))
+            return default
+
+    def get(self, key):
+        return self._call(self._client.get, key)
+
+    def get_many(self, *keys):
+        return self._call(self._client.mget, keys, default=[None] * len(keys))
+
+    def set(self, key, value, timeout=None, nx=False):
+        return self._call(self._client.set, key, value, ex=timeout, nx=nx, default=False)
+
+    def incr(self, key):
+        return self._call(self._client.incr, key, default=0)
+
+    def delete(self, *keys):
+        if keys:
+            self._call(self._client.delete, *keys)
+
+
+def create_backend(app):
+    cache_type = app.config.get('CACHE_TYPE', 'null')
+    if cache_type == 'redis':
+        return RedisBackend(app.config.get('CACHE_REDIS'))
+    elif cache_type == 'simple':
+        return SimpleBackend()
+    return NullBackend()
+
+
+class ResponseCache:
+    """Cache of rendered responses for public, non-personalized views.
+
+    Entries are keyed by endpoint, view arguments and query string, prefixed with a per-namespace
+    generation counter: writes bump the counter, which makes every older entry unreachable until it expires.
+    """
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self.prefix = ''
+        self.timeout = None
+        self.lock_timeout = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = create_backend(app)
+        self.prefix = app.config.get('CACHE_KEY_PREFIX', '')
+        self.timeout = app.config.get('CACHE_DEFAULT_TIMEOUT')
+        self.lock_timeout = app.config.get('CACHE_LOCK_TIMEOUT')
+        app.extensions['response_cache'] = self
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(str(part) for part in parts)
+
+    def generation(self, namespace):
+        return int(self.backend.get(self._key('generation', namespace)) or 0)
+
+    def invalidate(self, namespace):
+        self.backend.incr(self._key('generation', namespace))
+
+    def stats(self):
+        return {name: int(self.backend.get(self._key('stats', name)) or 0) for name in ('hit', 'miss')}
+
+    def _count(self, name):
+        self.backend.incr(self._key('stats', name))
+
+    def _request_key(self, namespace):
+        args = '&'.join(f'{key}={value}' for key, value in sorted(request.args.items(multi=True)))
+        view_args = '&'.join(f'{key}={value}' for key, value in sorted((request.view_args or dict()).items()))
+        theme = request.cookies.get('theme', '')
+        return self._key('response', namespace, self.generation(namespace), request.endpoint, view_args, args, theme)
+
+    @staticmethod
+    def _dump(response):
+        return pickle.dumps((response.status_code, response.headers.to_wsgi_list(), response.get_data()))
+
+    @staticmethod
+    def _load(payload):
+        status, headers, data = pickle.loads(payload)
+        return make_response(data, status, headers)
+
+    def _wait(self, key):
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(0.05)
+            payload = self.backend.get(key)
+            if payload:
+                return payload
+        return None
+
+    @staticmethod
+    def _is_personalized():
+        return current_user.is_authenticated or '_flashes' in session
+
+    def cached(self, namespace, timeout=None):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if self._is_personalized():
+                    return func(*args, **kwargs)
+                key = self._request_key(namespace)
+                payload = self.backend.get(key)
+                if payload:
+                    self._count('hit')
+                    return self._load(payload).make_conditional(request)
+                self._count('miss')
+                # Only the request holding the lock recomputes a missing entry, the others wait for its result.
+                lock_key = key + ':lock'
+                locked = self.backend.set(lock_key, 1, timeout=self.lock_timeout, nx=True)
+                if not locked:
+                    payload = self._wait(key)
+                    if payload:
+                        return self._load(payload).make_conditional(request)
+                try:
+                    response = make_response(func(*args, **kwargs))
+                    if response.status_code == 200 and not response.direct_passthrough:
+                        self.backend.set(key, self._dump(response), timeout=timeout or self.timeout)
+                finally:
+                    if locked:
+                        self.backend.delete(lock_key)
+                return response
+            return wrapper
+        return decorator
+
+
+class RecordCache:
+    """Small records read on hot paths, kept in a per-process LRU in front of the shared backend.
+
+    A deletion reaches the backend and the local LRU of the calling process only, so local entries
+    expire after local_timeout seconds: other processes see the change within that delay.
+    """
+    def __init__(self, app=None, namespace='record'):
+        self.namespace = namespace
+        self.backend = NullBackend()
+        self.prefix = ''
+        self.timeout = None
+        self.local_timeout = 0
+        self.max_size = 0
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = create_backend(app)
+        self.prefix = app.config.get('CACHE_KEY_PREFIX', '')
+        self.timeout = app.config.get('RECORD_CACHE_TIMEOUT')
+        self.local_timeout = app.config.get('RECORD_CACHE_LOCAL_TIMEOUT')
+        self.max_size = app.config.get('RECORD_CACHE_SIZE')
+        with self._lock:
+            self._local.clear()
+
+    def _key(self, key):
+        return f'{self.prefix}{self.namespace}:{key}'
+
+    def _get_local(self, key):
+        with self._lock:
+            value, expires = self._local.get(key, (None, 0))
+            if expires < time.time():
+                self._local.pop(key, None)
+                return None
+            self._local.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._local[key] = (value, time.time() + self.local_timeout)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def get(self, key, load_func):
+        """Returns the record of key, load_func(key) is only called when neither cache holds it."""
+        value = self._get_local(key)
+        if value is not None:
+            return value
+        payload = self.backend.get(self._key(key))
+        if payload:
+            value = json.loads(payload)
+        else:
+            value = load_func(key)
+            if value is None:
+                return None
+            self.backend.set(self._key(key), json.dumps(value), timeout=self.timeout)
+        self._set_local(key, value)
+        return value
+
+    def get_many(self, keys, load_many_func):
+        """Returns a dict of the records found for keys, the ones in neither cache are loaded by a single load_many_func(keys) call."""
+        values = dict()
+        for key in keys:
+            value = self._get_local(key)
+            if value is not None:
+                values[key] = value
+        missing = [key for key in keys if key not in values]
+        if missing:
+            payloads = self.backend.get_many(*[self._key(key) for key in missing])
+            for key, payload in zip(missing, payloads):
+                if payload:
+                    values[key] = json.loads(payload)
+                    self._set_local(key, values[key])
+            missing = [key for key in missing if key not in values]
+        if missing:
+            for key, value in load_many_func(missing).items():
+                self.backend.set(self._key(key), json.dumps(value), timeout=self.timeout)
+                self._set_local(key, value)
+                values[key] = value
+        return values
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+        self.backend.delete(*[self._key(key) for key in keys])
+
+
+class DiskCache:
+    """Files generated on demand and kept under a size budget, the least recently served ones are evicted first.
+
+    Recency is the file mtime, refreshed on every hit, so the budget is shared by every worker process
+    using the same directory: each one only keeps an estimate of the total and rescans when it exceeds the budget.
+    """
+    def __init__(self, app=None, path_key='SYS_MEDIA_VARIANT', size_key='SYS_MEDIA_VARIANT_CACHE_SIZE'):
+        self.path_key = path_key
+        self.size_key = size_key
+        self.path = None
+        self.max_size = None
+        self._size = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config.get(self.path_key)
+        self.max_size = app.config.get(self.size_key)
+        self._size = None
+
+    def _filename(self, name):
+        return os.path.join(self.path, name[:2], name)
+
+    def get(self, name):
+        filename = self._filename(name)
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            return None
+        return filename
+
+    def put(self, name, write_func):
+        filename = self._filename(name)
+        os.makedirs(os.path.dirname(filename), mode=0o750, exist_ok=True)
+        # Concurrent writers of the same entry each use their own temporary file, the last rename wins.
+        temporary_filename = f'{filename}.{uuid.uuid4().hex}.tmp'
+        try:
+            write_func(temporary_filename)
+            size = os.path.getsize(temporary_filename)
+            os.replace(temporary_filename, filename)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+        return filename
+
+    def delete(self, *names):
+        for name in names:
+            filename = self._filename(name)
+            try:
+                size = os.path.getsize(filename)
+                os.remove(filename)
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                if self._size is not None:
+                    self._size -= size
+
+    def _scan(self):
+        entries, total = [], 0
+        for root, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                try:
+                    stat = os.stat(os.path.join(root, filename))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, filename)))
+                total += stat.st_size
+        return entries, total
+
+    def _evict(self):
+        # Evict down to 90% of the budget so that the next few writes do not trigger another scan.
+        entries, total = self._scan()
+        target = self.max_size * 0.9
+        for _, size, filename in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+    def clear(self):
+        with self._lock:
+            for _, _, filename in self._scan()[0]:
+                os.remove(filename)
+            self._size = 0
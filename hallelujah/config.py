@@ -65,8 +65,20 @@ class Config:
     SYS_MEDIA = os.path.join(os.path.abspath(os.path.expanduser('~')), 'data', 'media')
     SYS_MEDIA_ORIGINAL = os.path.join(SYS_MEDIA, 'original')
     SYS_MEDIA_THUMBNAIL = os.path.join(SYS_MEDIA, 'thumbnail')
+    SYS_MEDIA_VARIANT = os.path.join(SYS_MEDIA, 'variant')
+    SYS_MEDIA_TRASH = os.path.join(SYS_MEDIA, 'trash')
     SYS_MEDIA_THUMBNAIL_HEIGHT = 200
+    SYS_MEDIA_VARIANT_WIDTHS = [320, 640, 1280, 1920]
+    SYS_MEDIA_VARIANT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+    SYS_MEDIA_MAX_AGE = 365 * 24 * 3600
     SYS_MEDIA_EXCLUDES = 'public,private'
+    # Media whose 64 bit perceptual hashes differ by at most this many bits are reported as similar.
+    SYS_MEDIA_SIMILAR_DISTANCE = 10
+    # Larger distances match most of a library, the pairs grow with the square of its size.
+    SYS_MEDIA_SIMILAR_MAX_DISTANCE = 16
+    # MEDIA DELIVERY: python, x-accel(nginx) or x-sendfile(apache/lighttpd)
+    SYS_MEDIA_DELIVERY = 'python'
+    SYS_MEDIA_ACCEL_PREFIX = '/protected_media'
     SYS_REGISTER = False
     SYS_SQLITE = False
     SYS_LOCAL_DEPLOY = True
@@ -81,6 +93,7 @@ class Config:
     # DROPZONE
     DROPZONE_PARALLEL_UPLOADS = 100
     DROPZONE_MAX_FILE_SIZE = 1024 * 1024 * 1024
+    DROPZONE_CHUNK_SIZE = 8 * 1024 * 1024
 
     # MAIL PORT CONFIG: 465 for SSL, 587 for TLS
     MAIL_PORT = 587
@@ -114,6 +127,24 @@ class Config:
     SESSION_COOKIE_SECURE = True
     SESSION_COOKIE_HTTPONLY = True
 
+    # CACHE: redis, simple(in process) or null
+    CACHE_TYPE = 'redis'
+    CACHE_REDIS = SESSION_REDIS
+    CACHE_KEY_PREFIX = SITE_NAME + ':cache:'
+    CACHE_DEFAULT_TIMEOUT = 300
+    CACHE_LOCK_TIMEOUT = 5
+    # RECORD CACHE: media metadata read by file serving, shared entries and per-process LRU entries in seconds
+    RECORD_CACHE_TIMEOUT = 24 * 3600
+    RECORD_CACHE_LOCAL_TIMEOUT = 10
+    RECORD_CACHE_SIZE = 10000
+
+    # MEDIA TASK: worker polling interval, running timeout and retention of finished tasks in seconds
+    TASK_POLL_INTERVAL = 1
+    TASK_TIMEOUT = 600
+    TASK_KEEP = 24 * 3600
+    # MEDIA WATCHER: seconds a file must stay unchanged before 'flask watch-media' imports it
+    WATCH_SETTLE_TIME = 2
+
     # SSH TUNNEL
     SSH_TUNNEL_SWITCH = False
     SSH_TUNNEL_PORT = 22
@@ -169,6 +200,7 @@ class TestingConfig(Config):
     SYS_SQLITE = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SESSION_TYPE = 'filesystem'
+    CACHE_TYPE = 'simple'
     SYS_LOCAL_DEPLOY = False
 
 
@@ -176,6 +208,7 @@ class DevelopmentConfig(Config):
     ENV = 'development'
     DEBUG = True
     SESSION_TYPE = 'filesystem'
+    CACHE_TYPE = 'simple'
 
 
 class ProductionConfig(Config):
@@ -10,6 +10,8 @@ from flask_mail import Mail
 from flask_moment import Moment
 from flask_session import Session
 
+from .cache import ResponseCache, RecordCache, DiskCache
+
 
 db = SQLAlchemy()
 migrate = Migrate()
@@ -18,4 +20,7 @@ login_manager = LoginManager()
 mail = Mail()
 moment = Moment()
 session = Session()
+cache = ResponseCache()
+media_cache = RecordCache(namespace='media')
+variant_cache = DiskCache()
 
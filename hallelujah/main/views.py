@@ -3,21 +3,26 @@
 
 
 import os
+import uuid
 import requests
 import urllib.parse
 from bs4 import BeautifulSoup
+from itsdangerous import URLSafeSerializer, BadSignature
 
 from flask_login import login_required, current_user
-from flask import Blueprint, render_template, request, current_app, abort, make_response, url_for, flash, jsonify, Response, send_file
+from flask import Blueprint, render_template, request, current_app, abort, make_response, url_for, flash, jsonify, Response, send_file, session
 
-from ..utility import redirect_save, redirect_back, browse_directory, import_user_media, MediaType, VIDEO_SUFFIXES, IMAGE_SUFFIXES
-from ..models import User, Article, Media, Resource
+from ..utility import redirect_save, redirect_back, get_upload_part_name, write_upload_chunk, get_variant_width, save_image_variant, send_media_file, send_media_bundle, send_zip, get_thumbnail_filename, make_etag, is_not_modified, set_validators, not_modified_response
+from ..utility import MediaType, VIDEO_SUFFIXES, IMAGE_SUFFIXES
+from ..models import User, Article, Media, MediaFolder, MediaTask, Resource
+from ..extensions import cache, variant_cache
 from .forms import ArticleForm, ResourceForm, DirectoryForm
 
 
 bp_main = Blueprint('main', __name__)
 
 @bp_main.route('/')
+@cache.cached('articles')
 def index():
     return render_template('main/articles.html', user=None, is_self=False)
 
@@ -32,11 +37,18 @@ def user_articles(user_name):
     return render_template('main/articles.html', user=user, is_self=False)
 
 @bp_main.route('/article/<article_url>')
+@cache.cached('articles')
 def article(article_url):
     article = Article.query.filter(Article.url == article_url).first_or_404()
     if not article.is_public and (not current_user.is_authenticated or article.user_id != current_user.id):
         return redirect_back('main.index')
-    return render_template('main/view_article.html', article=article, is_self=(current_user==article.author))
+    user_id = current_user.id if current_user.is_authenticated else None
+    last_modified = article.last_modified or article.timestamp
+    etag = make_etag(article.id, last_modified, user_id, request.cookies.get('theme', ''))
+    if '_flashes' not in session and is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    response = make_response(render_template('main/view_article.html', article=article, is_self=(current_user==article.author)))
+    return set_validators(response, etag, last_modified)
 
 @bp_main.route('/articles')
 @login_required
@@ -101,10 +113,17 @@ def _get_thumbnail_path():
 
 def _get_full_path(current_path, current_user):
     base_path = _get_original_path()
-    root = current_path.split(os.sep)[0]
-    if not current_user.is_authenticated or root != current_user.name:
+    names = current_path.split(os.sep)
+    if not current_user.is_authenticated or names[0] != current_user.name:
+        return None
+    # 'alice/../bob' would otherwise reach the library of another user.
+    if os.path.normpath(current_path) != current_path or '..' in names:
         return None
     full_path = os.path.join(base_path, current_path)
+    user_path = os.path.realpath(os.path.join(base_path, current_user.name))
+    real_path = os.path.realpath(full_path)
+    if real_path != user_path and not real_path.startswith(user_path + os.sep):
+        return None
     if os.path.isdir(full_path):
         return full_path
     return None
@@ -122,16 +141,15 @@ def manage_medias(current_path):
     full_path = _get_full_path(current_path, current_user)
     if not full_path:
         return redirect_back()
-    dirs = browse_directory(full_path)
-    files = Media.query.filter(Media.path==current_path).order_by(Media.filename.asc()).all()
     form = DirectoryForm()
     if form.validate_on_submit():
         target_dir = form.directory_name.data
         target_path = os.path.join(full_path, target_dir)
         os.makedirs(target_path, mode=0o775, exist_ok=True)
-        dirs.append(target_dir)
-        dirs.sort()
-        flash('Directory ' + os.path.join(current_path, target_dir) + ' is added successfully!')
+        if MediaFolder.add_folder(current_user.id, os.path.join(current_path, target_dir)):
+            flash('Directory ' + os.path.join(current_path, target_dir) + ' is added successfully!')
+    dirs = MediaFolder.get_children(current_user.id, current_path)
+    files = Media.query.filter(Media.path==current_path).order_by(Media.filename.asc()).all()
     return render_template('main/medias.html', current_path=current_path, form=form, dirs=dirs, files=files)
 
 @bp_main.route('/upload/<path:current_path>', methods=['POST'])
@@ -152,40 +170,190 @@ def upload(current_path):
         file.save(full_path_name)
         if not os.path.isfile(full_path_name):
             return make_response('file not found', 404)
-        media = import_user_media(full_path_name, is_public, current_user.query_user_media, current_user.add_user_media)
-        if not media:
+        task = MediaTask.add_task(current_user.id, current_path, filename, is_public)
+        if not task:
             return make_response('internal error', 500)
-        result_dict[filename] = media.uuidname
+        result_dict[filename] = task.id
     return make_response(jsonify(result_dict), 200)
 
+def _get_upload_serializer():
+    return URLSafeSerializer(current_app.config.get('SECRET_KEY'), salt='upload')
+
+def _load_upload(upload_id):
+    try:
+        upload = _get_upload_serializer().loads(upload_id)
+    except BadSignature:
+        return None, None, None
+    full_path = _get_full_path(upload['path'], current_user)
+    if upload['user_id'] != current_user.id or not full_path:
+        return None, None, None
+    part_name = get_upload_part_name(full_path, upload['nonce'])
+    if not os.path.isfile(part_name):
+        return None, None, None
+    return upload, full_path, part_name
+
+@bp_main.route('/upload_init/<path:current_path>', methods=['POST'])
+@login_required
+def upload_init(current_path):
+    full_path = _get_full_path(current_path, current_user)
+    if not full_path:
+        return make_response('forbidden', 403)
+    data = request.get_json(silent=True) or dict()
+    filename = os.path.basename(data.get('filename') or '')
+    size = data.get('size')
+    if not filename or filename.startswith('.') or not isinstance(size, int) or size < 0:
+        return make_response('bad request', 400)
+    if size > current_app.config.get('DROPZONE_MAX_FILE_SIZE'):
+        return make_response('file too large', 413)
+    # A client resuming after a disconnect presents its previous upload id and continues from the returned offset.
+    if data.get('upload_id'):
+        upload, _, part_name = _load_upload(data['upload_id'])
+        if upload and upload['path'] == current_path and upload['filename'] == filename and upload['size'] == size:
+            return jsonify({'upload_id': data['upload_id'], 'offset': os.path.getsize(part_name)})
+    upload = dict(user_id=current_user.id, path=current_path, filename=filename, size=size,
+                  is_public=bool(data.get('is_public')), nonce=uuid.uuid4().hex)
+    open(get_upload_part_name(full_path, upload['nonce']), 'wb').close()
+    return jsonify({'upload_id': _get_upload_serializer().dumps(upload), 'offset': 0})
+
+@bp_main.route('/upload_chunk/<upload_id>', methods=['GET', 'POST'])
+@login_required
+def upload_chunk(upload_id):
+    upload, _, part_name = _load_upload(upload_id)
+    if not upload:
+        return make_response('file not found', 404)
+    current_offset = os.path.getsize(part_name)
+    if request.method == 'GET':
+        return jsonify({'offset': current_offset})
+    offset = request.args.get('offset', type=int)
+    if offset is None or offset < 0:
+        return make_response('bad request', 400)
+    if offset > current_offset:
+        return make_response(jsonify({'offset': current_offset}), 409)
+    # Chunks already stored are acknowledged without rewriting them, so a resent upload only costs the transfer.
+    if request.content_length is not None and offset + request.content_length <= current_offset:
+        return jsonify({'offset': current_offset})
+    # Raw bodies are read straight from the socket, the multipart form is only a fallback for clients that need it.
+    if request.mimetype == 'multipart/form-data':
+        if 'file' not in request.files:
+            return make_response('bad request', 400)
+        stream = request.files['file'].stream
+    else:
+        stream = request.stream
+    new_offset = write_upload_chunk(part_name, stream, offset, upload['size'])
+    if new_offset is None:
+        return make_response('file too large', 413)
+    return jsonify({'offset': new_offset})
+
+@bp_main.route('/upload_finalize/<upload_id>', methods=['POST'])
+@login_required
+def upload_finalize(upload_id):
+    upload, full_path, part_name = _load_upload(upload_id)
+    if not upload:
+        return make_response('file not found', 404)
+    current_offset = os.path.getsize(part_name)
+    if current_offset != upload['size']:
+        return make_response(jsonify({'offset': current_offset}), 409)
+    full_path_name = os.path.join(full_path, upload['filename'])
+    os.replace(part_name, full_path_name)
+    # Thumbnails and metadata are produced by the media worker, the client polls the task status.
+    task = MediaTask.add_task(current_user.id, upload['path'], upload['filename'], upload['is_public'])
+    if not task:
+        return make_response('internal error', 500)
+    return make_response(jsonify({upload['filename']: task.id}), 200)
+
+def _get_media_etag(filename, *parts):
+    # Media keep their uuid when edited in place but their urls get a new version, together they validate the content.
+    return make_etag(os.path.splitext(filename)[0], request.args.get('v', ''), *parts)
+
+def _get_variant_request():
+    width = request.args.get('w', type=int)
+    if not width or width <= 0:
+        return None
+    width = get_variant_width(width, current_app.config.get('SYS_MEDIA_VARIANT_WIDTHS'))
+    image_format = 'WEBP' if 'image/webp' in request.accept_mimetypes.values() else 'JPEG'
+    return width, image_format
+
+def _send_variant(media, filename, etag, width, image_format):
+    name = '{}_{}.{}'.format(os.path.splitext(media['uuidname'])[0], width, image_format.lower())
+    variant_file = variant_cache.get(name)
+    if not variant_file:
+        full_path_name = os.path.join(_get_original_path(), media['path'], media['filename'])
+        if not os.path.isfile(full_path_name):
+            return Response('', status=204, mimetype='text/xml')
+        try:
+            variant_file = variant_cache.put(name, lambda temporary_file: save_image_variant(full_path_name, temporary_file, width, image_format))
+        except (OSError, ValueError) as e:
+            current_app.logger.error('_send_variant: {}'.format(str(e)))
+            return Response('', status=204, mimetype='text/xml')
+    response = send_file(variant_file, mimetype='image/' + image_format.lower(), download_name=filename, etag=etag)
+    response.headers['Cache-Control'] = _get_media_cache_control()
+    response.vary.add('Accept')
+    return response
+
+def _can_read_media(media):
+    return media['is_public'] or (current_user.is_authenticated and current_user.name == media['author_name'])
+
+def _get_media_cache_control():
+    return 'private, max-age={}, immutable'.format(current_app.config.get('SYS_MEDIA_MAX_AGE'))
+
 @bp_main.route('/file/<filename>')
 def get_file(filename):
     as_attachment = bool(request.args.get('download', 'no') == 'yes')
-    media = Media.query.filter(Media.uuidname == filename).first()
-    if not media or (not media.is_public and (not current_user.is_authenticated or current_user.name != media.author.name)):
+    etag = _get_media_etag(filename, as_attachment)
+    if is_not_modified(etag):
+        return not_modified_response(etag, cache_control=_get_media_cache_control())
+    media = Media.get_file_record(os.path.splitext(filename)[0])
+    if not media or media['uuidname'] != filename or not _can_read_media(media):
         return Response('', status=204, mimetype='text/xml')
-    full_path_name = os.path.join(_get_original_path(), media.path, media.filename)
-    download_name = filename if not as_attachment else media.filename
+    full_path_name = os.path.join(_get_original_path(), media['path'], media['filename'])
+    download_name = filename if not as_attachment else media['filename']
     if not os.path.isfile(full_path_name):
         return Response('', status=204, mimetype='text/xml')
-    return send_file(full_path_name, as_attachment=as_attachment, download_name=download_name)
+    return send_media_file(full_path_name, download_name, etag, as_attachment=as_attachment, cache_control=_get_media_cache_control())
 
 @bp_main.route('/thumbnail/<filename>')
 def get_thumbnail(filename):
-    uuid = os.path.splitext(os.path.basename(filename))[0]
-    media = Media.query.filter(Media.uuidname.like(f'{uuid}%')).first()
-    if not media or media.media_type < MediaType.IMAGE or (not media.is_public and (not current_user.is_authenticated or current_user.name != media.author.name)):
+    variant = _get_variant_request()
+    etag = _get_media_etag(filename, *(variant or ()))
+    if is_not_modified(etag):
+        response = not_modified_response(etag, cache_control=_get_media_cache_control())
+        if variant:
+            response.vary.add('Accept')
+        return response
+    media = Media.get_file_record(os.path.splitext(os.path.basename(filename))[0])
+    if not media or media['media_type'] < MediaType.IMAGE or not _can_read_media(media):
         return Response('', status=204, mimetype='text/xml')
-    if media.media_type == MediaType.VIDEO:
-        media_filename = os.path.splitext(media.filename)[0] + IMAGE_SUFFIXES[0]
-    else:
-        media_filename = media.filename
-    full_path_name = os.path.join(_get_thumbnail_path(), media.path, media_filename)
+    if variant and media['media_type'] == MediaType.IMAGE:
+        return _send_variant(media, filename, etag, *variant)
+    full_path_name = os.path.join(_get_thumbnail_path(), media['path'], get_thumbnail_filename(media['filename'], media['media_type']))
     if not os.path.isfile(full_path_name):
         return Response('', status=204, mimetype='text/xml')
-    return send_file(full_path_name, as_attachment=False, download_name=filename)
+    response = send_file(full_path_name, as_attachment=False, download_name=filename, etag=etag)
+    response.headers['Cache-Control'] = _get_media_cache_control()
+    return response
+
+@bp_main.route('/thumbnails')
+def get_thumbnails():
+    # One request for a whole gallery page: the thumbnails are sent back to back and unpacked into blob urls.
+    filenames = [filename for filename in request.args.get('uuids', '').split(',') if filename]
+    if not filenames or len(filenames) > current_app.config.get('ITEMS_PER_PAGE'):
+        return 'bad request', 400
+    uuidstems = [os.path.splitext(filename)[0] for filename in filenames]
+    etag = make_etag('bundle', request.args.get('v', ''), *uuidstems)
+    if is_not_modified(etag):
+        return not_modified_response(etag, cache_control=_get_media_cache_control())
+    medias = Media.get_file_records(list(set(uuidstems)))
+    entries = []
+    for filename, uuidstem in zip(filenames, uuidstems):
+        media = medias.get(uuidstem)
+        full_path_name = None
+        if media and media['media_type'] >= MediaType.IMAGE and _can_read_media(media):
+            full_path_name = os.path.join(_get_thumbnail_path(), media['path'], get_thumbnail_filename(media['filename'], media['media_type']))
+        entries.append((filename, full_path_name))
+    return send_media_bundle(entries, etag, cache_control=_get_media_cache_control())
 
 def _delete_file(media):
+    # Deduplicated media share hardlinks, removing a name only frees the content once its last link is gone.
     full_path_name = os.path.join(_get_original_path(), media.path, media.filename)
     if os.path.isfile(full_path_name):
         os.remove(full_path_name)
@@ -197,18 +365,10 @@ def _delete_file(media):
     if os.path.isfile(full_path_name):
         os.remove(full_path_name)
 
-def _delete_directory(path):
-    full_path_name = os.path.join(_get_original_path(), path)
-    if os.path.isdir(full_path_name):
-        os.removedirs(full_path_name)
-    full_path_name = os.path.join(_get_thumbnail_path(), path)
-    if os.path.isdir(full_path_name):
-        os.removedirs(full_path_name)
-
 @bp_main.route('/delete', methods=['POST'])
 def delete_dropzone_file():
     filename = request.get_json().get('filename', '')
-    if not current_user.is_authenticated:
+    if not current_user.is_authenticated or not filename:
         return 'bad request', 400
     media = Media.query.filter(Media.uuidname == filename).first()
     if not media:
@@ -224,20 +384,27 @@ def delete_dropzone_file():
 @login_required
 def delete_media_directory(current_path):
     full_path = _get_full_path(current_path, current_user)
-    if not full_path:
+    # The user root holds the whole library and stays, only directories below it can be deleted.
+    if not full_path or os.sep not in current_path:
         return redirect_back()
-    medias = Media.query.filter(Media.path.like(f'{current_path}%')).all()
-    for media in medias:
-        if not media or media.author.name != current_user.name or not Media.delete_media(media.uuidname):
-            flash('Failed to delete media directory {}!'.format(current_path))
-            break
-        else:
-            _delete_file(media)
+    # Rows go in one transaction and the files are handed to the media worker, whatever the directory holds.
+    if not Media.delete_directory(current_user.id, current_path):
+        flash('Failed to delete media directory {}!'.format(current_path))
     else:
-        _delete_directory(current_path)
         flash('Media directory ' + current_path + ' is deleted!')
     return redirect_back()
 
+@bp_main.route('/download_directory/<path:current_path>', methods=['GET'])
+@login_required
+def download_media_directory(current_path):
+    if not _get_full_path(current_path, current_user):
+        return redirect_back()
+    # The archive is streamed while it is built, names in it start with the downloaded directory.
+    prefix = len(os.path.dirname(current_path) + os.sep) if os.sep in current_path else 0
+    entries = [(os.path.join(_get_original_path(), path, filename), os.path.join(path, filename)[prefix:], timestamp)
+               for path, filename, timestamp in Media.query_directory_files(current_user.id, current_path)]
+    return send_zip(entries, os.path.basename(current_path) + '.zip')
+
 @bp_main.route('/delete/<filename>', methods=['GET'])
 @login_required
 def delete_media(filename):
@@ -3,18 +3,22 @@
 
 
 import os
+import re
+import time
 import uuid
 import hashlib
 import datetime
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from faker import Faker
-from sqlalchemy import exc
+from sqlalchemy import exc, event, DDL
+from sqlalchemy.dialects.mysql import match
 from flask import current_app, url_for
 from flask_login import UserMixin, AnonymousUserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from jinja2.filters import do_striptags, do_truncate
 
-from .extensions import db, login_manager
-from .utility import markdown_to_html, get_thumbnail_size, get_media_files, import_user_medias, MediaType, IMAGE_SUFFIXES
+from .extensions import db, login_manager, cache, media_cache, variant_cache
+from .utility import MARKDOWN_RENDER_VERSION, render_markdown, markdown_hash, html_to_text, text_to_summary, count_words, sqlite_in_use, url_template, versioned_url, get_thumbnail_size, get_media_files, import_user_media, probe_media, place_media, normalize_media_ext, get_relative_name, get_thumbnail_name, get_thumbnail_filename, save_thumbnail, read_thumbnail_info, split_media_sequence, hash_file, link_media, break_link, is_upload_part, trash_media_directory, restore_media_directory, empty_trash, PerceptualHashIndex, MediaType, TaskStatus, TaskKind, IMAGE_SUFFIXES
 from .config import Config
 
 
@@ -86,7 +90,7 @@ class User(UserMixin, db.Model):
         if not os.path.exists(user_path):
             os.makedirs(user_path)
         else:
-            import_user_medias(self.name, self.query_user_media, self.add_user_media)
+            User.import_medias(self.name)
 
     @staticmethod
     def add_user(name, email, password):
@@ -101,22 +105,124 @@ class User(UserMixin, db.Model):
         return user
 
     @staticmethod
-    def query_user_media(username, pathname, filename):
+    def query_user_media(pathname, stem):
+        # Paths start with the user name, so the path alone scopes the query to one user.
+        # A range on the filename within the path rather than a LIKE, which most databases can not seek.
+        upper = stem[:-1] + chr(ord(stem[-1]) + 1)
+        rows = db.session.query(Media.filename).filter(Media.path==pathname, Media.filename >= stem, Media.filename < upper).all()
+        return {os.path.splitext(row.filename)[0] for row in rows}
+
+    @staticmethod
+    def find_user_media(username, content_hash):
         user = User.query.filter(User.name==username).first()
         if not user:
-            return False
-        name = os.path.splitext(filename)[0]
-        media = Media.query.filter(Media.path==pathname).filter(Media.filename.like(f'{name}%')).first()
-        return media is not None
+            return None
+        return Media.query.filter(Media.user_id==user.id, Media.content_hash==content_hash).order_by(Media.id.asc()).first()
 
     @staticmethod
-    def add_user_media(username, pathname, filename, timestamp, width=None, height=None, media_type=MediaType.OTHER, is_public=False):
+    def add_user_media(username, pathname, filename, timestamp, width=None, height=None, media_type=MediaType.OTHER, is_public=False, duration=None, codec=None, content_hash=None, file_size=None,
+                       placeholder=None, dominant_color=None, perceptual_hash=None, file_mtime=None):
         user = User.query.filter(User.name==username).first()
         if not user:
             return None
-        media = Media.add_media(user.id, pathname, filename, timestamp, width, height, media_type, is_public)
+        media = Media.add_media(user.id, pathname, filename, timestamp, width, height, media_type, is_public, duration, codec, content_hash, file_size,
+                                placeholder, dominant_color, perceptual_hash, file_mtime)
         return media
 
+    @staticmethod
+    def import_medias(name, jobs=None, batch_size=500, is_public=False):
+        """Import every file under the user media directory which has no media row yet.
+
+        Files are probed on a process pool and inserted batch by batch, so an interrupted import
+        resumes where it stopped and already imported files only cost a set lookup.
+        Returns (imported count, failed count), or None if the user does not exist.
+        """
+        user = User.query.filter(User.name==name).first()
+        if not user:
+            return None
+        user_path = os.path.join(current_app.config.get('SYS_MEDIA_ORIGINAL'), name)
+        os.makedirs(user_path, mode=0o750, exist_ok=True)
+        rows = db.session.query(Media.path, Media.filename, Media.media_type, Media.content_hash).filter(Media.user_id==user.id).all()
+        imported = {(row.path, row.filename) for row in rows}
+        taken = defaultdict(set)
+        for row in rows:
+            stem = os.path.splitext(row.filename)[0]
+            taken[(row.path, split_media_sequence(stem)[0])].add(stem)
+        contents = {row.content_hash: (row.path, row.filename, row.media_type) for row in rows if row.content_hash}
+        files = []
+        for root, _, filenames in os.walk(user_path):
+            relative_path = get_relative_name(root)
+            files.extend(os.path.join(root, filename) for filename in sorted(filenames)
+                         if not is_upload_part(filename) and (relative_path, filename) not in imported)
+        folders = dict()
+        if not files:
+            MediaFolder.sync_user_folders(user)
+            return 0, 0
+
+        def query_taken(pathname, stem):
+            return taken[(pathname, stem)]
+
+        jobs = jobs or os.cpu_count() or 1
+        thumbnail_height = current_app.config.get('SYS_MEDIA_THUMBNAIL_HEIGHT')
+        count, failed, reclaimed, start = 0, 0, 0, time.time()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for index in range(0, len(files), batch_size):
+                batch = [normalize_media_ext(media_fullname) for media_fullname in files[index:index+batch_size]]
+                thumbnails = [get_thumbnail_name(media_fullname) for media_fullname in batch]
+                for thumbnail_dirname in {os.path.dirname(thumbnail) for thumbnail in thumbnails}:
+                    os.makedirs(thumbnail_dirname, mode=0o750, exist_ok=True)
+                results = executor.map(_probe_user_media, batch, thumbnails, [thumbnail_height] * len(batch),
+                                       chunksize=max(1, len(batch) // (jobs * 4)))
+                medias, hashes = [], []
+                for media_fullname, thumbnail, (metadata, error) in zip(batch, thumbnails, results):
+                    if not metadata:
+                        current_app.logger.error(f'import_medias: failed to probe {media_fullname}, {error}')
+                        failed += 1
+                        continue
+                    relative_path = os.path.dirname(get_relative_name(media_fullname))
+                    filename = place_media(media_fullname, os.path.dirname(thumbnail), metadata, query_taken)
+                    stem = os.path.splitext(filename)[0]
+                    taken[(relative_path, split_media_sequence(stem)[0])].add(stem)
+                    (width, height), media_type, media_timestamp, _, media_info = metadata
+                    # Copies already in the library are kept under their own names but share one inode.
+                    if media_info['content_hash'] in contents:
+                        reclaimed += link_media(get_media_files(*contents[media_info['content_hash']]),
+                                                get_media_files(relative_path, filename, media_type))
+                    else:
+                        contents[media_info['content_hash']] = (relative_path, filename, media_type)
+                        hashes.append(media_info['content_hash'])
+                    if relative_path not in folders:
+                        folders[relative_path] = MediaFolder.ensure_folder(user.id, relative_path).id
+                    file_mtime = os.stat(get_media_files(relative_path, filename, media_type)[0]).st_mtime_ns
+                    medias.append(Media(user_id=user.id, path=relative_path, filename=filename, folder_id=folders[relative_path],
+                                        timestamp=datetime.datetime.fromtimestamp(media_timestamp), file_mtime=file_mtime,
+                                        width=width, height=height, media_type=media_type, is_public=is_public, **media_info))
+                db.session.add_all(medias)
+                try:
+                    db.session.flush()
+                    MediaFolder.refresh_folders({media.folder_id for media in medias})
+                    db.session.commit()
+                except exc.SQLAlchemyError as e:
+                    current_app.logger.error('import_medias: {}'.format(str(e)))
+                    db.session.rollback()
+                    # The originals stay under their placed names and are picked up by the next import, their thumbnails go.
+                    for media in medias:
+                        current_app.logger.error(f'import_medias: failed to record {os.path.join(media.path, media.filename)}')
+                        thumbnail = get_media_files(media.path, media.filename, media.media_type)[1]
+                        if os.path.isfile(thumbnail):
+                            os.remove(thumbnail)
+                    for content_hash in hashes:
+                        contents.pop(content_hash, None)
+                    folders.clear()
+                    failed += len(medias)
+                    continue
+                count += len(medias)
+                scanned = index + len(batch)
+                current_app.logger.info(f'import_medias: {scanned}/{len(files)} scanned, {count} imported, {failed} failed, '
+                                        f'{reclaimed / 1024 / 1024:.1f} MiB deduplicated, {scanned / (time.time() - start):.1f} files/s')
+        MediaFolder.sync_user_folders(user)
+        return count, failed
+
     @staticmethod
     def _remove_user_source(current_path):
         if os.path.isdir(current_path):
@@ -158,16 +264,82 @@ def load_user(user_id):
     return User.query.get(int(user_id))
 
 
+def _probe_user_media(media_fullname, thumbnail_fullname, height):
+    try:
+        return probe_media(media_fullname, thumbnail_fullname, height), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _save_user_thumbnail(media_fullname, thumbnail_fullname, height):
+    try:
+        return save_thumbnail(media_fullname, thumbnail_fullname, height), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _scan_directory(path):
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry.stat() for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return dict()
+
+
+def _check_media_directory(original_path, thumbnail_path, rows, verify_hash):
+    # Runs on a checker thread, it only touches the filesystem and returns (findings, manifest updates).
+    originals, thumbnails = _scan_directory(original_path), _scan_directory(thumbnail_path)
+    findings, updates = defaultdict(list), []
+    for row in rows:
+        original = os.path.join(original_path, row.filename)
+        stat = originals.pop(row.filename, None)
+        thumbnail_filename = get_thumbnail_filename(row.filename, row.media_type)
+        has_thumbnail = not thumbnail_filename or thumbnails.pop(thumbnail_filename, None) is not None
+        if not stat:
+            findings['missing'].append(original)
+            continue
+        if not has_thumbnail:
+            findings['missing_thumbnails'].append(original)
+        changed = (row.file_size is not None and row.file_size != stat.st_size) or \
+                  (row.file_mtime is not None and row.file_mtime != stat.st_mtime_ns)
+        update = {'id': row.id, 'file_size': stat.st_size, 'file_mtime': stat.st_mtime_ns}
+        if verify_hash and (changed or not row.content_hash):
+            content_hash = hash_file(original)
+            if row.content_hash and content_hash != row.content_hash:
+                findings['corrupted'].append(original)
+                continue
+            update['content_hash'] = content_hash
+        elif changed:
+            # Kept out of the manifest until a hashed run tells an edit from a corruption.
+            findings['changed'].append(original)
+            continue
+        if (row.file_size, row.file_mtime) != (stat.st_size, stat.st_mtime_ns) or 'content_hash' in update:
+            updates.append(update)
+    findings['unrecorded'].extend(os.path.join(original_path, filename) for filename in sorted(originals) if not is_upload_part(filename))
+    findings['orphaned_thumbnails'].extend(os.path.join(thumbnail_path, filename) for filename in sorted(thumbnails))
+    return findings, updates
+
+
 class Article(db.Model):
     __tablename__ = 'articles'
+    __table_args__ = (
+        db.Index('ix_articles_public_timestamp_id', 'is_public', 'timestamp', 'id'),
+        db.Index('ix_articles_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=False, nullable=False, index=True)
     timestamp = db.Column(db.DateTime, unique=False, nullable=False, index=True, default=datetime.datetime.utcnow)
+    last_modified = db.Column(db.DateTime, unique=False, nullable=True, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     url = db.Column(db.String(Config.MAX_STR_LEN), unique=True, nullable=False, index=True)
     is_public = db.Column(db.Boolean, unique=False, nullable=False, default=True)
     title = db.Column(db.String(Config.SHORT_STR_LEN), unique=False, nullable=False)
     content = db.Column(db.Text, unique=False, nullable=False)
     content_html = db.Column(db.Text, unique=False, nullable=False)
+    content_text = db.Column(db.Text, unique=False, nullable=True)
+    summary = db.Column(db.String(Config.MAX_STR_LEN), unique=False, nullable=True)
+    word_count = db.Column(db.Integer, unique=False, nullable=True, default=0)
+    render_version = db.Column(db.Integer, unique=False, nullable=True, index=True)
+    content_hash = db.Column(db.String(Config.SHORT_STR_LEN), unique=False, nullable=True)
 
     def __init__(self, **kwargs):
         super(Article, self).__init__(**kwargs)
@@ -187,28 +359,173 @@ class Article(db.Model):
 
     def _generate_url_html(self):
         self.url = self._generate_url()
-        self.content_html = markdown_to_html(self.content)
+        self._render_content()
+
+    def _render_content(self):
+        self.content_html, self.content_text, self.summary, self.word_count = render_markdown(self.content)
+        self.render_version = MARKDOWN_RENDER_VERSION
+        self.content_hash = markdown_hash(self.content)
+
+    def _generate_text(self):
+        self.content_text = html_to_text(self.content_html)
+        self.summary = text_to_summary(self.content_text)
+        self.word_count = count_words(self.content_text)
+
+    def _update_search_index(self, delete=False):
+        Article._update_search_rows([{'id': self.id, 'title': self.title, 'content_text': self.content_text}], delete)
+
+    @staticmethod
+    def _update_search_rows(rows, delete=False):
+        # MySQL/MariaDB keeps the FULLTEXT index in sync by itself, only the FTS5 table needs maintenance.
+        if not sqlite_in_use() or not rows:
+            return
+        db.session.execute(db.text('DELETE FROM articles_fts WHERE rowid = :id'), [{'id': row['id']} for row in rows])
+        if not delete:
+            db.session.execute(db.text('INSERT INTO articles_fts (rowid, title, content_text) VALUES (:id, :title, :content_text)'), rows)
+
+    @property
+    def author_name(self):
+        return self.author.name
 
     def to_json(self):
-        json_article = {
-            'author': self.author.name,
-            'author_url': url_for('main.user', user_name=self.author.name, _external=True),
-            'title': self.title,
-            'truncated_content': do_truncate(current_app.jinja_env, do_striptags(self.content_html)),
-            'timestamp': self.timestamp,
-            'url': url_for('main.article', article_url=self.url, _external=True),
-        }
-        return json_article
+        return Article.rows_to_json([self])[0]
+
+    @staticmethod
+    def query_json_rows():
+        return db.session.query(Article.id, Article.timestamp, Article.last_modified, Article.url, Article.title, Article.summary,
+                                Article.word_count, User.name.label('author_name')).join(User, Article.user_id == User.id)
+
+    @staticmethod
+    def rows_to_json(rows):
+        author_url = url_template('main.user', 'user_name')
+        article_url = url_template('main.article', 'article_url')
+        return [{
+            'author': row.author_name,
+            'author_url': author_url(row.author_name),
+            'title': row.title,
+            'truncated_content': row.summary or '',
+            'word_count': row.word_count or 0,
+            'timestamp': row.timestamp,
+            'url': article_url(row.url),
+        } for row in rows]
+
+    @staticmethod
+    def _fulltext_terms(keywords):
+        if sqlite_in_use():
+            return ' '.join('"{}"*'.format(keyword.replace('"', '""')) for keyword in keywords)
+        words = re.sub(r'[+\-<>()~*"@]', ' ', ' '.join(keywords)).split()
+        return ' '.join(f'+{word}*' for word in words)
+
+    @staticmethod
+    def search_articles(keywords, user_id, articles=None):
+        terms = Article._fulltext_terms(keywords)
+        articles = articles if articles is not None else Article.query
+        articles = articles.filter(db.or_(Article.user_id == user_id, Article.is_public == True))
+        if not terms:
+            # Both backends reject an empty match expression, nothing or only operators were given.
+            return articles.filter(db.false()), db.literal(0.0)
+        if sqlite_in_use():
+            # bm25() is smaller for better matches, negate it so that both backends rank by descending score.
+            fts = db.text('SELECT rowid AS id, -bm25(articles_fts, 10.0, 1.0) AS score FROM articles_fts WHERE articles_fts MATCH :terms')
+            fts = fts.bindparams(terms=terms).columns(id=db.Integer, score=db.Float).subquery()
+            articles = articles.join(fts, fts.c.id == Article.id)
+            score = fts.c.score
+        else:
+            score = match(Article.title, Article.content_text, against=terms).in_boolean_mode()
+            articles = articles.filter(score > 0)
+        return articles, score
+
+    @staticmethod
+    def _update_in_batches(articles, update_func, batch_size):
+        count, last_id = 0, 0
+        while True:
+            batch = articles.filter(Article.id > last_id).order_by(Article.id.asc()).limit(batch_size).all()
+            if not batch:
+                return count
+            for article in batch:
+                update_func(article)
+            try:
+                db.session.commit()
+            except exc.SQLAlchemyError as e:
+                current_app.logger.error('_update_in_batches: {}'.format(str(e)))
+                db.session.rollback()
+                return count
+            cache.invalidate('articles')
+            last_id = batch[-1].id
+            count += len(batch)
+
+    @staticmethod
+    def reindex(batch_size=500):
+        if sqlite_in_use():
+            db.session.execute(db.text(ARTICLES_FTS_CREATE))
+            db.session.execute(db.text('DELETE FROM articles_fts'))
+
+        def update_func(article):
+            article.content_text = html_to_text(article.content_html)
+            article._update_search_index()
+
+        count = Article._update_in_batches(Article.query, update_func, batch_size)
+        if not sqlite_in_use():
+            indexes = [index['name'] for index in db.inspect(db.engine).get_indexes(Article.__tablename__)]
+            if 'ix_articles_fulltext' not in indexes:
+                db.session.execute(db.text(ARTICLES_FULLTEXT_CREATE))
+                db.session.commit()
+        return count
+
+    @staticmethod
+    def summarize(all_articles=False, batch_size=500):
+        articles = Article.query if all_articles else Article.query.filter(Article.summary == None)
+        return Article._update_in_batches(articles, Article._generate_text, batch_size)
+
+    @staticmethod
+    def rerender(jobs=None, batch_size=500, force=False):
+        # Stale rows are detected from (render_version, content_hash), rendered on a process pool
+        # and written back with one bulk update per batch.
+        columns = db.session.query(Article.id, Article.title, Article.content, Article.render_version, Article.content_hash)
+        count, scanned, last_id, start = 0, 0, 0, time.time()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            while True:
+                rows = columns.filter(Article.id > last_id).order_by(Article.id.asc()).limit(batch_size).all()
+                if not rows:
+                    break
+                last_id, scanned = rows[-1].id, scanned + len(rows)
+                hashes = [markdown_hash(row.content) for row in rows]
+                stale = [(row, content_hash) for row, content_hash in zip(rows, hashes)
+                         if force or row.render_version != MARKDOWN_RENDER_VERSION or row.content_hash != content_hash]
+                if not stale:
+                    continue
+                chunksize = max(1, len(stale) // ((jobs or os.cpu_count() or 1) * 4))
+                results = executor.map(render_markdown, [row.content for row, _ in stale], chunksize=chunksize)
+                mappings = [{'id': row.id, 'content_html': html, 'content_text': text, 'summary': summary,
+                             'word_count': word_count, 'render_version': MARKDOWN_RENDER_VERSION, 'content_hash': content_hash}
+                            for (row, content_hash), (html, text, summary, word_count) in zip(stale, results)]
+                try:
+                    db.session.bulk_update_mappings(Article, mappings)
+                    Article._update_search_rows([{'id': row.id, 'title': row.title, 'content_text': mapping['content_text']}
+                                                 for (row, _), mapping in zip(stale, mappings)])
+                    db.session.commit()
+                except exc.SQLAlchemyError as e:
+                    current_app.logger.error('rerender: {}'.format(str(e)))
+                    db.session.rollback()
+                    break
+                cache.invalidate('articles')
+                count += len(mappings)
+                elapsed = time.time() - start
+                current_app.logger.info(f'rerender: {count} re-rendered, {scanned} scanned, {scanned / elapsed:.1f} articles/s')
+        return count
 
     @staticmethod
     def add_article(user_id, is_public, title, content):
         article = Article(user_id=user_id, is_public=is_public, title=title, content=content)
         db.session.add(article)
         try:
+            db.session.flush()
+            article._update_search_index()
             db.session.commit()
         except exc.SQLAlchemyError as e:
             current_app.logger.error('add_article: {}'.format(str(e)))
             return None
+        cache.invalidate('articles')
         return article
 
     @staticmethod
@@ -219,13 +536,15 @@ class Article(db.Model):
         article.is_public = is_public
         article.title = title
         article.content = content
-        article.content_html = markdown_to_html(content)
+        article._render_content()
         db.session.add(article)
         try:
+            article._update_search_index()
             db.session.commit()
         except exc.SQLAlchemyError as e:
             current_app.logger.error('add_article: {}'.format(str(e)))
             return None
+        cache.invalidate('articles')
         return article
 
     @staticmethod
@@ -235,10 +554,12 @@ class Article(db.Model):
             return False
         db.session.delete(article)
         try:
+            article._update_search_index(delete=True)
             db.session.commit()
         except exc.SQLAlchemyError as e:
             current_app.logger.error('add_article: {}'.format(str(e)))
             return False
+        cache.invalidate('articles')
         return True
 
     @staticmethod
@@ -254,18 +575,44 @@ class Article(db.Model):
                                     fake.text(max_nb_chars=current_app.config.get('MAX_STR_LEN')))
 
 
+ARTICLES_FTS_CREATE = 'CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5(title, content_text)'
+ARTICLES_FULLTEXT_CREATE = 'ALTER TABLE articles ADD FULLTEXT INDEX ix_articles_fulltext (title, content_text)'
+event.listen(Article.__table__, 'after_create', DDL(ARTICLES_FTS_CREATE).execute_if(dialect='sqlite'))
+event.listen(Article.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS articles_fts').execute_if(dialect='sqlite'))
+event.listen(Article.__table__, 'after_create', DDL(ARTICLES_FULLTEXT_CREATE).execute_if(dialect='mysql'))
+
+
 class Media(db.Model):
     __tablename__ = 'medias'
+    __table_args__ = (
+        db.Index('ix_medias_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_medias_user_content_hash', 'user_id', 'content_hash'),
+        # A folder stands for one path, so this is unique on (path, filename) within a 3072 byte InnoDB key.
+        db.UniqueConstraint('folder_id', 'filename', name='uq_medias_folder_filename'),
+        db.Index('ix_medias_folder_timestamp_id', 'folder_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=False, nullable=False, index=True)
     timestamp = db.Column(db.DateTime, unique=False, nullable=False, index=True)
     path = db.Column(db.String(Config.MAX_STR_LEN), unique=False, nullable=False, index=True)
     filename = db.Column(db.String(Config.MAX_STR_LEN), unique=False, nullable=False, index=True)
     uuidname = db.Column(db.String(Config.SHORT_STR_LEN), unique=True, nullable=False, index=True)
+    # The uuid without extension, thumbnails and variants are requested by it and need an exact lookup.
+    uuidstem = db.Column(db.String(Config.SHORT_STR_LEN), unique=True, nullable=False, index=True)
     width = db.Column(db.Integer, unique=False, nullable=True, index=False)
     height = db.Column(db.Integer, unique=False, nullable=True, index=False)
     media_type = db.Column(db.Integer, unique=False, nullable=False, index=True, default=MediaType.OTHER)
     is_public = db.Column(db.Boolean, unique=False, nullable=False, index=True, default=False)
+    duration = db.Column(db.Float, unique=False, nullable=True, index=False)
+    codec = db.Column(db.String(Config.SHORT_STR_LEN), unique=False, nullable=True, index=False)
+    content_hash = db.Column(db.String(Config.SHORT_STR_LEN), unique=False, nullable=True, index=False)
+    # Size and mtime in nanoseconds of the original when recorded or last seen by 'flask check', so that unchanged files are not read again.
+    file_size = db.Column(db.BigInteger, unique=False, nullable=True, index=False)
+    file_mtime = db.Column(db.BigInteger, unique=False, nullable=True, index=False)
+    placeholder = db.Column(db.Text, unique=False, nullable=True)
+    dominant_color = db.Column(db.String(Config.MIN_STR_LEN * 2), unique=False, nullable=True, index=False)
+    perceptual_hash = db.Column(db.BigInteger, unique=False, nullable=True, index=False)
+    folder_id = db.Column(db.Integer, db.ForeignKey('media_folders.id'), unique=False, nullable=True, index=False)
 
     def __init__(self, **kwargs):
         super(Media, self).__init__(**kwargs)
@@ -279,43 +626,96 @@ class Media(db.Model):
 
     def _generate_uuidname(self):
         file_ext = os.path.splitext(self.filename)[1]
-        self.uuidname = uuid.uuid4().hex + file_ext
+        self.uuidstem = uuid.uuid4().hex
+        self.uuidname = self.uuidstem + file_ext
+
+    @property
+    def author_name(self):
+        return self.author.name
+
+    @property
+    def version(self):
+        return Media.content_version(self.content_hash)
+
+    @staticmethod
+    def content_version(content_hash):
+        # Files edited in place keep their uuid, their urls carry this so that browsers drop the immutable copies.
+        return content_hash[:16] if content_hash else None
 
     def to_json(self):
-        view_url = url_for('main.get_file', filename=self.uuidname, _external=True)
-        download_url = url_for('main.get_file', filename=self.uuidname, download='yes', _external=True)
-        if self.media_type == MediaType.VIDEO:
-            video_thumbnail = os.path.splitext(self.uuidname)[0] + IMAGE_SUFFIXES[0]
-            thumbnail_url = url_for('main.get_thumbnail', filename=video_thumbnail, _external=True)
-        elif self.media_type == MediaType.IMAGE:
-            thumbnail_url = url_for('main.get_thumbnail', filename=self.uuidname, _external=True)
-        else:
-            thumbnail_url = view_url
-        thumbnail_size = get_thumbnail_size((self.width, self.height), Config.SYS_MEDIA_THUMBNAIL_HEIGHT)
-        json_media = {
-            'author': self.author.name,
-            'timestamp': self.timestamp,
-            'uuidname': self.uuidname,
-            'view_url': view_url,
-            'download_url': download_url,
-            'thumbnail_url': thumbnail_url if self.media_type >= MediaType.IMAGE else view_url,
-            'height': self.height,
-            'width': self.width,
-            'thumbnail_height': thumbnail_size[1],
-            'thumbnail_width': thumbnail_size[0],
-            'media_type': self.media_type,
-            'is_public': self.is_public,
-        }
-        return json_media
+        return Media.rows_to_json([self])[0]
+
+    @staticmethod
+    def query_json_rows():
+        return db.session.query(Media.id, Media.timestamp, Media.uuidname, Media.width, Media.height, Media.media_type,
+                                Media.is_public, Media.duration, Media.placeholder, Media.dominant_color, Media.content_hash,
+                                User.name.label('author_name')).join(User, Media.user_id == User.id)
 
     @staticmethod
-    def add_media(user_id, pathname, filename, timestamp, width=None, height=None, media_type=MediaType.OTHER, is_public=False):
-        media = Media(user_id=user_id, path=pathname, filename=filename, timestamp=timestamp, width=width, height=height, media_type=media_type, is_public=is_public)
-        db.session.add(media)
+    def rows_to_json(rows):
+        file_url = url_template('main.get_file', 'filename')
+        download_url = url_template('main.get_file', 'filename', download='yes')
+        thumbnail_url = url_template('main.get_thumbnail', 'filename')
+        thumbnail_height = Config.SYS_MEDIA_THUMBNAIL_HEIGHT
+        variant_widths = sorted(Config.SYS_MEDIA_VARIANT_WIDTHS)
+        variant_urls = [(width, url_template('main.get_thumbnail', 'filename', w=width)) for width in variant_widths]
+        json_medias = []
+        for row in rows:
+            version = Media.content_version(row.content_hash)
+            view_url = preview_url = versioned_url(file_url(row.uuidname), version)
+            srcset = ''
+            if row.width and row.height:
+                thumbnail_size = get_thumbnail_size((row.width, row.height), thumbnail_height)
+            else:
+                thumbnail_size = (None, None)
+            if row.media_type == MediaType.VIDEO:
+                media_thumbnail_url = versioned_url(thumbnail_url(os.path.splitext(row.uuidname)[0] + IMAGE_SUFFIXES[0]), version)
+            elif row.media_type == MediaType.IMAGE:
+                media_thumbnail_url = versioned_url(thumbnail_url(row.uuidname), version)
+                if row.width:
+                    preview_url = versioned_url(variant_urls[-1][1](row.uuidname), version)
+                    srcset = ', '.join([f'{media_thumbnail_url} {thumbnail_size[0]}w'] +
+                                       [f'{versioned_url(variant_url(row.uuidname), version)} {width}w' for width, variant_url in variant_urls
+                                        if thumbnail_size[0] < width < row.width])
+            else:
+                media_thumbnail_url = view_url
+            json_medias.append({
+                'author': row.author_name,
+                'timestamp': row.timestamp,
+                'uuidname': row.uuidname,
+                'version': version,
+                'view_url': view_url,
+                'download_url': versioned_url(download_url(row.uuidname), version),
+                'thumbnail_url': media_thumbnail_url,
+                'preview_url': preview_url,
+                'srcset': srcset,
+                'height': row.height,
+                'width': row.width,
+                'thumbnail_height': thumbnail_size[1],
+                'thumbnail_width': thumbnail_size[0],
+                'media_type': row.media_type,
+                'is_public': row.is_public,
+                'duration': row.duration,
+                'placeholder': row.placeholder,
+                'dominant_color': row.dominant_color,
+            })
+        return json_medias
+
+    @staticmethod
+    def add_media(user_id, pathname, filename, timestamp, width=None, height=None, media_type=MediaType.OTHER, is_public=False, duration=None, codec=None, content_hash=None, file_size=None,
+                  placeholder=None, dominant_color=None, perceptual_hash=None, file_mtime=None):
+        media = Media(user_id=user_id, path=pathname, filename=filename, timestamp=timestamp, width=width, height=height, media_type=media_type, is_public=is_public,
+                      duration=duration, codec=codec, content_hash=content_hash, file_size=file_size, placeholder=placeholder, dominant_color=dominant_color,
+                      perceptual_hash=perceptual_hash, file_mtime=file_mtime)
         try:
+            folder = MediaFolder.ensure_folder(user_id, pathname)
+            media.folder_id = folder.id
+            db.session.add(media)
+            MediaFolder.add_media_stats(folder.id, 1, file_size or 0, timestamp)
             db.session.commit()
         except exc.SQLAlchemyError as e:
             current_app.logger.error('add_media: {}'.format(str(e)))
+            db.session.rollback()
             return None
         return media
 
@@ -326,36 +726,671 @@ class Media(db.Model):
             return False
         db.session.delete(media)
         try:
+            db.session.flush()
+            MediaFolder.refresh_folders([media.folder_id])
             db.session.commit()
         except exc.SQLAlchemyError as e:
             current_app.logger.error('delete_media: {}'.format(str(e)))
+            db.session.rollback()
             return False
+        media_cache.delete(media.uuidstem)
         return True
 
     @staticmethod
-    def check_media():
-        data_set = set()
-        items = Media.query.all()
-        for item in items:
-            original_media, thumbnail_media = get_media_files(item.path, item.filename, item.media_type)
-            if original_media in data_set:
-                current_app.logger.error(f'duplicated file in database: {original_media}')
-            elif not os.path.isfile(original_media):
-                current_app.logger.error(f'invalid file in database: {original_media}')
-            else:
-                data_set.add(original_media)
-            if thumbnail_media:
-                if thumbnail_media in data_set:
-                    current_app.logger.error(f'duplicated file in database: {thumbnail_media}')
-                elif not os.path.isfile(thumbnail_media):
-                    current_app.logger.error(f'invalid file in database: {thumbnail_media}')
-                else:
-                    data_set.add(thumbnail_media)
-        for root, _, files in os.walk(current_app.config.get('SYS_MEDIA'), topdown=False):
-            for filename in files:
-                cur_filename = os.path.join(root, filename)
-                if cur_filename not in data_set:
-                    current_app.logger.error(f'unrecorded file: {cur_filename}')
+    def query_directory_files(user_id, pathname):
+        """Returns the (path, filename, timestamp) of the media below pathname, skipping the folders excluded below it."""
+        return db.session.query(Media.path, Media.filename, Media.timestamp) \
+            .filter(Media.folder_id.in_(MediaFolder.query_subtree_ids(user_id, pathname))).order_by(Media.path.asc(), Media.filename.asc()).all()
+
+    @staticmethod
+    def delete_directory(user_id, pathname):
+        """Delete a media directory with everything below it in one transaction, returns the task removing its files.
+
+        The directories are moved to the trash before the commit, they disappear at once and the worker unlinks them later.
+        """
+        subtree = db.and_(Media.user_id==user_id, db.or_(Media.path==pathname, db.and_(
+            Media.path > pathname + os.sep, Media.path < pathname + chr(ord(os.sep) + 1))))
+        uuidstems = [row.uuidstem for row in db.session.query(Media.uuidstem).filter(subtree)]
+        task = MediaTask(user_id=user_id, path=pathname, filename=uuid.uuid4().hex, kind=TaskKind.DELETE)
+        moves = []
+        try:
+            db.session.query(Media).filter(subtree).delete(synchronize_session=False)
+            MediaFolder.delete_subtree(user_id, pathname)
+            db.session.add(task)
+            db.session.flush()
+            moves = trash_media_directory(pathname, task.filename)
+            db.session.commit()
+        except (exc.SQLAlchemyError, OSError) as e:
+            current_app.logger.error('delete_directory: {}'.format(str(e)))
+            db.session.rollback()
+            restore_media_directory(moves)
+            return None
+        media_cache.delete(*uuidstems)
+        return task
+
+    @staticmethod
+    def _query_file_records():
+        return db.session.query(Media.uuidstem, Media.uuidname, Media.path, Media.filename, Media.media_type, Media.is_public, User.name) \
+            .join(User, Media.user_id == User.id)
+
+    @staticmethod
+    def _to_file_record(row):
+        return {'uuidname': row.uuidname, 'path': row.path, 'filename': row.filename,
+                'media_type': row.media_type, 'is_public': row.is_public, 'author_name': row.name}
+
+    @staticmethod
+    def _load_file_record(uuidstem):
+        row = Media._query_file_records().filter(Media.uuidstem == uuidstem).first()
+        if not row:
+            return None
+        return Media._to_file_record(row)
+
+    @staticmethod
+    def _load_file_records(uuidstems):
+        rows = Media._query_file_records().filter(Media.uuidstem.in_(uuidstems)).all()
+        return {row.uuidstem: Media._to_file_record(row) for row in rows}
+
+    @staticmethod
+    def get_file_record(uuidstem):
+        """Returns what serving a file needs: uuidname, path, filename, media_type, is_public and author_name."""
+        return media_cache.get(uuidstem, Media._load_file_record)
+
+    @staticmethod
+    def get_file_records(uuidstems):
+        """Returns a dict of uuidstem to file record for the existing media among uuidstems, in at most one query."""
+        return media_cache.get_many(uuidstems, Media._load_file_records)
+
+    @staticmethod
+    def dedupe(jobs=None, batch_size=500):
+        """Hash the media recorded before content hashes existed, then hardlink identical files of each user.
+
+        Returns (hashed count, linked count, bytes reclaimed).
+        """
+        hashed, last_id = 0, 0
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            while True:
+                rows = db.session.query(Media.id, Media.path, Media.filename, Media.media_type) \
+                    .filter(Media.content_hash.is_(None), Media.id > last_id).order_by(Media.id.asc()).limit(batch_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                rows = [(row.id, get_media_files(row.path, row.filename, row.media_type)[0]) for row in rows]
+                rows = [(media_id, original_media) for media_id, original_media in rows if os.path.isfile(original_media)]
+                hashes = executor.map(hash_file, [original_media for _, original_media in rows])
+                mappings = [{'id': media_id, 'content_hash': content_hash} for (media_id, _), content_hash in zip(rows, hashes)]
+                try:
+                    db.session.bulk_update_mappings(Media, mappings)
+                    db.session.commit()
+                except exc.SQLAlchemyError as e:
+                    current_app.logger.error('dedupe: {}'.format(str(e)))
+                    db.session.rollback()
+                    return hashed, 0, 0
+                hashed += len(mappings)
+                current_app.logger.info(f'dedupe: {hashed} media hashed')
+        linked, reclaimed = 0, 0
+        groups = db.session.query(Media.user_id, Media.content_hash).filter(Media.content_hash.isnot(None)) \
+            .group_by(Media.user_id, Media.content_hash).having(db.func.count(Media.id) > 1).all()
+        for user_id, content_hash in groups:
+            medias = Media.query.filter(Media.user_id == user_id, Media.content_hash == content_hash).order_by(Media.id.asc()).all()
+            source_files = get_media_files(medias[0].path, medias[0].filename, medias[0].media_type)
+            for media in medias[1:]:
+                size = link_media(source_files, get_media_files(media.path, media.filename, media.media_type))
+                linked, reclaimed = linked + bool(size), reclaimed + size
+        return hashed, linked, reclaimed
+
+    @staticmethod
+    def fill_placeholders(jobs=None, batch_size=500):
+        """Compute the placeholder, dominant color and perceptual hash of the media imported before they were recorded, from their thumbnails."""
+        count, last_id = 0, 0
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            while True:
+                rows = db.session.query(Media.id, Media.path, Media.filename, Media.media_type) \
+                    .filter(db.or_(Media.placeholder.is_(None), Media.perceptual_hash.is_(None)), Media.media_type >= MediaType.IMAGE, Media.id > last_id) \
+                    .order_by(Media.id.asc()).limit(batch_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                rows = [(row.id, get_media_files(row.path, row.filename, row.media_type)[1]) for row in rows]
+                rows = [(media_id, thumbnail) for media_id, thumbnail in rows if os.path.isfile(thumbnail)]
+                results = executor.map(read_thumbnail_info, [thumbnail for _, thumbnail in rows])
+                mappings = [dict(info, id=media_id) for (media_id, _), info in zip(rows, results) if info]
+                try:
+                    db.session.bulk_update_mappings(Media, mappings)
+                    db.session.commit()
+                except exc.SQLAlchemyError as e:
+                    current_app.logger.error('fill_placeholders: {}'.format(str(e)))
+                    db.session.rollback()
+                    break
+                count += len(mappings)
+                current_app.logger.info(f'fill_placeholders: {count} media updated')
+        return count
+
+    @staticmethod
+    def fill_uuidstems(batch_size=500):
+        """Add the uuidstem column to a database created before it existed and fill it from uuidname, returns the count filled.
+
+        The column is added nullable and its unique index is only created once every row has a stem.
+        """
+        if 'uuidstem' not in [column['name'] for column in db.inspect(db.engine).get_columns(Media.__tablename__)]:
+            db.session.execute(db.text(MEDIAS_UUIDSTEM_ADD))
+            db.session.commit()
+        count = 0
+        while True:
+            rows = db.session.query(Media.id, Media.uuidname).filter(Media.uuidstem.is_(None)).limit(batch_size).all()
+            if not rows:
+                break
+            try:
+                db.session.bulk_update_mappings(Media, [{'id': row.id, 'uuidstem': os.path.splitext(row.uuidname)[0]} for row in rows])
+                db.session.commit()
+            except exc.SQLAlchemyError as e:
+                current_app.logger.error('fill_uuidstems: {}'.format(str(e)))
+                db.session.rollback()
+                return count
+            count += len(rows)
+            current_app.logger.info(f'fill_uuidstems: {count} media updated')
+        if 'ix_medias_uuidstem' not in [index['name'] for index in db.inspect(db.engine).get_indexes(Media.__tablename__)]:
+            db.session.execute(db.text(MEDIAS_UUIDSTEM_INDEX))
+            db.session.commit()
+        return count
+
+    @staticmethod
+    def sync_file(full_path_name, is_public=False):
+        """Import a file written under SYS_MEDIA_ORIGINAL by hand, returns its uuidname or None when there is nothing to do.
+
+        A recorded file keeps its row, uuid and visibility, its content is refreshed in place. An upload is left to its pending task.
+        """
+        pathname, filename = os.path.split(get_relative_name(full_path_name))
+        media = Media.query.filter(Media.path==pathname, Media.filename==filename).first()
+        if media:
+            return Media._sync_recorded_file(media, full_path_name)
+        if MediaTask.query.filter(MediaTask.path==pathname, MediaTask.filename==filename,
+                                  MediaTask.status.in_([TaskStatus.PENDING, TaskStatus.RUNNING])).first():
+            return None
+        media = import_user_media(full_path_name, is_public, User.query_user_media, User.add_user_media, User.find_user_media)
+        if not media:
+            raise RuntimeError(f'failed to import {full_path_name}')
+        return media.uuidname
+
+    @staticmethod
+    def _sync_recorded_file(media, full_path_name):
+        # An attribute change such as chmod leaves size and mtime alone, the file is not even read then.
+        stat = os.stat(full_path_name)
+        if (media.file_size, media.file_mtime) == (stat.st_size, stat.st_mtime_ns):
+            return None
+        content_hash = hash_file(full_path_name)
+        if media.content_hash is None or media.content_hash == content_hash:
+            # Touched, or recorded before content hashes existed: only the row is brought up to date.
+            db.session.bulk_update_mappings(Media, [{'id': media.id, 'content_hash': content_hash,
+                                                     'file_size': stat.st_size, 'file_mtime': stat.st_mtime_ns}])
+            try:
+                MediaFolder.refresh_folders([media.folder_id])
+                db.session.commit()
+            except exc.SQLAlchemyError as e:
+                current_app.logger.error('sync_file: {}'.format(str(e)))
+                db.session.rollback()
+            return None
+        return Media._refresh_media(media, full_path_name, stat)
+
+    @staticmethod
+    def _refresh_media(media, full_path_name, stat):
+        # Edited in place: the media hardlinked to this original by 'flask dedupe' were edited along with it.
+        medias = [media]
+        if stat.st_nlink > 1:
+            for other in Media.query.filter(Media.user_id==media.user_id, Media.content_hash==media.content_hash, Media.id!=media.id):
+                other_fullname = get_media_files(other.path, other.filename, other.media_type)[0]
+                if os.path.isfile(other_fullname) and os.path.samefile(other_fullname, full_path_name):
+                    medias.append(other)
+            # Copy on write, so that the next edit of this file no longer reaches the others.
+            break_link(full_path_name)
+        thumbnail = get_media_files(media.path, media.filename, media.media_type)[1]
+        (width, height), _, media_datetime, temporary_thumbnail, media_info = probe_media(
+            full_path_name, get_thumbnail_name(full_path_name), current_app.config.get('SYS_MEDIA_THUMBNAIL_HEIGHT'))
+        if temporary_thumbnail:
+            os.replace(temporary_thumbnail, thumbnail)
+            link_media([thumbnail] * (len(medias) - 1),
+                       [get_media_files(other.path, other.filename, other.media_type)[1] for other in medias[1:]])
+        timestamp = datetime.datetime.fromtimestamp(media_datetime)
+        uuidstems = [other.uuidstem for other in medias]
+        db.session.bulk_update_mappings(Media, [dict(media_info, id=other.id, width=width, height=height, timestamp=timestamp,
+                                                     file_mtime=stat.st_mtime_ns) for other in medias])
+        try:
+            MediaFolder.refresh_folders({other.folder_id for other in medias})
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            current_app.logger.error('sync_file: {}'.format(str(e)))
+            db.session.rollback()
+            return None
+        variant_cache.delete(*['{}_{}.{}'.format(uuidstem, variant_width, image_format) for uuidstem in uuidstems
+                               for variant_width in current_app.config.get('SYS_MEDIA_VARIANT_WIDTHS') for image_format in ('webp', 'jpeg')])
+        return media.uuidname
+
+    @staticmethod
+    def find_similar_media(user_id, max_distance, uuidname=None):
+        """Returns the (id, id, distance) pairs of the media of a user whose perceptual hashes differ by at most max_distance bits.
+
+        Byte-identical copies are left to 'flask dedupe' and not reported. With uuidname, only the pairs of that media are.
+        """
+        rows = db.session.query(Media.id, Media.uuidname, Media.perceptual_hash, Media.content_hash) \
+            .filter(Media.user_id==user_id, Media.perceptual_hash.isnot(None)).order_by(Media.id.asc()).all()
+        index = PerceptualHashIndex([row.id for row in rows], [row.perceptual_hash for row in rows])
+        if uuidname:
+            target = next((row for row in rows if row.uuidname == uuidname), None)
+            if not target:
+                return []
+            pairs = [(target.id, media_id, distance) for media_id, distance in index.search(target.perceptual_hash, max_distance) if media_id != target.id]
+        else:
+            pairs = index.pairs(max_distance)
+        contents = {row.id: row.content_hash for row in rows}
+        return [(a, b, distance) for a, b, distance in pairs if not contents[a] or contents[a] != contents[b]]
+
+    @staticmethod
+    def get_relative_names(media_ids):
+        rows = db.session.query(Media.id, Media.path, Media.filename).filter(Media.id.in_(media_ids)).all()
+        return {row.id: os.path.join(row.path, row.filename) for row in rows}
+
+    @staticmethod
+    def check_media(jobs=None, verify_hash=False, repair=False):
+        """Check the media rows against the files, directory by directory, returns a report of the findings.
+
+        Each directory is listed once on a thread instead of testing every file, and only the originals whose
+        size or mtime moved since the last run are hashed again when verify_hash is set.
+        Repair regenerates missing thumbnails and imports unrecorded originals.
+        """
+        original_base_path = current_app.config.get('SYS_MEDIA_ORIGINAL')
+        thumbnail_base_path = current_app.config.get('SYS_MEDIA_THUMBNAIL')
+        paths = {row.path for row in db.session.query(Media.path).distinct()}
+        for base_path in (original_base_path, thumbnail_base_path):
+            for root, _, _ in os.walk(base_path):
+                paths.add(os.path.relpath(root, base_path) if root != base_path else '')
+        paths = sorted(paths)
+        report = defaultdict(list, directories=len(paths), media=0, repaired_thumbnails=0, imported=0)
+        jobs = jobs or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for index in range(0, len(paths), jobs * 4):
+                batch = paths[index:index+jobs*4]
+                rows = [db.session.query(Media.id, Media.filename, Media.media_type, Media.file_size, Media.file_mtime, Media.content_hash)
+                        .filter(Media.path==path).all() for path in batch]
+                results = executor.map(_check_media_directory, [os.path.join(original_base_path, path) for path in batch],
+                                       [os.path.join(thumbnail_base_path, path) for path in batch], rows, [verify_hash] * len(batch))
+                updates = []
+                for path_rows, (findings, path_updates) in zip(rows, results):
+                    report['media'] += len(path_rows)
+                    for name, filenames in findings.items():
+                        report[name].extend(filenames)
+                    updates.extend(path_updates)
+                if updates:
+                    try:
+                        db.session.bulk_update_mappings(Media, updates)
+                        db.session.commit()
+                    except exc.SQLAlchemyError as e:
+                        current_app.logger.error('check_media: {}'.format(str(e)))
+                        db.session.rollback()
+        for name, message in (('missing', 'invalid file in database'), ('missing_thumbnails', 'missing thumbnail'),
+                              ('changed', 'changed file'), ('corrupted', 'corrupted file'),
+                              ('unrecorded', 'unrecorded file'), ('orphaned_thumbnails', 'unrecorded file')):
+            for filename in report[name]:
+                current_app.logger.error(f'{message}: {filename}')
+        if repair:
+            Media._repair_media(report, jobs)
+        return dict(report)
+
+    @staticmethod
+    def _repair_media(report, jobs):
+        originals = report['missing_thumbnails']
+        if originals:
+            thumbnails = [get_thumbnail_name(original) for original in originals]
+            for thumbnail_dirname in {os.path.dirname(thumbnail) for thumbnail in thumbnails}:
+                os.makedirs(thumbnail_dirname, mode=0o750, exist_ok=True)
+            height = current_app.config.get('SYS_MEDIA_THUMBNAIL_HEIGHT')
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = executor.map(_save_user_thumbnail, originals, thumbnails, [height] * len(originals))
+                for original, (thumbnail, error) in zip(originals, results):
+                    if not thumbnail:
+                        current_app.logger.error(f'check_media: failed to regenerate thumbnail of {original}, {error}')
+                        continue
+                    report['repaired_thumbnails'] += 1
+        usernames = {get_relative_name(original).split(os.sep)[0] for original in report['unrecorded']
+                     if os.sep in get_relative_name(original)}
+        for username in sorted(usernames):
+            report['imported'] += (User.import_medias(username, jobs=jobs) or (0, 0))[0]
+
+
+MEDIAS_UUIDSTEM_ADD = f'ALTER TABLE medias ADD COLUMN uuidstem VARCHAR({Config.SHORT_STR_LEN})'
+MEDIAS_UUIDSTEM_INDEX = 'CREATE UNIQUE INDEX ix_medias_uuidstem ON medias (uuidstem)'
+
+
+class MediaFolder(db.Model):
+    """Media directory of a user with the aggregates of the media stored directly in it.
+
+    The tree is kept in step with the media rows, so listings and gallery queries never touch the disk:
+    path is materialized and a subtree is a range on the (user_id, path) index. excluded_depth is the depth
+    of the first path component named in SYS_MEDIA_EXCLUDES, a gallery hides the folders excluded below it.
+    """
+    __tablename__ = 'media_folders'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'path', name='uq_media_folders_user_path'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=False, nullable=False, index=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('media_folders.id'), unique=False, nullable=True, index=True)
+    path = db.Column(db.String(Config.MAX_STR_LEN), unique=False, nullable=False, index=False)
+    name = db.Column(db.String(Config.MAX_STR_LEN), unique=False, nullable=False, index=False)
+    depth = db.Column(db.Integer, unique=False, nullable=False, index=False, default=0)
+    excluded_depth = db.Column(db.Integer, unique=False, nullable=True, index=False)
+    media_count = db.Column(db.Integer, unique=False, nullable=False, index=False, default=0)
+    total_size = db.Column(db.BigInteger, unique=False, nullable=False, index=False, default=0)
+    newest_timestamp = db.Column(db.DateTime, unique=False, nullable=True, index=False)
+
+    def __repr__(self):
+        return '{}: id={}, user_id={}, path={}'.format(self.__class__.__name__, self.id, self.user_id, self.path)
+
+    def __str__(self):
+        return self.__repr__()
+
+    @staticmethod
+    def _get_excluded_depth(path):
+        excludes = set(current_app.config.get('SYS_MEDIA_EXCLUDES').split(','))
+        for depth, name in enumerate(path.split(os.sep)):
+            if depth and name in excludes:
+                return depth
+        return None
+
+    @staticmethod
+    def get_folder(user_id, path):
+        return MediaFolder.query.filter(MediaFolder.user_id==user_id, MediaFolder.path==path).first()
+
+    @staticmethod
+    def ensure_folder(user_id, path):
+        """Returns the folder of path, adding it and its missing ancestors to the current transaction."""
+        folder = MediaFolder.get_folder(user_id, path)
+        if folder:
+            return folder
+        parent = MediaFolder.ensure_folder(user_id, os.path.dirname(path)) if os.sep in path else None
+        folder = MediaFolder(user_id=user_id, parent_id=parent.id if parent else None, path=path, name=os.path.basename(path),
+                             depth=path.count(os.sep), excluded_depth=MediaFolder._get_excluded_depth(path))
+        # Another process may add the same folder meanwhile, the savepoint lets us pick up its row instead.
+        try:
+            with db.session.begin_nested():
+                db.session.add(folder)
+        except exc.IntegrityError:
+            folder = MediaFolder.get_folder(user_id, path)
+        return folder
+
+    @staticmethod
+    def add_folder(user_id, path):
+        try:
+            folder = MediaFolder.ensure_folder(user_id, path)
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            current_app.logger.error('add_folder: {}'.format(str(e)))
+            db.session.rollback()
+            return None
+        return folder
+
+    @staticmethod
+    def add_media_stats(folder_id, count, size, timestamp):
+        newest = db.case((db.or_(MediaFolder.newest_timestamp.is_(None), MediaFolder.newest_timestamp < timestamp), timestamp),
+                         else_=MediaFolder.newest_timestamp)
+        db.session.query(MediaFolder).filter(MediaFolder.id==folder_id).update(
+            {'media_count': MediaFolder.media_count + count, 'total_size': MediaFolder.total_size + size, 'newest_timestamp': newest},
+            synchronize_session=False)
+
+    @staticmethod
+    def refresh_folders(folder_ids):
+        """Recompute the aggregates of the given folders from their media, in the current transaction."""
+        folder_ids = [folder_id for folder_id in folder_ids if folder_id]
+        if not folder_ids:
+            return
+        stats = {row.folder_id: row for row in db.session.query(
+            Media.folder_id, db.func.count(Media.id).label('media_count'), db.func.sum(Media.file_size).label('total_size'),
+            db.func.max(Media.timestamp).label('newest_timestamp')).filter(Media.folder_id.in_(folder_ids)).group_by(Media.folder_id)}
+        db.session.bulk_update_mappings(MediaFolder, [
+            {'id': folder_id, 'media_count': stats[folder_id].media_count, 'total_size': stats[folder_id].total_size or 0,
+             'newest_timestamp': stats[folder_id].newest_timestamp} if folder_id in stats else
+            {'id': folder_id, 'media_count': 0, 'total_size': 0, 'newest_timestamp': None} for folder_id in folder_ids])
+
+    @staticmethod
+    def get_children(user_id, path):
+        folder = MediaFolder.get_folder(user_id, path)
+        if not folder:
+            return []
+        return MediaFolder.query.filter(MediaFolder.parent_id==folder.id).order_by(MediaFolder.name.asc()).all()
+
+    @staticmethod
+    def _filter_subtree(query, user_id, path):
+        # Every path below 'a/b' sorts between 'a/b/' and 'a/b0', the character following the separator.
+        return query.filter(MediaFolder.user_id==user_id, db.or_(
+            MediaFolder.path==path, db.and_(MediaFolder.path > path + os.sep, MediaFolder.path < path + chr(ord(os.sep) + 1))))
+
+    @staticmethod
+    def query_subtree_ids(user_id, path, with_excluded=False):
+        query = MediaFolder._filter_subtree(db.session.query(MediaFolder.id), user_id, path)
+        if not with_excluded:
+            query = query.filter(db.or_(MediaFolder.excluded_depth.is_(None), MediaFolder.excluded_depth <= path.count(os.sep)))
+        return query
+
+    @staticmethod
+    def delete_subtree(user_id, path):
+        """Delete the folder rows of path and below in the current transaction, their media must be gone already."""
+        # One statement per level, deepest first, so no parent goes before its children.
+        depths = MediaFolder._filter_subtree(db.session.query(MediaFolder.depth), user_id, path).distinct().all()
+        for (depth,) in sorted(depths, reverse=True):
+            MediaFolder._filter_subtree(MediaFolder.query, user_id, path).filter(MediaFolder.depth==depth).delete(synchronize_session=False)
+
+    @staticmethod
+    def delete_folder(user_id, path):
+        try:
+            MediaFolder.delete_subtree(user_id, path)
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            current_app.logger.error('delete_folder: {}'.format(str(e)))
+            db.session.rollback()
+            return False
+        return True
+
+    @staticmethod
+    def sync_user_folders(user):
+        """Add the directories found on disk, attach the media without folder and recompute every aggregate of the user."""
+        original_path = current_app.config.get('SYS_MEDIA_ORIGINAL')
+        try:
+            for root, _, _ in os.walk(os.path.join(original_path, user.name)):
+                MediaFolder.ensure_folder(user.id, get_relative_name(root))
+            for (path,) in db.session.query(Media.path).filter(Media.user_id==user.id, Media.folder_id.is_(None)).distinct().all():
+                folder = MediaFolder.ensure_folder(user.id, path)
+                db.session.query(Media).filter(Media.user_id==user.id, Media.path==path, Media.folder_id.is_(None)) \
+                    .update({'folder_id': folder.id}, synchronize_session=False)
+            MediaFolder.refresh_folders([folder_id for (folder_id,) in db.session.query(MediaFolder.id).filter(MediaFolder.user_id==user.id)])
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            current_app.logger.error('sync_user_folders: {}'.format(str(e)))
+            db.session.rollback()
+            return False
+        return True
+
+    def to_json(self):
+        return {
+            'name': self.name,
+            'path': self.path,
+            'media_count': self.media_count,
+            'total_size': self.total_size,
+            'newest_timestamp': self.newest_timestamp
+        }
+
+
+class MediaTask(db.Model):
+    """Uploaded file waiting for its thumbnail, metadata and media row, or trashed directory waiting for removal, processed by 'flask worker'."""
+    __tablename__ = 'media_tasks'
+    __table_args__ = (
+        db.Index('ix_media_tasks_status_id', 'status', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=False, nullable=False, index=True)
+    path = db.Column(db.String(Config.MAX_STR_LEN), unique=False, nullable=False, index=False)
+    filename = db.Column(db.String(Config.MAX_STR_LEN), unique=False, nullable=False, index=False)
+    is_public = db.Column(db.Boolean, unique=False, nullable=False, index=False, default=False)
+    status = db.Column(db.Integer, unique=False, nullable=False, index=False, default=TaskStatus.PENDING)
+    kind = db.Column(db.Integer, unique=False, nullable=False, index=False, default=TaskKind.IMPORT)
+    progress = db.Column(db.Integer, unique=False, nullable=False, index=False, default=0)
+    uuidname = db.Column(db.String(Config.SHORT_STR_LEN), unique=False, nullable=True, index=False)
+    error = db.Column(db.String(Config.MAX_STR_LEN), unique=False, nullable=True, index=False)
+    timestamp = db.Column(db.DateTime, unique=False, nullable=False, index=False, default=datetime.datetime.utcnow)
+    last_modified = db.Column(db.DateTime, unique=False, nullable=False, index=False, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return '{}: id={}, user_id={}, filename={}, status={}'.format(self.__class__.__name__, self.id, self.user_id, self.filename, self.status)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def to_json(self):
+        json_task = {
+            'id': self.id,
+            'path': self.path,
+            'filename': self.filename,
+            'status': self.status,
+            'kind': self.kind,
+            'progress': self.progress,
+            'uuidname': self.uuidname,
+            'error': self.error,
+            'timestamp': self.timestamp,
+        }
+        return json_task
+
+    @staticmethod
+    def add_task(user_id, pathname, filename, is_public=False):
+        task = MediaTask(user_id=user_id, path=pathname, filename=filename, is_public=is_public)
+        db.session.add(task)
+        try:
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            current_app.logger.error('add_task: {}'.format(str(e)))
+            db.session.rollback()
+            return None
+        return task
+
+    @staticmethod
+    def claim_tasks(limit):
+        # The conditional update makes claiming safe when several workers poll the same table.
+        task_ids = [row.id for row in db.session.query(MediaTask.id).filter(MediaTask.status == TaskStatus.PENDING)
+                    .order_by(MediaTask.id.asc()).limit(limit)]
+        claimed = []
+        for task_id in task_ids:
+            result = MediaTask.query.filter(MediaTask.id == task_id, MediaTask.status == TaskStatus.PENDING) \
+                .update({'status': TaskStatus.RUNNING, 'last_modified': datetime.datetime.utcnow()}, synchronize_session=False)
+            if result:
+                claimed.append(task_id)
+        try:
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            current_app.logger.error('claim_tasks: {}'.format(str(e)))
+            db.session.rollback()
+            return []
+        return claimed
+
+    @staticmethod
+    def recover_tasks(timeout, keep):
+        # Tasks left running by a killed worker are queued again, finished ones are kept for status polling only.
+        now = datetime.datetime.utcnow()
+        MediaTask.query.filter(MediaTask.status == TaskStatus.RUNNING, MediaTask.last_modified < now - datetime.timedelta(seconds=timeout)) \
+            .update({'status': TaskStatus.PENDING}, synchronize_session=False)
+        MediaTask.query.filter(MediaTask.status.in_([TaskStatus.DONE, TaskStatus.FAILED]), MediaTask.last_modified < now - datetime.timedelta(seconds=keep)) \
+            .delete(synchronize_session=False)
+        try:
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            current_app.logger.error('recover_tasks: {}'.format(str(e)))
+            db.session.rollback()
+
+    def _update_progress(self, progress):
+        self.progress = progress
+        try:
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            current_app.logger.error('update_progress: {}'.format(str(e)))
+            db.session.rollback()
+
+    @staticmethod
+    def process_task(task_id):
+        task = db.session.get(MediaTask, task_id)
+        if not task:
+            return None
+        if task.kind == TaskKind.DELETE:
+            try:
+                task.progress = empty_trash(task.filename, task._update_progress)
+                task.status = TaskStatus.DONE
+            except OSError as e:
+                current_app.logger.error('process_task: {}'.format(str(e)))
+                task.status, task.error = TaskStatus.FAILED, str(e)[:Config.MAX_STR_LEN]
+            try:
+                db.session.commit()
+            except exc.SQLAlchemyError as e:
+                current_app.logger.error('process_task: {}'.format(str(e)))
+                db.session.rollback()
+            return task.status
+        full_path_name = os.path.join(current_app.config.get('SYS_MEDIA_ORIGINAL'), task.path, task.filename)
+        try:
+            if not os.path.isfile(full_path_name):
+                raise FileNotFoundError(full_path_name)
+            media = import_user_media(full_path_name, task.is_public, User.query_user_media, User.add_user_media, User.find_user_media)
+            if not media:
+                raise RuntimeError(f'failed to import {full_path_name}')
+            task.status, task.uuidname = TaskStatus.DONE, media.uuidname
+        except Exception as e:
+            current_app.logger.error('process_task: {}'.format(str(e)))
+            db.session.rollback()
+            task.status, task.error = TaskStatus.FAILED, str(e)[:Config.MAX_STR_LEN]
+        try:
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            current_app.logger.error('process_task: {}'.format(str(e)))
+            db.session.rollback()
+        return task.status
+
+    @staticmethod
+    def run_worker(jobs=None, once=False):
+        """Feed pending tasks to a pool of processes until interrupted, or until the queue is drained with once."""
+        jobs = jobs or os.cpu_count() or 1
+        poll_interval = current_app.config.get('TASK_POLL_INTERVAL')
+        MediaTask.recover_tasks(current_app.config.get('TASK_TIMEOUT'), current_app.config.get('TASK_KEEP'))
+        count, futures = 0, set()
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_task_process, initargs=(current_app.config.get('ENV'),)) as executor:
+            while True:
+                task_ids = MediaTask.claim_tasks(2 * jobs - len(futures))
+                futures.update(executor.submit(_run_task, task_id) for task_id in task_ids)
+                if not futures:
+                    if once:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+                done, futures = wait(futures, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task_id, status = future.result()
+                    count += 1
+                    current_app.logger.info(f'worker: task {task_id} {"done" if status == TaskStatus.DONE else "failed"}, {count} processed')
+        return count
+
+
+_task_app = None
+
+
+def _init_task_process(config_name):
+    global _task_app
+    from . import create_app
+    _task_app = create_app(config_name)
+
+
+def _run_task(task_id):
+    with _task_app.app_context():
+        return task_id, MediaTask.process_task(task_id)
+
+
+def _run_sync(full_path_name, is_public):
+    with _task_app.app_context():
+        try:
+            return full_path_name, Media.sync_file(full_path_name, is_public), None
+        except Exception as e:
+            db.session.rollback()
+            return full_path_name, None, str(e)
 
 
 class Resource(db.Model):
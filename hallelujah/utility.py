@@ -2,17 +2,30 @@
 # -*- coding:utf-8 -*-
 
 
+import io
 import os
+import re
 import cv2
+import json
+import uuid
+import base64
+import shutil
+import zipfile
+import struct
+import hashlib
+import binascii
 import bleach
 import datetime
+import mimetypes
 import subprocess
+import urllib.parse
+import numpy as np
 from PIL import Image, ImageOps, ExifTags
-from hachoir.parser import createParser
-from hachoir.metadata import extractMetadata
 from threading import Thread
 from markdown import markdown
-from flask import current_app, request, redirect, url_for, session
+from jinja2 import Environment
+from jinja2.filters import do_striptags, do_truncate
+from flask import current_app, request, redirect, url_for, session, Response, send_file
 from flask_mail import Message
 
 from .extensions import mail
@@ -25,15 +38,306 @@ class MediaType:
     VIDEO = 3
 
 
+class TaskStatus:
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+
+
+class TaskKind:
+    IMPORT = 0
+    DELETE = 1
+
+
 MUSIC_SUFFIXES = ['.mp3', '.wav']
 IMAGE_SUFFIXES = ['.jpg', '.jpeg', '.png', '.gif']
 VIDEO_SUFFIXES = ['.mp4', '.mov', '.m4v']
+MEDIA_PREFIXES = {MediaType.IMAGE: 'IMG_', MediaType.VIDEO: 'VID_'}
+MEDIA_SEQUENCE_SEPARATOR = '-'
 EXIF_TAG_MAP = {ExifTags.TAGS[tag]: tag for tag in ExifTags.TAGS}
+EXIF_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+VARIANT_QUALITY = 80
+VIDEO_POSTER_POSITIONS = (0.1, 0.25, 0.5)
+VIDEO_POSTER_BRIGHTNESS = 24
+MP4_EPOCH_OFFSET = 2082844800
+PLACEHOLDER_SIZE = 16
+PERCEPTUAL_HASH_SIZE = 8
+PERCEPTUAL_HASH_SCALE = 32
+# Deflating these formats gains nothing, they go into archives as stored entries.
+COMPRESSED_SUFFIXES = IMAGE_SUFFIXES + VIDEO_SUFFIXES + ['.mp3']
+# Bump MARKDOWN_RENDER_VERSION whenever the rendered output changes, then run 'flask rerender'.
+MARKDOWN_EXTENSIONS = ['fenced_code', 'admonition', 'tables', 'extra']
+MARKDOWN_RENDER_VERSION = 1
+SUMMARY_LENGTH = 255
+SUMMARY_ENV = Environment()
+WORD_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]|[^\W\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+')
+UPLOAD_PART_SUFFIX = '.part'
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+MAX_BYTE_RANGES = 16
 
 
 def markdown_to_html(text):
-    extensions = ['fenced_code', 'admonition', 'tables', 'extra']
-    return bleach.linkify(markdown(text, extensions=extensions, output_format='html5'))
+    return bleach.linkify(markdown(text, extensions=MARKDOWN_EXTENSIONS, output_format='html5'))
+
+
+def markdown_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def render_markdown(text):
+    html = markdown_to_html(text)
+    plain_text = html_to_text(html)
+    return html, plain_text, text_to_summary(plain_text), count_words(plain_text)
+
+
+def html_to_text(html):
+    return do_striptags(html)
+
+
+def text_to_summary(text, length=SUMMARY_LENGTH):
+    return do_truncate(SUMMARY_ENV, text, length)
+
+
+def count_words(text):
+    # CJK characters are counted one by one since they are not separated by spaces.
+    return len(WORD_PATTERN.findall(text))
+
+
+def encode_cursor(*values):
+    values = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def url_template(endpoint, argument, **kwargs):
+    placeholder = f'__{argument}__'
+    prefix, suffix = url_for(endpoint, **{argument: placeholder}, **kwargs, _external=True).split(placeholder, 1)
+    return lambda value: prefix + urllib.parse.quote(str(value), safe='') + suffix
+
+
+def versioned_url(url, version):
+    return url + ('&' if '?' in url else '?') + urllib.parse.urlencode({'v': version}) if version else url
+
+
+def make_etag(*parts):
+    return hashlib.md5('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def is_not_modified(etag, last_modified=None):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified and request.if_modified_since:
+        return last_modified.replace(tzinfo=datetime.timezone.utc, microsecond=0) <= request.if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified=None, cache_control='private, no-cache'):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def not_modified_response(etag, last_modified=None, cache_control='private, no-cache'):
+    return set_validators(Response(status=304), etag, last_modified, cache_control)
+
+
+def _resolve_ranges(ranges, length):
+    resolved = []
+    for start, stop in ranges:
+        if start < 0:
+            start, stop = max(length + start, 0), length
+        else:
+            stop = min(stop or length, length)
+        if start < stop:
+            resolved.append((start, stop))
+    return resolved
+
+
+def _send_multiple_ranges(full_path_name, mimetype, ranges, length):
+    boundary = uuid.uuid4().hex
+    part_headers = [f'--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n'.encode('ascii')
+                    for start, stop in ranges]
+    closing = f'--{boundary}--\r\n'.encode('ascii')
+    content_length = sum(len(header) + stop - start + 2 for header, (start, stop) in zip(part_headers, ranges)) + len(closing)
+
+    def generate():
+        with open(full_path_name, 'rb') as f:
+            for header, (start, stop) in zip(part_headers, ranges):
+                yield header
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    block = f.read(min(UPLOAD_BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    yield block
+                yield b'\r\n'
+        yield closing
+
+    response = Response(generate(), status=206, mimetype=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
+    response.content_length = content_length
+    response.accept_ranges = 'bytes'
+    return response
+
+
+def send_media_file(full_path_name, download_name, etag, as_attachment=False, cache_control='private, no-cache'):
+    """Send a file under SYS_MEDIA with the configured delivery mode.
+
+    'python' streams from the worker and answers single and multiple byte ranges, 'x-accel' and 'x-sendfile'
+    only hand the file over to nginx or apache, which then serve the bytes and the ranges themselves.
+    """
+    delivery = current_app.config.get('SYS_MEDIA_DELIVERY')
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    if delivery in ('x-accel', 'x-sendfile'):
+        response = Response(mimetype=mimetype)
+        if delivery == 'x-accel':
+            relative_name = os.path.relpath(full_path_name, current_app.config.get('SYS_MEDIA'))
+            response.headers['X-Accel-Redirect'] = current_app.config.get('SYS_MEDIA_ACCEL_PREFIX') + '/' + urllib.parse.quote(relative_name)
+        else:
+            response.headers['X-Sendfile'] = full_path_name
+        response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline', filename=download_name)
+        return set_validators(response, etag, cache_control=cache_control)
+    # Werkzeug answers a single range itself, multipart/byteranges responses are built here.
+    if request.range and len(request.range.ranges) > 1 and (not request.headers.get('If-Range') or request.if_range.etag == etag):
+        length = os.path.getsize(full_path_name)
+        ranges = _resolve_ranges(request.range.ranges, length)
+        if not ranges:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{length}'
+            return response
+        if len(ranges) <= MAX_BYTE_RANGES:
+            return set_validators(_send_multiple_ranges(full_path_name, mimetype, ranges, length), etag, cache_control=cache_control)
+        # Too many ranges are ignored as the RFC allows, the whole file is sent instead.
+        response = send_file(full_path_name, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name, conditional=False)
+        return set_validators(response, etag, cache_control=cache_control)
+    response = send_file(full_path_name, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name, etag=etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def send_media_bundle(entries, etag, cache_control='private, no-cache'):
+    """Send several small media files in one response, entries being (name, full path name or None) pairs.
+
+    The body is a big-endian uint32 length, a JSON array of [name, mimetype, size] in the order of entries,
+    then the files back to back. Unreadable files are listed with a size of 0 and take no bytes in the body.
+    """
+    header, files = [], []
+    for name, full_path_name in entries:
+        try:
+            size = os.path.getsize(full_path_name) if full_path_name else 0
+        except OSError:
+            size = 0
+        header.append([name, mimetypes.guess_type(name)[0] or 'application/octet-stream', size])
+        if size:
+            files.append((full_path_name, size))
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header = struct.pack('>I', len(header)) + header
+
+    def generate():
+        yield header
+        for full_path_name, size in files:
+            # The sizes are already announced, a file changed since keeps its slot so that the next ones stay aligned.
+            try:
+                with open(full_path_name, 'rb') as f:
+                    data = f.read(size)
+            except OSError:
+                data = b''
+            yield data.ljust(size, b'\0')
+
+    response = Response(generate(), mimetype='application/octet-stream', direct_passthrough=True)
+    response.content_length = len(header) + sum(size for _, size in files)
+    return set_validators(response, etag, cache_control=cache_control)
+
+
+class _ArchiveBuffer(io.RawIOBase):
+    """Unseekable sink of a ZipFile, the bytes written are handed over and dropped by drain()."""
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+
+def iter_zip(entries, block_size=UPLOAD_BLOCK_SIZE):
+    """Yield a ZIP archive of entries, (full path name, name in the archive, timestamp) tuples, as it is built.
+
+    Nothing is seeked back, sizes and CRCs follow each entry in a data descriptor, so at most one block
+    of a file is held at a time. Missing files are skipped.
+    """
+    buffer = _ArchiveBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for full_path_name, arcname, timestamp in entries:
+            try:
+                f = open(full_path_name, 'rb')
+            except OSError:
+                continue
+            with f:
+                # ZIP dates start in 1980.
+                info = zipfile.ZipInfo(arcname, date_time=max(timestamp or datetime.datetime.now(), datetime.datetime(1980, 1, 1)).timetuple()[:6])
+                info.external_attr = 0o644 << 16
+                info.compress_type = zipfile.ZIP_STORED if os.path.splitext(arcname)[1].lower() in COMPRESSED_SUFFIXES else zipfile.ZIP_DEFLATED
+                with archive.open(info, 'w', force_zip64=os.fstat(f.fileno()).st_size >= zipfile.ZIP64_LIMIT) as entry:
+                    while True:
+                        block = f.read(block_size)
+                        if not block:
+                            break
+                        entry.write(block)
+                        yield buffer.drain()
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def send_zip(entries, download_name):
+    response = Response((data for data in iter_zip(entries) if data), mimetype='application/zip', direct_passthrough=True)
+    response.headers['Content-Disposition'] = 'attachment; filename*=UTF-8\'\'{}'.format(urllib.parse.quote(download_name))
+    response.headers['Cache-Control'] = 'private, no-store'
+    # Keep nginx from buffering the archive, the client gets the first bytes at once.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def get_upload_part_name(full_path, nonce):
+    return os.path.join(full_path, f'.{nonce}{UPLOAD_PART_SUFFIX}')
+
+
+def is_upload_part(filename):
+    return filename.startswith('.') and filename.endswith(UPLOAD_PART_SUFFIX)
+
+
+def write_upload_chunk(part_name, stream, offset, size):
+    # Copy the chunk block by block so memory stays constant whatever the chunk size is.
+    with open(part_name, 'r+b') as f:
+        f.seek(offset)
+        while True:
+            block = stream.read(UPLOAD_BLOCK_SIZE)
+            if not block:
+                break
+            if f.tell() + len(block) > size:
+                return None
+            f.write(block)
+        f.flush()
+        return os.fstat(f.fileno()).st_size
 
 
 def get_request_ip(request):
@@ -178,16 +482,6 @@ def send_email(to, subject, msg):
     thread.start()
     return thread
 
-def browse_directory(current_path):
-    dirs = []
-    if not os.path.isdir(current_path):
-        return dirs
-    for file in os.listdir(current_path):
-        if os.path.isdir(os.path.join(current_path, file)):
-            dirs.append(file)
-    dirs.sort()
-    return dirs
-
 def _rotate_image_by_orientation(image):
     try:
         exif_info = image._getexif()
@@ -243,146 +537,431 @@ def _parse_exif_timestamp(timestamp_string):
         timestamp = None
     return timestamp
 
-def _get_image_timestamp(image_file):
-    image = Image.open(image_file)
-    exif_info = image._getexif()
-    image.close()
-    image_timestamp = None
-    if exif_info:
-        if EXIF_TAG_MAP['DateTimeOriginal'] in exif_info:
-            image_timestamp = _parse_exif_timestamp(exif_info[EXIF_TAG_MAP['DateTimeOriginal']])
-        elif EXIF_TAG_MAP['DateTimeDigitized'] in exif_info:
-            image_timestamp = _parse_exif_timestamp(exif_info[EXIF_TAG_MAP['DateTimeDigitized']])
-        elif EXIF_TAG_MAP['DateTime'] in exif_info:
-            image_timestamp = _parse_exif_timestamp(exif_info[EXIF_TAG_MAP['DateTime']])
-    if not image_timestamp:
-        image_timestamp = get_file_ctime(image_file)
-    return image_timestamp
-
-def _is_file_exist(cur_filename, query_func):
-    pathname = os.path.dirname(_get_relative_name(cur_filename))
-    filename = os.path.basename(cur_filename)
-    username = pathname.split(os.sep)[0]
-    return query_func(username, pathname, filename)
-
-def _get_solid_filename(cur_filename, query_func):
-    while _is_file_exist(cur_filename, query_func):
-        file_path = os.path.dirname(cur_filename)
-        file_name, file_ext = os.path.splitext(os.path.basename(cur_filename))
-        prefix_str, dt_str = file_name.split('_', 1)
-        cur_dt = datetime.datetime.strptime(dt_str, '%Y%m%d_%H%M%S')
-        next_dt = cur_dt + datetime.timedelta(seconds=1)
-        file_basename = prefix_str + '_' +  next_dt.strftime('%Y%m%d_%H%M%S') + file_ext
-        cur_filename = os.path.join(file_path, file_basename)
-    return cur_filename
-
-def _create_image_thumbnail(image_file, thumbnail_dirname, height, query_func):
-    image_timestamp = _get_image_timestamp(image_file)
-    new_filename = 'IMG_' + datetime.datetime.fromtimestamp(image_timestamp).strftime('%Y%m%d_%H%M%S') + os.path.splitext(image_file)[1]
-    new_file = os.path.join(os.path.dirname(image_file), new_filename)
-    new_file = _get_solid_filename(new_file, query_func)
-    if image_file != new_file:
-        os.rename(image_file, new_file)
-        new_filename = os.path.basename(new_file)
-
-    image = Image.open(new_file)
-    image = ImageOps.exif_transpose(image)
-    ### PIL.Image.rotate is not good enough to be applyed!
-    # image = _rotate_image_by_orientation(image)
-    image_size = image.size
-
-    thumbnail_file = os.path.join(thumbnail_dirname, new_filename)
-    if not os.path.isfile(thumbnail_file):
+def _get_exif_timestamp(exif):
+    exif_ifd = exif.get_ifd(EXIF_TAG_MAP['ExifOffset'])
+    for tags, tag in ((exif_ifd, 'DateTimeOriginal'), (exif_ifd, 'DateTimeDigitized'), (exif, 'DateTime')):
+        if EXIF_TAG_MAP[tag] in tags:
+            return _parse_exif_timestamp(tags[EXIF_TAG_MAP[tag]])
+    return None
+
+def split_media_sequence(stem):
+    """Split 'IMG_20240101_120000-3' into ('IMG_20240101_120000', 3), a stem without sequence has sequence 0."""
+    base, separator, sequence = stem.rpartition(MEDIA_SEQUENCE_SEPARATOR)
+    if separator and sequence.isdigit():
+        return base, int(sequence)
+    return stem, 0
+
+def _claim_media_filename(media_fullname, stem, file_ext, taken_stems):
+    # The next sequence after the highest one recorded is computed once, instead of probing names one at a time.
+    # The claim itself is a hardlink which never replaces an existing file, so concurrent importers can not
+    # clobber each other nor a file not imported yet: on a clash the next sequence is tried.
+    sequences = [sequence for base, sequence in map(split_media_sequence, taken_stems) if base == stem]
+    sequence = max(sequences) + 1 if sequences else 0
+    dirname = os.path.dirname(media_fullname)
+    while True:
+        new_stem = f'{stem}{MEDIA_SEQUENCE_SEPARATOR}{sequence}' if sequence else stem
+        new_fullname = os.path.join(dirname, new_stem + file_ext)
+        if new_fullname == media_fullname:
+            return media_fullname
+        try:
+            os.link(media_fullname, new_fullname)
+        except FileExistsError:
+            sequence += 1
+            continue
+        os.remove(media_fullname)
+        return new_fullname
+
+def get_placeholder(pixels):
+    """Returns the placeholder columns of a decoded RGB thumbnail: a tiny PNG data URI and the dominant color.
+
+    Both are vectorized over the pixel array: tiles are averaged with reduceat, colors counted on a 4 bit per channel histogram.
+    """
+    height, width = pixels.shape[:2]
+    scale = min(1.0, PLACEHOLDER_SIZE / max(height, width))
+    tile_rows = np.linspace(0, height, max(1, round(height * scale)), endpoint=False).astype(np.intp)
+    tile_cols = np.linspace(0, width, max(1, round(width * scale)), endpoint=False).astype(np.intp)
+    sums = np.add.reduceat(np.add.reduceat(pixels.astype(np.uint32), tile_rows, axis=0), tile_cols, axis=1)
+    areas = np.outer(np.diff(tile_rows, append=height), np.diff(tile_cols, append=width))[..., np.newaxis]
+    tiny = Image.fromarray(np.rint(sums / areas).astype(np.uint8))
+    with io.BytesIO() as buffer:
+        tiny.save(buffer, 'PNG', optimize=True)
+        placeholder = 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+    quantized = (pixels >> 4).astype(np.uint16).reshape(-1, 3)
+    keys = (quantized[:, 0] << 8) | (quantized[:, 1] << 4) | quantized[:, 2]
+    dominant = np.rint(pixels.reshape(-1, 3)[keys == np.bincount(keys).argmax()].mean(axis=0)).astype(int)
+    return {'placeholder': placeholder, 'dominant_color': '#{:02x}{:02x}{:02x}'.format(*dominant)}
+
+def get_perceptual_hash(pixels):
+    """Returns the 64 bit DCT hash of a decoded RGB thumbnail, as the signed integer a BIGINT column holds.
+
+    Each bit tells whether one of the 8x8 lowest frequencies of a 32x32 grayscale reduction is above their median,
+    so resized, re-encoded or slightly retouched copies of a picture keep most of its bits.
+    """
+    gray = cv2.cvtColor(np.ascontiguousarray(pixels), cv2.COLOR_RGB2GRAY)
+    frequencies = cv2.dct(cv2.resize(gray, (PERCEPTUAL_HASH_SCALE, PERCEPTUAL_HASH_SCALE), interpolation=cv2.INTER_AREA).astype(np.float32))
+    frequencies = frequencies[:PERCEPTUAL_HASH_SIZE, :PERCEPTUAL_HASH_SIZE].ravel()
+    # The DC term is the mean brightness, it is left out of the median.
+    return int(np.packbits(frequencies > np.median(frequencies[1:])).view('>i8')[0])
+
+def get_thumbnail_info(pixels):
+    """Returns the columns computed from a decoded RGB thumbnail: placeholder, dominant color and perceptual hash."""
+    return dict(get_placeholder(pixels), perceptual_hash=get_perceptual_hash(pixels))
+
+def read_thumbnail_info(thumbnail_file):
+    try:
+        with Image.open(thumbnail_file) as image:
+            return get_thumbnail_info(np.asarray(image.convert('RGB')))
+    except (OSError, ValueError):
+        return None
+
+def _popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # NumPy before 2.0 has no popcount, the SWAR reduction does the same on uint64 arrays.
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (values * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+class PerceptualHashIndex:
+    """Perceptual hashes packed in a uint64 array, searched by Hamming distance.
+
+    Distances are the popcount of XORed hashes, computed for a block of rows against the whole array at once.
+    Blocks are sized so that each distance matrix stays around block_size entries.
+    """
+    def __init__(self, ids, hashes, block_size=1 << 22):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.hashes = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+        self.block_size = block_size
+
+    def search(self, value, max_distance):
+        """Returns the (id, distance) within max_distance of the hash value, nearest first."""
+        distances = _popcount(self.hashes ^ np.array(value, dtype=np.int64).view(np.uint64))
+        found = np.nonzero(distances <= max_distance)[0]
+        found = found[np.argsort(distances[found], kind='stable')]
+        return list(zip(self.ids[found].tolist(), distances[found].tolist()))
+
+    def pairs(self, max_distance):
+        """Returns every (id, id, distance) pair within max_distance, each pair once."""
+        count = len(self.hashes)
+        rows = max(1, self.block_size // max(count, 1))
+        pairs = []
+        for start in range(0, count, rows):
+            block = self.hashes[start:start + rows]
+            # Only the columns after the first row of the block, the lower triangle is dropped below.
+            distances = _popcount(block[:, np.newaxis] ^ self.hashes[np.newaxis, start:])
+            found_rows, found_cols = np.nonzero(distances <= max_distance)
+            upper = found_cols > found_rows
+            found_rows, found_cols = found_rows[upper], found_cols[upper]
+            pairs.extend(zip(self.ids[found_rows + start].tolist(), self.ids[found_cols + start].tolist(),
+                             distances[found_rows, found_cols].tolist()))
+        return pairs
+
+def _save_image_thumbnail(image_file, thumbnail_file, height):
+    # EXIF, dimensions and pixels come from a single open, and JPEG originals are decoded at the
+    # smallest DCT scale still larger than the thumbnail, so a 48MP photo is never fully decoded.
+    with Image.open(image_file) as image:
+        exif = image.getexif()
+        image_timestamp = _get_exif_timestamp(exif) or get_file_ctime(image_file)
+        transposed = exif.get(EXIF_TAG_MAP['Orientation']) in EXIF_TRANSPOSED_ORIENTATIONS
+        image_size = image.size[::-1] if transposed else image.size
         thumbnail_size = get_thumbnail_size(image_size, height)
-        if thumbnail_size != image_size:
-            image = image.resize(thumbnail_size, Image.Resampling.LANCZOS)
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        image.save(thumbnail_file)
-
-    image.close()
-    return (image_size, MediaType.IMAGE, image_timestamp, new_filename)
-
-def _get_video_timestamp(video_file):
-    file_ctime = get_file_ctime(video_file)
-    parser = createParser(video_file)
-    if not parser:
-        return file_ctime
-
+        image.draft('RGB', thumbnail_size[::-1] if transposed else thumbnail_size)
+        ### PIL.Image.rotate is not good enough to be applyed!
+        # image = _rotate_image_by_orientation(image)
+        thumbnail = ImageOps.exif_transpose(image)
+        if thumbnail.size != thumbnail_size:
+            thumbnail = thumbnail.resize(thumbnail_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if thumbnail.mode != 'RGB':
+            thumbnail = thumbnail.convert('RGB')
+        thumbnail.save(thumbnail_file)
+    return image_size, image_timestamp, get_thumbnail_info(np.asarray(thumbnail))
+
+def save_image_variant(image_file, variant_file, width, image_format='JPEG'):
+    with Image.open(image_file) as image:
+        transposed = image.getexif().get(EXIF_TAG_MAP['Orientation']) in EXIF_TRANSPOSED_ORIENTATIONS
+        image_size = image.size[::-1] if transposed else image.size
+        width = min(width, image_size[0])
+        variant_size = (width, max(1, round(image_size[1] * float(width) / image_size[0])))
+        image.draft('RGB', variant_size[::-1] if transposed else variant_size)
+        variant = ImageOps.exif_transpose(image)
+        if variant.size != variant_size:
+            variant = variant.resize(variant_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if variant.mode != 'RGB':
+            variant = variant.convert('RGB')
+        variant.save(variant_file, format=image_format, quality=VARIANT_QUALITY)
+
+def get_variant_width(width, widths):
+    # Requested widths are snapped up to the ladder so that only a bounded set of variants is ever generated.
+    for variant_width in sorted(widths):
+        if variant_width >= width:
+            return variant_width
+    return max(widths)
+
+def _find_mp4_box(f, start, end, box_type):
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        size, kind = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1:
+            size, header_size = struct.unpack('>Q', f.read(8))[0], 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            return None
+        if kind == box_type:
+            return position + header_size, position + size
+        position += size
+    return None
+
+def _read_mp4_movie_header(video_file):
+    """Return (creation timestamp, duration in seconds) from the moov/mvhd box of a mp4/mov file.
+
+    Only box headers are read, the media data is skipped with a seek however large it is.
+    """
     try:
-        metadata = extractMetadata(parser)
-    except Exception as error:
-        metadata = None
-    if not metadata:
-        return file_ctime
-
-    for line in metadata.exportPlaintext():
-        datetime_caption, datetime_str = line.split(':', 1)
-        if datetime_caption == '- Creation date':
-            datetime_str = datetime_str.strip()
-            timestamp = datetime.datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S').timestamp()
-            return timestamp
-    return file_ctime
+        with open(video_file, 'rb') as f:
+            moov = _find_mp4_box(f, 0, os.fstat(f.fileno()).st_size, b'moov')
+            mvhd = moov and _find_mp4_box(f, *moov, b'mvhd')
+            if not mvhd:
+                return None, None
+            f.seek(mvhd[0])
+            version = f.read(4)[0]
+            if version == 1:
+                creation_time, _, timescale, duration = struct.unpack('>QQIQ', f.read(28))
+            else:
+                creation_time, _, timescale, duration = struct.unpack('>IIII', f.read(16))
+    except (OSError, struct.error, IndexError):
+        return None, None
+    timestamp = creation_time - MP4_EPOCH_OFFSET if creation_time > MP4_EPOCH_OFFSET else None
+    return timestamp, (duration / timescale if timescale else None)
 
 def _get_video_thumbnail_filename(original_filename):
     prefix, ext = os.path.splitext(original_filename)
     return prefix + IMAGE_SUFFIXES[0]
 
 
-def _create_video_thumbnail(video_file, thumbnail_dirname, height, query_func):
+def _read_poster_frame(video_capture, duration):
+    # The first frame is often black, so seek to a few positions and keep the first bright enough frame.
+    best = None
+    for position in (VIDEO_POSTER_POSITIONS if duration else (0, )):
+        video_capture.set(cv2.CAP_PROP_POS_MSEC, duration * position * 1000 if duration else 0)
+        success, frame = video_capture.read()
+        if not success:
+            continue
+        brightness = frame[::8, ::8].mean()
+        if best is None or brightness > best[0]:
+            best = (brightness, frame)
+        if brightness >= VIDEO_POSTER_BRIGHTNESS:
+            break
+    return best[1] if best else None
+
+def _get_fourcc(video_capture):
+    fourcc = int(video_capture.get(cv2.CAP_PROP_FOURCC))
+    return ''.join(chr((fourcc >> 8 * index) & 0xFF) for index in range(4)).strip('\x00 ') or None
+
+def _save_video_thumbnail(video_file, thumbnail_file, height):
+    timestamp, duration = _read_mp4_movie_header(video_file)
     video_capture = cv2.VideoCapture(video_file)
-    _, image = video_capture.read()
+    try:
+        if not duration:
+            fps = video_capture.get(cv2.CAP_PROP_FPS)
+            duration = video_capture.get(cv2.CAP_PROP_FRAME_COUNT) / fps if fps else None
+        codec = _get_fourcc(video_capture)
+        # Frames come out already rotated by the container orientation, so their shape is the displayed size.
+        image = _read_poster_frame(video_capture, duration)
+    finally:
+        video_capture.release()
+    if image is None:
+        raise ValueError(f'no frame decoded from {video_file}')
     video_size = (image.shape[1], image.shape[0])
-    video_timestamp = _get_video_timestamp(video_file)
-    new_filename = 'VID_' + datetime.datetime.fromtimestamp(video_timestamp).strftime('%Y%m%d_%H%M%S') + os.path.splitext(video_file)[1]
-    new_file = os.path.join(os.path.dirname(video_file), new_filename)
-    new_file = _get_solid_filename(new_file, query_func)
-    if video_file != new_file:
-        os.rename(video_file, new_file)
-        new_filename = os.path.basename(new_file)
-
-    thumbnail_filename = _get_video_thumbnail_filename(new_filename)
-    thumbnail_file = os.path.join(thumbnail_dirname, thumbnail_filename)
-    if not os.path.isfile(thumbnail_file):
-        width = round(image.shape[1] * float(height) / image.shape[0])
-        thumbnail_image = cv2.resize(image, (width, height))
-        cv2.imwrite(thumbnail_file, thumbnail_image)
-    return (video_size, MediaType.VIDEO, video_timestamp, new_filename)
-
-def _create_thumbnail(media_fullname, thumbnail_dirname, height, query_func):
+
+    width = round(image.shape[1] * float(height) / image.shape[0])
+    thumbnail_image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    cv2.imwrite(thumbnail_file, thumbnail_image)
+    video_info = dict(get_thumbnail_info(cv2.cvtColor(thumbnail_image, cv2.COLOR_BGR2RGB)), duration=duration, codec=codec)
+    return video_size, timestamp or get_file_ctime(video_file), video_info
+
+def _get_temporary_filename(filename):
+    # The suffix is kept so that PIL and OpenCV still pick the encoder from the filename.
+    dirname, basename = os.path.split(filename)
+    prefix, ext = os.path.splitext(basename)
+    return os.path.join(dirname, f'.{prefix}.tmp{ext}')
+
+def probe_media(media_fullname, thumbnail_fullname, height):
+    """Read the metadata of a media file and write its thumbnail to a temporary file beside thumbnail_fullname.
+
+    Neither the database nor the application context is used, so media can be probed on a process pool.
+    Returns ((width, height), media_type, timestamp, temporary thumbnail filename or None, extra media columns).
+    """
     file_ext = os.path.splitext(media_fullname)[1]
+    media_info = {'content_hash': hash_file(media_fullname), 'file_size': os.path.getsize(media_fullname)}
     if file_ext in IMAGE_SUFFIXES:
-        meta_data = _create_image_thumbnail(media_fullname, thumbnail_dirname, height, query_func)
+        temporary_thumbnail = _get_temporary_filename(thumbnail_fullname)
+        image_size, image_timestamp, image_info = _save_image_thumbnail(media_fullname, temporary_thumbnail, height)
+        return (image_size, MediaType.IMAGE, image_timestamp, temporary_thumbnail, dict(media_info, **image_info))
     elif file_ext in VIDEO_SUFFIXES:
-        meta_data = _create_video_thumbnail(media_fullname, thumbnail_dirname, height, query_func)
+        temporary_thumbnail = _get_temporary_filename(_get_video_thumbnail_filename(thumbnail_fullname))
+        video_size, video_timestamp, video_info = _save_video_thumbnail(media_fullname, temporary_thumbnail, height)
+        return (video_size, MediaType.VIDEO, video_timestamp, temporary_thumbnail, dict(media_info, **video_info))
     elif file_ext in MUSIC_SUFFIXES:
-        meta_data = ((None, None), MediaType.MUSIC, get_file_ctime(media_fullname), os.path.basename(media_fullname))
+        return ((None, None), MediaType.MUSIC, get_file_ctime(media_fullname), None, media_info)
     else:
-        meta_data = ((None, None), MediaType.OTHER, get_file_ctime(media_fullname), os.path.basename(media_fullname))
-    return meta_data
+        return ((None, None), MediaType.OTHER, get_file_ctime(media_fullname), None, media_info)
+
+def save_thumbnail(media_fullname, thumbnail_fullname, height):
+    """Write the thumbnail of a recorded media in place and return its filename, or None for media without one.
 
-def _get_relative_name(media_fullname):
+    Unlike probe_media the original is only decoded, never hashed.
+    """
+    file_ext = os.path.splitext(media_fullname)[1]
+    if file_ext in IMAGE_SUFFIXES:
+        save_func = _save_image_thumbnail
+    elif file_ext in VIDEO_SUFFIXES:
+        save_func, thumbnail_fullname = _save_video_thumbnail, _get_video_thumbnail_filename(thumbnail_fullname)
+    else:
+        return None
+    temporary_thumbnail = _get_temporary_filename(thumbnail_fullname)
+    try:
+        save_func(media_fullname, temporary_thumbnail, height)
+        os.replace(temporary_thumbnail, thumbnail_fullname)
+    finally:
+        if os.path.isfile(temporary_thumbnail):
+            os.remove(temporary_thumbnail)
+    return thumbnail_fullname
+
+def discard_media(media_fullname, metadata):
+    temporary_thumbnail = metadata[3]
+    os.remove(media_fullname)
+    if temporary_thumbnail and os.path.isfile(temporary_thumbnail):
+        os.remove(temporary_thumbnail)
+
+def hash_file(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(UPLOAD_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _link_file(source_file, target_file):
+    if not source_file or not target_file or not os.path.isfile(source_file) or not os.path.isfile(target_file):
+        return 0
+    if os.path.samefile(source_file, target_file):
+        return 0
+    size = os.path.getsize(target_file)
+    temporary_file = _get_temporary_filename(target_file)
+    try:
+        os.link(source_file, temporary_file)
+        os.replace(temporary_file, target_file)
+    except OSError:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        return 0
+    return size
+
+def break_link(filename):
+    """Give filename an inode of its own, the other hardlinks to its content keep the current one."""
+    temporary_file = _get_temporary_filename(filename)
+    try:
+        shutil.copy2(filename, temporary_file)
+        os.replace(temporary_file, filename)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+def link_media(source_files, target_files):
+    """Replace the original and thumbnail of a media by hardlinks to those of an identical one, returns the bytes reclaimed.
+
+    The inode link count then acts as the reference count: deleting either media only unlinks its own names.
+    """
+    return sum(_link_file(source_file, target_file) for source_file, target_file in zip(source_files, target_files))
+
+def place_media(media_fullname, thumbnail_dirname, metadata, query_func):
+    """Rename a probed media after its timestamp and move its thumbnail in place, returns the new filename.
+
+    query_func(pathname, stem) returns the stems already recorded in pathname which start with stem,
+    media taken within the same second get an increasing sequence suffix.
+    """
+    _, media_type, media_timestamp, temporary_thumbnail, _ = metadata
+    if media_type in MEDIA_PREFIXES:
+        stem = MEDIA_PREFIXES[media_type] + datetime.datetime.fromtimestamp(media_timestamp).strftime('%Y%m%d_%H%M%S')
+        pathname = os.path.dirname(get_relative_name(media_fullname))
+        taken_stems = query_func(pathname, stem)
+        media_fullname = _claim_media_filename(media_fullname, stem, os.path.splitext(media_fullname)[1], taken_stems)
+    new_filename = os.path.basename(media_fullname)
+    if temporary_thumbnail:
+        thumbnail_filename = new_filename if media_type == MediaType.IMAGE else _get_video_thumbnail_filename(new_filename)
+        os.replace(temporary_thumbnail, os.path.join(thumbnail_dirname, thumbnail_filename))
+    return new_filename
+
+def normalize_media_ext(media_fullname):
+    prefix, ext = os.path.splitext(media_fullname)
+    target_ext = ext.lower()
+    if ext != target_ext:
+        media_old_name, media_fullname = media_fullname, prefix + target_ext
+        os.rename(media_old_name, media_fullname)
+    return media_fullname
+
+def get_relative_name(media_fullname):
     original_path = current_app.config.get('SYS_MEDIA_ORIGINAL')
     media_relative_name = media_fullname[len(original_path)+1:]
     return media_relative_name
 
-def _get_thumbnail_name(media_fullname):
+def get_thumbnail_name(media_fullname):
     thumbnail_path = current_app.config.get('SYS_MEDIA_THUMBNAIL')
-    media_relative_name = _get_relative_name(media_fullname)
+    media_relative_name = get_relative_name(media_fullname)
     thumbnail_full_name = os.path.join(thumbnail_path, media_relative_name)
     return thumbnail_full_name
 
+def get_thumbnail_filename(filename, media_type):
+    if media_type == MediaType.IMAGE:
+        return filename
+    elif media_type == MediaType.VIDEO:
+        return _get_video_thumbnail_filename(filename)
+    return None
+
+def trash_media_directory(pathname, trash_name):
+    """Move the original and thumbnail directories of pathname into the trash, returns the (source, target) moves.
+
+    A rename is constant time whatever the directory holds, the files are unlinked later by the media worker.
+    """
+    moves = []
+    trash_path = os.path.join(current_app.config.get('SYS_MEDIA_TRASH'), trash_name)
+    for name, base_path in (('original', current_app.config.get('SYS_MEDIA_ORIGINAL')), ('thumbnail', current_app.config.get('SYS_MEDIA_THUMBNAIL'))):
+        source = os.path.join(base_path, pathname)
+        if os.path.isdir(source):
+            os.makedirs(trash_path, mode=0o750, exist_ok=True)
+            os.rename(source, os.path.join(trash_path, name))
+            moves.append((source, os.path.join(trash_path, name)))
+    return moves
+
+def restore_media_directory(moves):
+    for source, target in reversed(moves):
+        os.rename(target, source)
+
+def empty_trash(trash_name, progress_func=None, interval=500):
+    """Remove a trashed directory file by file, progress_func(count) is called every interval files, returns the count."""
+    trash_path = os.path.join(current_app.config.get('SYS_MEDIA_TRASH'), trash_name)
+    count = 0
+    for root, dirs, files in os.walk(trash_path, topdown=False):
+        for name in files:
+            os.remove(os.path.join(root, name))
+            count += 1
+            if progress_func and count % interval == 0:
+                progress_func(count)
+        for name in dirs:
+            os.rmdir(os.path.join(root, name))
+    if os.path.isdir(trash_path):
+        os.rmdir(trash_path)
+    return count
+
 def get_media_files(pathname, filename, media_type):
     original_base_path = current_app.config.get('SYS_MEDIA_ORIGINAL')
     thumbnail_base_path = current_app.config.get('SYS_MEDIA_THUMBNAIL')
     original_media = os.path.join(original_base_path, pathname, filename)
-    if media_type == MediaType.IMAGE:
-        thumbnail_media = os.path.join(thumbnail_base_path, pathname, filename)
-    elif media_type == MediaType.VIDEO:
-        thumbnail_filename = _get_video_thumbnail_filename(filename)
-        thumbnail_media = os.path.join(thumbnail_base_path, pathname, thumbnail_filename)
-    else:
-        thumbnail_media = None
+    thumbnail_filename = get_thumbnail_filename(filename, media_type)
+    thumbnail_media = os.path.join(thumbnail_base_path, pathname, thumbnail_filename) if thumbnail_filename else None
     return original_media, thumbnail_media
 
 def _verify_media_integrity(added_media, pathname, filename, media_type):
@@ -399,32 +978,26 @@ def _verify_media_integrity(added_media, pathname, filename, media_type):
             current_app.logger.error('verify media integrity: remove media {}'.format(added_media.uuidname))
     return added_media
 
-def import_user_media(media_fullname, is_public, user_query_media_func, user_add_media_func):
-    prefix, ext = os.path.splitext(media_fullname)
-    target_ext = ext.lower()
-    if ext != target_ext:
-        media_old_name, media_fullname = media_fullname, prefix + target_ext
-        os.rename(media_old_name, media_fullname)
-    thumbnail_dirname = os.path.dirname(_get_thumbnail_name(media_fullname))
-    relative_path = os.path.dirname(_get_relative_name(media_fullname))
+def import_user_media(media_fullname, is_public, user_query_media_func, user_add_media_func, user_find_media_func=None):
+    media_fullname = normalize_media_ext(media_fullname)
+    thumbnail_fullname = get_thumbnail_name(media_fullname)
+    thumbnail_dirname = os.path.dirname(thumbnail_fullname)
+    relative_path = os.path.dirname(get_relative_name(media_fullname))
     username = relative_path.split(os.sep)[0]
     os.makedirs(thumbnail_dirname, mode=0o750, exist_ok=True)
-    metadata = _create_thumbnail(media_fullname, thumbnail_dirname, current_app.config.get('SYS_MEDIA_THUMBNAIL_HEIGHT'), user_query_media_func)
-    (width, height), media_type, media_datetime, media_filename = metadata
+    metadata = probe_media(media_fullname, thumbnail_fullname, current_app.config.get('SYS_MEDIA_THUMBNAIL_HEIGHT'))
+    (width, height), media_type, media_datetime, _, media_info = metadata
+    duplicate = user_find_media_func(username, media_info['content_hash']) if user_find_media_func else None
+    if duplicate and duplicate.path == relative_path and os.path.isfile(get_media_files(duplicate.path, duplicate.filename, duplicate.media_type)[0]):
+        discard_media(media_fullname, metadata)
+        return duplicate
+    media_filename = place_media(media_fullname, thumbnail_dirname, metadata, user_query_media_func)
+    if duplicate:
+        link_media(get_media_files(duplicate.path, duplicate.filename, duplicate.media_type),
+                   get_media_files(relative_path, media_filename, media_type))
     timestamp = datetime.datetime.fromtimestamp(media_datetime)
-    added_media = user_add_media_func(username, relative_path, media_filename, timestamp,
-                                      width=width, height=height, media_type=media_type, is_public=is_public)
+    # Stat the placed name, a linked duplicate carries the mtime of the copy it now shares.
+    file_mtime = os.stat(get_media_files(relative_path, media_filename, media_type)[0]).st_mtime_ns
+    added_media = user_add_media_func(username, relative_path, media_filename, timestamp, width=width, height=height,
+                                      media_type=media_type, is_public=is_public, file_mtime=file_mtime, **media_info)
     return _verify_media_integrity(added_media, relative_path, media_filename, media_type)
-
-def import_user_medias(username, user_query_media_func, user_add_media_func):
-    original_path = current_app.config.get('SYS_MEDIA_ORIGINAL')
-
-    cur_path = os.path.join(original_path, username)
-    if not os.path.exists(cur_path):
-        os.makedirs(cur_path, mode=0o750, exist_ok=True)
-        return
-
-    for root, _, files in os.walk(cur_path, topdown=False):
-        for filename in files:
-            import_user_media(os.path.join(root, filename), False, user_query_media_func, user_add_media_func)
-
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+
+from .models import User, MediaFolder, _init_task_process, _run_sync
+from .utility import get_relative_name
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+EVENT_BUFFER_SIZE = 64 * 1024
+
+
+class Inotify:
+    """Minimal inotify binding over ctypes, Linux only."""
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available on this platform')
+        self._libc = libc
+        self.fd = self._check(libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    @staticmethod
+    def _check(result, path=None):
+        if result < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return result
+
+    def add_watch(self, path, mask):
+        return self._check(self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask)), path)
+
+    def rm_watch(self, wd):
+        # The kernel drops the watch of a removed directory by itself, it may already be gone.
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Returns the (wd, mask, name) events available within timeout seconds."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            events.append((wd, mask, os.fsdecode(data[offset:offset + length].rstrip(b'\0'))))
+            offset += length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MediaWatcher:
+    """Watch the original media tree and import the files written into it by hand once they are stable.
+
+    Only directories are walked, when they are first watched; afterwards every file is reached through its
+    own events. A file is stable when neither an event nor its size and mtime changed for settle seconds.
+    Hidden names, such as rsync and upload temporary files, are ignored.
+    """
+    def __init__(self, root, settle):
+        self.root = root
+        self.settle = settle
+        self.inotify = Inotify()
+        self.paths = dict()
+        self.pending = dict()
+
+    def close(self):
+        self.inotify.close()
+
+    def watch_tree(self, path, schedule=False):
+        """Watch path and the directories below it, with schedule they are new: recorded as folders and their files scheduled."""
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+            try:
+                self.paths[self.inotify.add_watch(dirpath, WATCH_MASK)] = dirpath
+            except OSError as e:
+                # ENOSPC: fs.inotify.max_user_watches is too small for the tree.
+                current_app.logger.error('watch_tree: {}'.format(str(e)))
+                continue
+            if schedule:
+                self._add_folder(dirpath)
+                for filename in filenames:
+                    self.schedule(os.path.join(dirpath, filename))
+
+    def _add_folder(self, dirpath):
+        relative_path = get_relative_name(dirpath)
+        user = User.query.filter(User.name==relative_path.split(os.sep)[0]).first()
+        if user:
+            MediaFolder.add_folder(user.id, relative_path)
+
+    def schedule(self, full_path_name):
+        # Files right under the root belong to no user.
+        if os.path.basename(full_path_name).startswith('.') or os.path.dirname(full_path_name) == self.root:
+            return
+        self.pending[full_path_name] = (time.monotonic() + self.settle, None)
+
+    def handle(self, events):
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                current_app.logger.warning('watcher: event queue overflowed, run flask check --repair to import the missed files')
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            dirpath = self.paths.get(wd)
+            if dirpath is None:
+                continue
+            if mask & IN_MOVE_SELF:
+                # A directory moved within the tree is watched again under its new path by the IN_MOVED_TO of its parent.
+                self.inotify.rm_watch(wd)
+                continue
+            if not name:
+                continue
+            full_path_name = os.path.join(dirpath, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith('.'):
+                    self.watch_tree(full_path_name, schedule=True)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.pending.pop(full_path_name, None)
+            else:
+                self.schedule(full_path_name)
+
+    def next_timeout(self):
+        if not self.pending:
+            return None
+        return max(0, min(deadline for deadline, _ in self.pending.values()) - time.monotonic())
+
+    def due(self):
+        """Returns the pending files found stable, the others are checked again settle seconds later."""
+        now, ready = time.monotonic(), []
+        for full_path_name, (deadline, stat) in list(self.pending.items()):
+            if deadline > now:
+                continue
+            try:
+                current = os.stat(full_path_name)
+            except FileNotFoundError:
+                del self.pending[full_path_name]
+                continue
+            current = (current.st_size, current.st_mtime_ns)
+            if current != stat:
+                self.pending[full_path_name] = (now + self.settle, current)
+                continue
+            del self.pending[full_path_name]
+            ready.append(full_path_name)
+        return ready
+
+    def run(self, jobs=None, is_public=False):
+        """Import stable files on a pool of processes, at most jobs at a time, until interrupted."""
+        jobs = jobs or os.cpu_count() or 1
+        self.watch_tree(self.root)
+        current_app.logger.info(f'watcher: {len(self.paths)} directories watched under {self.root}')
+        count, ready, running = 0, [], dict()
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_task_process, initargs=(current_app.config.get('ENV'),)) as executor:
+            while True:
+                timeout = self.next_timeout()
+                if running:
+                    timeout = self.settle if timeout is None else min(timeout, self.settle)
+                self.handle(self.inotify.read(timeout))
+                ready.extend(full_path_name for full_path_name in self.due() if full_path_name not in ready)
+                while ready and len(running) < jobs:
+                    full_path_name = ready.pop(0)
+                    if full_path_name in running.values():
+                        # Written again while being imported, it is looked at once the current import is over.
+                        self.schedule(full_path_name)
+                        continue
+                    running[executor.submit(_run_sync, full_path_name, is_public)] = full_path_name
+                for future in [future for future in running if future.done()]:
+                    del running[future]
+                    full_path_name, uuidname, error = future.result()
+                    if error:
+                        current_app.logger.error(f'watcher: failed to import {full_path_name}, {error}')
+                    elif uuidname:
+                        count += 1
+                        current_app.logger.info(f'watcher: {full_path_name} imported as {uuidname}, {count} imported')
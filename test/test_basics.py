@@ -2,15 +2,37 @@
 # -*- coding:utf-8 -*-
 
 
+import io
+import os
+import json
+import shutil
+import zipfile
+import datetime
+import tempfile
 import unittest
+from PIL import Image
 from flask import current_app
+from sqlalchemy import event
 
-from hallelujah import create_app, db
+from hallelujah import create_app, db, User, Article, Media, MediaFolder, MediaTask
+from hallelujah.utility import MediaType, TaskStatus, TaskKind, encode_cursor
+from hallelujah.extensions import cache, variant_cache
+
+
+def _set_media_dir(app):
+    """Point the media directories of app into a new temporary directory, returns it."""
+    media_dir = tempfile.mkdtemp()
+    app.config['SYS_MEDIA'] = media_dir
+    for key, name in (('SYS_MEDIA_ORIGINAL', 'original'), ('SYS_MEDIA_THUMBNAIL', 'thumbnail'),
+                      ('SYS_MEDIA_VARIANT', 'variant'), ('SYS_MEDIA_TRASH', 'trash')):
+        app.config[key] = os.path.join(media_dir, name)
+    return media_dir
 
 
 class BasicTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app('testing')
+        self.media_dir = _set_media_dir(self.app)
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -19,6 +41,7 @@ class BasicTestCase(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
+        shutil.rmtree(self.media_dir)
 
     def test_app_exists(self):
         self.assertTrue(self.app is not None)
@@ -26,3 +49,306 @@ class BasicTestCase(unittest.TestCase):
     def test_app_test_mode(self):
         self.assertTrue(self.app.config.get('TESTING', True))
 
+
+    def test_response_cache(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        Article.add_article(u.id, True, 'first', 'content')
+        client = self.app.test_client()
+        self.assertEqual(len(client.get('/api/get_articles').json), 1)
+        self.assertEqual(len(client.get('/api/get_articles').json), 1)
+        self.assertEqual(cache.stats(), {'hit': 1, 'miss': 1})
+        Article.add_article(u.id, True, 'second', 'content')
+        self.assertEqual(len(client.get('/api/get_articles').json), 2)
+        self.assertEqual(cache.stats(), {'hit': 1, 'miss': 2})
+
+    def test_conditional_get(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        a = Article.add_article(u.id, True, 'first', 'content')
+        client = self.app.test_client()
+        etag = client.get('/api/get_self_articles').headers['ETag']
+        self.assertEqual(client.get('/api/get_self_articles', headers={'If-None-Match': etag}).status_code, 304)
+        etag = client.get(f'/article/{a.url}').headers['ETag']
+        self.assertEqual(client.get(f'/article/{a.url}', headers={'If-None-Match': etag}).status_code, 304)
+        Article.edit_article(a.id, True, 'first', 'changed')
+        self.assertEqual(client.get(f'/article/{a.url}', headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_search_blank_keywords(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        Article.add_article(u.id, True, 'first', 'content')
+        client = self.app.test_client()
+        for keywords in ('', '%20%20', '%09'):
+            response = client.get(f'/api/search?keywords={keywords}')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json, [])
+        self.assertEqual(len(client.get('/api/search?keywords=%20content%20').json), 1)
+
+    def test_similar_medias_distance(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(u.id)
+        self.assertEqual(client.get('/api/get_similar_medias').json, [])
+        self.assertEqual(client.get('/api/get_similar_medias?distance=16').status_code, 200)
+        for distance in ('17', '64', '-1'):
+            self.assertEqual(client.get(f'/api/get_similar_medias?distance={distance}').status_code, 400)
+
+    def test_keyset_pages(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        for index in range(65):
+            Article.add_article(u.id, True, f'title {index}', 'common content')
+        client = self.app.test_client()
+        for url in ('/api/get_articles', '/api/search?keywords=common'):
+            titles, cursor = [], None
+            for _ in range(4):
+                separator = '&' if '?' in url else '?'
+                response = client.get(f'{url}{separator}cursor={cursor}' if cursor else url)
+                titles += [article['title'] for article in response.json]
+                cursor = response.headers.get('X-Next-Cursor')
+                if not cursor:
+                    break
+            self.assertIsNone(cursor)
+            self.assertEqual(sorted(titles), sorted(f'title {index}' for index in range(65)))
+        # A malformed cursor is ignored and the first page served.
+        first = [article['title'] for article in client.get('/api/get_articles').json]
+        for values in (['2020-01-01', [1]], [1, 2], ['not a date', 1], ['2020-01-01', '1'], 'garbage'):
+            cursor = encode_cursor(*values) if isinstance(values, list) else values
+            response = client.get(f'/api/get_articles?cursor={cursor}')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([article['title'] for article in response.json], first)
+        self.assertEqual(client.get('/api/get_articles?offset=x').status_code, 200)
+
+    def test_chunked_upload(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        os.makedirs(os.path.join(self.media_dir, 'original', 'test'))
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(u.id)
+        data = b'0123456789'
+        upload_id = client.post('/upload_init/test', json={'filename': 'notes.txt', 'size': len(data)}).json['upload_id']
+        self.assertEqual(client.post(f'/upload_chunk/{upload_id}?offset=0', data=data[:4]).json['offset'], 4)
+        self.assertEqual(client.post(f'/upload_chunk/{upload_id}?offset=8', data=data[8:]).status_code, 409)
+        self.assertEqual(client.post(f'/upload_finalize/{upload_id}').status_code, 409)
+        resumed = client.post('/upload_init/test', json={'filename': 'notes.txt', 'size': len(data), 'upload_id': upload_id}).json
+        self.assertEqual(resumed, {'upload_id': upload_id, 'offset': 4})
+        self.assertEqual(client.get(f'/upload_chunk/{upload_id}').json['offset'], 4)
+        self.assertEqual(client.post(f'/upload_chunk/{upload_id}?offset=4', data=data[4:]).json['offset'], 10)
+        self.assertEqual(client.post(f'/upload_chunk/{upload_id}?offset=8', data=b'extra').status_code, 413)
+        response = client.post(f'/upload_finalize/{upload_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(os.listdir(os.path.join(self.media_dir, 'original', 'test')), ['notes.txt'])
+        task_id = response.json['notes.txt']
+        self.assertEqual(client.get('/api/get_media_tasks').json[0]['status'], TaskStatus.PENDING)
+        self.assertEqual(MediaTask.claim_tasks(10), [task_id])
+        self.assertEqual(MediaTask.claim_tasks(10), [])
+        self.assertEqual(MediaTask.process_task(task_id), TaskStatus.DONE)
+        self.assertEqual(client.get('/api/get_media_tasks').json, [])
+        task = client.get(f'/api/get_media_tasks?ids={task_id}').json[0]
+        media = Media.query.filter(Media.uuidname == task['uuidname']).first()
+        self.assertEqual(media.filename, 'notes.txt')
+        # The dropzone remove link deletes the media by the uuidname of its task.
+        self.assertEqual(client.post('/delete', json={}).status_code, 400)
+        self.assertEqual(client.post('/delete', json={'filename': task['uuidname']}).json, 'succeed')
+        self.assertEqual(Media.query.count(), 0)
+        self.assertEqual(os.listdir(os.path.join(self.media_dir, 'original', 'test')), [])
+
+    def test_image_variants(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        variant_cache.init_app(self.app)
+        os.makedirs(os.path.join(self.media_dir, 'original', 'test'))
+        Image.new('RGB', (1000, 500)).save(os.path.join(self.media_dir, 'original', 'test', 'photo.jpg'))
+        m = Media.add_media(u.id, 'test', 'photo.jpg', datetime.datetime.now(), 1000, 500, MediaType.IMAGE, True)
+        client = self.app.test_client()
+        response = client.get(f'/thumbnail/{m.uuidname}?w=500', headers={'Accept': 'image/webp,*/*'})
+        self.assertEqual(response.mimetype, 'image/webp')
+        self.assertIn('Accept', response.vary)
+        self.assertEqual(Image.open(io.BytesIO(response.data)).size, (640, 320))
+        response = client.get(f'/thumbnail/{m.uuidname}?w=5000', headers={'Accept': '*/*'})
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertEqual(Image.open(io.BytesIO(response.data)).size, (1000, 500))
+        self.assertEqual(len(os.listdir(os.path.join(self.media_dir, 'variant', m.uuidname[:2]))), 2)
+        variant_cache.max_size = 1
+        variant_cache.put('zzzzzz', lambda filename: open(filename, 'wb').close())
+        self.assertEqual(os.listdir(os.path.join(self.media_dir, 'variant', m.uuidname[:2])), [])
+
+    def test_media_file_records(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        os.makedirs(os.path.join(self.media_dir, 'thumbnail', 'test'))
+        Image.new('RGB', (40, 30)).save(os.path.join(self.media_dir, 'thumbnail', 'test', 'photo.jpg'))
+        m = Media.add_media(u.id, 'test', 'photo.jpg', datetime.datetime.now(), 40, 30, MediaType.IMAGE, True)
+        self.assertEqual(m.uuidname, m.uuidstem + '.jpg')
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        client = self.app.test_client()
+        self.assertEqual(client.get(f'/thumbnail/{m.uuidname}').status_code, 200)
+        count = len(statements)
+        self.assertEqual(client.get(f'/thumbnail/{m.uuidname}', headers={'If-None-Match': 'other'}).status_code, 200)
+        self.assertEqual(len(statements), count)
+        # An edit in place keeps the uuid, the version in the urls keeps browsers from serving the old content.
+        etag = client.get(f'/thumbnail/{m.uuidname}').headers['ETag']
+        self.assertNotEqual(client.get(f'/thumbnail/{m.uuidname}?v=1').headers['ETag'], etag)
+        Media.query.filter(Media.id == m.id).update({'content_hash': 'ab' * 32})
+        db.session.commit()
+        with self.app.test_request_context():
+            json_media = db.session.get(Media, m.id).to_json()
+        self.assertEqual(json_media['version'], 'ab' * 8)
+        self.assertTrue(json_media['thumbnail_url'].endswith(f'/thumbnail/{m.uuidname}?v={"ab" * 8}'))
+        self.assertTrue(json_media['download_url'].endswith(f'download=yes&v={"ab" * 8}'))
+        self.assertTrue(Media.delete_media(m.uuidname))
+        self.assertEqual(client.get(f'/thumbnail/{m.uuidname}', headers={'If-None-Match': 'other'}).status_code, 204)
+
+    def test_thumbnail_bundle(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        other = User(name='other', email='other@test.com', password='pwd')
+        db.session.add_all([u, other])
+        db.session.commit()
+        for name in ('test', 'other'):
+            os.makedirs(os.path.join(self.media_dir, 'thumbnail', name))
+            Image.new('RGB', (40, 30)).save(os.path.join(self.media_dir, 'thumbnail', name, 'photo.jpg'))
+        now = datetime.datetime.now()
+        a = Media.add_media(u.id, 'test', 'photo.jpg', now, 40, 30, MediaType.IMAGE, True)
+        b = Media.add_media(u.id, 'test', 'missing.jpg', now, 40, 30, MediaType.IMAGE, True)
+        c = Media.add_media(other.id, 'other', 'photo.jpg', now, 40, 30, MediaType.IMAGE, False)
+        a, b, c = a.uuidname, b.uuidname, c.uuidname
+        client = self.app.test_client()
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        response = client.get(f'/thumbnails?uuids={a},{b},{c},{a}')
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(statements), 1)
+        length = int.from_bytes(response.data[:4], 'big')
+        header = json.loads(response.data[4:4 + length])
+        size = os.path.getsize(os.path.join(self.media_dir, 'thumbnail', 'test', 'photo.jpg'))
+        self.assertEqual(header, [[a, 'image/jpeg', size], [b, 'image/jpeg', 0], [c, 'image/jpeg', 0], [a, 'image/jpeg', size]])
+        self.assertEqual(len(response.data), 4 + length + 2 * size)
+        self.assertEqual(response.data[4 + length:4 + length + size], client.get(f'/thumbnail/{a}').data)
+        etag = response.headers['ETag']
+        self.assertEqual(client.get(f'/thumbnails?uuids={a},{b},{c},{a}', headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(client.get('/thumbnails').status_code, 400)
+
+    def test_media_folders(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        for path in ('test/trip/day1', 'test/trip/private', 'test/trips'):
+            os.makedirs(os.path.join(self.media_dir, 'original', path))
+        now = datetime.datetime.now()
+        a = Media.add_media(u.id, 'test/trip/day1', 'a.jpg', now, media_type=MediaType.IMAGE, file_size=100)
+        Media.add_media(u.id, 'test/trip/day1', 'b.jpg', now - datetime.timedelta(days=1), media_type=MediaType.IMAGE, file_size=50)
+        Media.add_media(u.id, 'test/trip/private', 'c.jpg', now, media_type=MediaType.IMAGE)
+        Media.add_media(u.id, 'test/trips', 'd.jpg', now, media_type=MediaType.IMAGE)
+        day1 = MediaFolder.get_folder(u.id, 'test/trip/day1')
+        self.assertEqual((day1.media_count, day1.total_size, day1.newest_timestamp), (2, 150, now))
+        self.assertEqual([folder.name for folder in MediaFolder.get_children(u.id, 'test/trip')], ['day1', 'private'])
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(u.id)
+        # Folders named in SYS_MEDIA_EXCLUDES are hidden below the gallery root but shown when browsed into.
+        names = lambda path: sorted(media['uuidname'] for media in client.get(f'/api/get_self_medias/{path}').json)
+        self.assertEqual(len(names('test/trip')), 2)
+        self.assertEqual(len(names('test/trip/private')), 1)
+        self.assertEqual(len(names('test')), 3)
+        self.assertTrue(Media.delete_media(a.uuidname))
+        db.session.refresh(day1)
+        self.assertEqual((day1.media_count, day1.total_size), (1, 50))
+        self.assertIn(b'day1', client.get('/manage_medias/test/trip').data)
+
+    def test_download_media_directory(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        files = {'test/trip/a.jpg': os.urandom(3000), 'test/trip/day1/b.txt': b'text' * 1000, 'test/trip/private/c.jpg': b'hidden'}
+        for name, data in files.items():
+            os.makedirs(os.path.join(self.media_dir, 'original', os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(self.media_dir, 'original', name), 'wb') as f:
+                f.write(data)
+            Media.add_media(u.id, os.path.dirname(name), os.path.basename(name), datetime.datetime(1970, 1, 1), media_type=MediaType.IMAGE)
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(u.id)
+        response = client.get('/download_directory/test/trip')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('trip.zip', response.headers['Content-Disposition'])
+        with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(sorted(archive.namelist()), ['trip/a.jpg', 'trip/day1/b.txt'])
+            self.assertEqual(archive.getinfo('trip/a.jpg').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(archive.getinfo('trip/day1/b.txt').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(archive.read('trip/day1/b.txt'), files['test/trip/day1/b.txt'])
+        with zipfile.ZipFile(io.BytesIO(client.get('/download_directory/test/trip/private').data)) as archive:
+            self.assertEqual(archive.namelist(), ['private/c.jpg'])
+        with zipfile.ZipFile(io.BytesIO(client.get('/download_directory/test').data)) as archive:
+            self.assertEqual(len(archive.namelist()), 2)
+        self.assertEqual(client.get('/download_directory/other').status_code, 302)
+
+    def test_delete_media_directory(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        for path in ('test/trip', 'test/trip/day1', 'test/other'):
+            for name in ('original', 'thumbnail'):
+                os.makedirs(os.path.join(self.media_dir, name, path), exist_ok=True)
+                Image.new('RGB', (4, 3)).save(os.path.join(self.media_dir, name, path, 'a.jpg'))
+            Media.add_media(u.id, path, 'a.jpg', datetime.datetime.now(), media_type=MediaType.IMAGE)
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(u.id)
+        self.assertEqual(client.get('/delete_directory/test').status_code, 302)
+        self.assertEqual(Media.query.count(), 3)
+        # Another library cannot be reached through '..' or a symlink out of the user directory.
+        os.makedirs(os.path.join(self.media_dir, 'original', 'bob', 'album'))
+        os.symlink(os.path.join(self.media_dir, 'original', 'bob'), os.path.join(self.media_dir, 'original', 'test', 'bob'))
+        for path in ('test/../bob', 'test/trip/../../bob', 'test/./../bob/album', 'test/bob/album'):
+            self.assertEqual(client.get('/delete_directory/' + path).status_code, 302)
+        self.assertTrue(os.path.isdir(os.path.join(self.media_dir, 'original', 'bob', 'album')))
+        self.assertEqual(MediaTask.query.count(), 0)
+        client.get('/delete_directory/test/trip')
+        self.assertEqual([media.path for media in Media.query.all()], ['test/other'])
+        self.assertIsNone(MediaFolder.get_folder(u.id, 'test/trip/day1'))
+        self.assertEqual([folder.name for folder in MediaFolder.get_children(u.id, 'test')], ['other'])
+        self.assertFalse(os.path.exists(os.path.join(self.media_dir, 'original', 'test', 'trip')))
+        self.assertFalse(os.path.exists(os.path.join(self.media_dir, 'thumbnail', 'test', 'trip')))
+        task = client.get('/api/get_media_tasks').json[0]
+        self.assertEqual((task['kind'], task['status'], task['path']), (TaskKind.DELETE, TaskStatus.PENDING, 'test/trip'))
+        self.assertEqual(MediaTask.process_task(task['id']), TaskStatus.DONE)
+        self.assertEqual(db.session.get(MediaTask, task['id']).progress, 4)
+        self.assertEqual(os.listdir(os.path.join(self.media_dir, 'trash')), [])
+
+    def test_media_ranges(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        os.makedirs(os.path.join(self.media_dir, 'original', 'test'))
+        data = bytes(range(256)) * 4
+        with open(os.path.join(self.media_dir, 'original', 'test', 'clip.mp4'), 'wb') as f:
+            f.write(data)
+        m = Media.add_media(u.id, 'test', 'clip.mp4', datetime.datetime.now(), media_type=MediaType.VIDEO, is_public=True)
+        client = self.app.test_client()
+        response = client.get(f'/file/{m.uuidname}', headers={'Range': 'bytes=10-19'})
+        self.assertEqual((response.status_code, response.data), (206, data[10:20]))
+        response = client.get(f'/file/{m.uuidname}', headers={'Range': 'bytes=0-3,-4'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.mimetype, 'multipart/byteranges')
+        self.assertEqual(int(response.headers['Content-Length']), len(response.data))
+        self.assertIn(b'Content-Range: bytes 0-3/1024\r\n\r\n' + data[:4], response.data)
+        self.assertIn(b'Content-Range: bytes 1020-1023/1024\r\n\r\n' + data[-4:], response.data)
+        self.assertEqual(client.get(f'/file/{m.uuidname}', headers={'Range': 'bytes=2000-2010,3000-'}).status_code, 416)
+        self.app.config['SYS_MEDIA_DELIVERY'] = 'x-accel'
+        response = client.get(f'/file/{m.uuidname}')
+        self.assertEqual(response.headers['X-Accel-Redirect'], '/protected_media/original/test/clip.mp4')
+        self.assertEqual(response.data, b'')
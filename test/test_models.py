@@ -2,13 +2,33 @@
 # -*- coding:utf-8 -*-
 
 
+import os
+import cv2
 import uuid
 import time
+import shutil
 import datetime
+import tempfile
 import unittest
+from unittest import mock
+import numpy as np
 from faker import Faker
+from PIL import Image
+from sqlalchemy import exc
 
-from hallelujah import create_app, db, User, Article, Media, Resource
+from hallelujah import create_app, db, User, Article, Media, MediaFolder, MediaTask, Resource
+from hallelujah.watcher import MediaWatcher
+from hallelujah.utility import MediaType, EXIF_TAG_MAP, get_media_files, import_user_media, hash_file, read_thumbnail_info
+
+
+def _set_media_dir(app):
+    """Point the media directories of app into a new temporary directory, returns it."""
+    media_dir = tempfile.mkdtemp()
+    app.config['SYS_MEDIA'] = media_dir
+    for key, name in (('SYS_MEDIA_ORIGINAL', 'original'), ('SYS_MEDIA_THUMBNAIL', 'thumbnail'),
+                      ('SYS_MEDIA_VARIANT', 'variant'), ('SYS_MEDIA_TRASH', 'trash')):
+        app.config[key] = os.path.join(media_dir, name)
+    return media_dir
 
 
 class UserModelTestCase(unittest.TestCase):
@@ -88,9 +108,64 @@ class ArticleModelTestCase(unittest.TestCase):
         self.assertIsNotNone(a.url)
         self.assertTrue(a.content_html == '<h1>Head</h1>\n<ol>\n<li>first</li>\n<li>second</li>\n<li>third</li>\n</ol>')
 
+    def test_summary(self):
+        a = Article(title='test', content='# Head\n' + 'word ' * 100 + '\n\n中文摘要')
+        self.assertTrue(a.summary.startswith('Head word word'))
+        self.assertTrue(a.summary.endswith('...'))
+        self.assertTrue(len(a.summary) <= 260)
+        self.assertEqual(a.word_count, 105)
+
+    def _search(self, keywords, user_id):
+        articles, score = Article.search_articles(keywords, user_id)
+        return articles.order_by(score.desc(), Article.id.desc()).all()
+
+    def test_search(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        a1 = Article.add_article(u.id, True, 'flask notes', 'something about *python* web')
+        a2 = Article.add_article(u.id, True, 'python', 'python **python** everywhere')
+        a3 = Article.add_article(u.id, False, 'private python', 'python')
+        self.assertEqual([a.id for a in self._search(['python'], -1)], [a2.id, a1.id])
+        self.assertEqual(len(self._search(['python'], u.id)), 3)
+        Article.edit_article(a1.id, True, 'flask notes', 'nothing here')
+        self.assertEqual([a.id for a in self._search(['python'], -1)], [a2.id])
+        Article.delete_article(a2.id)
+        self.assertEqual(self._search(['python'], -1), [])
+        self.assertEqual(Article.reindex(), 2)
+        self.assertEqual([a.id for a in self._search(['pyth'], u.id)], [a3.id])
+        self.assertEqual(self._search([], u.id), [])
+
+    def test_rerender(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        articles = [Article.add_article(u.id, True, f'title {i}', f'**content** {i}') for i in range(5)]
+        self.assertEqual(Article.rerender(jobs=2), 0)
+        articles[0].render_version = None
+        articles[1].content = 'changed *content*'
+        articles[2].content_html = ''
+        db.session.commit()
+        self.assertEqual(Article.rerender(jobs=2, batch_size=2), 2)
+        self.assertEqual(articles[1].content_html, '<p>changed <em>content</em></p>')
+        self.assertEqual(articles[2].content_html, '')
+        self.assertEqual(Article.rerender(jobs=2, force=True), 5)
+        self.assertEqual(articles[2].content_html, '<p><strong>content</strong> 2</p>')
+
+    def test_json_rows(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        for i in range(3):
+            Article.add_article(u.id, True, f'title {i}', f'content {i}')
+        with self.app.test_request_context('/'):
+            rows = Article.query_json_rows().order_by(Article.id.asc()).all()
+            self.assertEqual(Article.rows_to_json(rows), [a.to_json() for a in Article.query.order_by(Article.id.asc())])
+
 class MediaModelTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app('testing')
+        self.media_dir = _set_media_dir(self.app)
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -99,12 +174,271 @@ class MediaModelTestCase(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
+        shutil.rmtree(self.media_dir)
 
     def test_valid_media(self):
         m = Media(user_id=-1, path="", filename="")
         self.assertTrue(m.timestamp == None)
         self.assertTrue(m.uuidname != None)
 
+    def test_import_medias(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        user_path = os.path.join(self.media_dir, 'original', 'test', 'album')
+        os.makedirs(user_path)
+        for index in range(3):
+            Image.new('RGB', (40, 30)).save(os.path.join(user_path, f'photo{index}.JPG'))
+        with open(os.path.join(user_path, 'notes.txt'), 'w') as f:
+            f.write('notes')
+        # A video starting with black frames, its poster must be taken further in.
+        writer = cv2.VideoWriter(os.path.join(user_path, 'clip.mp4'), cv2.VideoWriter_fourcc(*'mp4v'), 10, (64, 48))
+        for index in range(20):
+            writer.write(np.full((48, 64, 3), 0 if index < 2 else 200, np.uint8))
+        writer.release()
+        self.assertEqual(User.import_medias('test', jobs=2, batch_size=2), (5, 0))
+        self.assertEqual(User.import_medias('test', jobs=2, batch_size=2), (0, 0))
+        self.assertEqual(MediaFolder.get_folder(u.id, 'test/album').media_count, 5)
+        self.assertEqual([folder.name for folder in MediaFolder.get_children(u.id, 'test')], ['album'])
+        video = Media.query.filter(Media.media_type == MediaType.VIDEO).first()
+        self.assertEqual((video.width, video.height, video.duration), (64, 48, 2.0))
+        self.assertTrue(video.codec)
+        poster = cv2.imread(os.path.join(self.media_dir, 'thumbnail', video.path, os.path.splitext(video.filename)[0] + '.jpg'))
+        self.assertGreater(poster.mean(), 100)
+        images = Media.query.filter(Media.media_type == MediaType.IMAGE).all()
+        self.assertEqual(len({image.filename for image in images}), 3)
+        for image in images:
+            self.assertEqual((image.width, image.height), (40, 30))
+            self.assertTrue(os.path.isfile(os.path.join(self.media_dir, 'thumbnail', image.path, image.filename)))
+            self.assertEqual(image.dominant_color, '#000000')
+            self.assertTrue(image.placeholder.startswith('data:image/png;base64,'))
+            self.assertIsNotNone(image.perceptual_hash)
+        self.assertTrue(video.placeholder)
+        self.assertGreater(int(video.dominant_color[1:3], 16), 150)
+        perceptual_hash = images[0].perceptual_hash
+        images[0].placeholder = images[0].dominant_color = images[0].perceptual_hash = None
+        db.session.commit()
+        self.assertEqual(Media.fill_placeholders(jobs=1), 1)
+        self.assertEqual(db.session.get(Media, images[0].id).dominant_color, '#000000')
+        self.assertEqual(db.session.get(Media, images[0].id).perceptual_hash, perceptual_hash)
+
+    def test_import_medias_failed_batch(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        user_path = os.path.join(self.media_dir, 'original', 'test')
+        os.makedirs(user_path)
+        for index in range(2):
+            Image.new('RGB', (40, 30), (index * 100, 0, 0)).save(os.path.join(user_path, f'photo{index}.jpg'))
+        refresh_folders = MediaFolder.refresh_folders
+        calls = []
+        def fail_first(folder_ids):
+            calls.append(folder_ids)
+            if len(calls) == 1:
+                raise exc.SQLAlchemyError('commit failed')
+            return refresh_folders(folder_ids)
+        with mock.patch.object(MediaFolder, 'refresh_folders', side_effect=fail_first):
+            self.assertEqual(User.import_medias('test', jobs=1, batch_size=1), (1, 1))
+        self.assertEqual(Media.query.count(), 1)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_dir, 'thumbnail', 'test'))), 1)
+        self.assertEqual(User.import_medias('test', jobs=1), (1, 0))
+        self.assertEqual(len(os.listdir(os.path.join(self.media_dir, 'thumbnail', 'test'))), 2)
+
+    def test_dedupe_medias(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        for album in ('a', 'b'):
+            os.makedirs(os.path.join(self.media_dir, 'original', 'test', album))
+            Image.new('RGB', (40, 30), 'red').save(os.path.join(self.media_dir, 'original', 'test', album, 'photo.jpg'))
+        self.assertEqual(User.import_medias('test', jobs=1), (2, 0))
+        first, second = Media.query.order_by(Media.path.asc()).all()
+        self.assertEqual(first.content_hash, second.content_hash)
+        first_files = get_media_files(first.path, first.filename, first.media_type)
+        second_files = get_media_files(second.path, second.filename, second.media_type)
+        for first_file, second_file in zip(first_files, second_files):
+            self.assertTrue(os.path.samefile(first_file, second_file))
+        # Removing one copy only drops a link, the other one stays readable.
+        os.remove(first_files[0])
+        self.assertTrue(os.path.isfile(second_files[0]))
+        # Uploading the same content again into a directory already holding it returns the existing media.
+        upload = os.path.join(self.media_dir, 'original', 'test', 'b', 'upload.jpg')
+        Image.new('RGB', (40, 30), 'red').save(upload)
+        media = import_user_media(upload, False, User.query_user_media, User.add_user_media, User.find_user_media)
+        self.assertEqual(media.id, second.id)
+        self.assertFalse(os.path.exists(upload))
+        self.assertEqual(Media.query.count(), 2)
+
+    def test_check_media(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        user_path = os.path.join(self.media_dir, 'original', 'test', 'album')
+        os.makedirs(user_path)
+        for index in range(3):
+            Image.new('RGB', (40, 30), (index * 80, 0, 0)).save(os.path.join(user_path, f'photo{index}.jpg'))
+        self.assertEqual(User.import_medias('test', jobs=1), (3, 0))
+        report = Media.check_media(jobs=2)
+        self.assertEqual(report['media'], 3)
+        self.assertFalse(any(report[name] for name in ('missing', 'missing_thumbnails', 'changed', 'unrecorded', 'orphaned_thumbnails')))
+        first, second, third = Media.query.order_by(Media.id.asc()).all()
+        self.assertTrue(first.file_mtime)
+        first_files = get_media_files(first.path, first.filename, first.media_type)
+        os.remove(first_files[1])
+        with open(get_media_files(second.path, second.filename, second.media_type)[0], 'ab') as f:
+            f.write(b'garbage')
+        os.remove(get_media_files(third.path, third.filename, third.media_type)[0])
+        Image.new('RGB', (40, 30), 'blue').save(os.path.join(user_path, 'new.jpg'))
+        Image.new('RGB', (40, 30), 'blue').save(os.path.join(self.media_dir, 'thumbnail', 'test', 'album', 'stray.jpg'))
+        report = Media.check_media(jobs=2, verify_hash=True, repair=True)
+        self.assertEqual(report['missing_thumbnails'], [first_files[0]])
+        self.assertEqual(len(report['corrupted']), 1)
+        self.assertEqual(len(report['missing']), 1)
+        self.assertEqual(report['orphaned_thumbnails'], [os.path.join(self.media_dir, 'thumbnail', 'test', 'album', 'stray.jpg')])
+        self.assertEqual(report['unrecorded'], [os.path.join(user_path, 'new.jpg')])
+        self.assertEqual((report['repaired_thumbnails'], report['imported']), (1, 1))
+        self.assertTrue(os.path.isfile(first_files[1]))
+
+    def test_burst_filenames(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        user_path = os.path.join(self.media_dir, 'original', 'test', 'burst')
+        os.makedirs(user_path)
+        # A file already named like the first slot but not imported yet must not be overwritten.
+        with open(os.path.join(user_path, 'IMG_20240101_120000.jpg'), 'wb') as f:
+            f.write(b'not imported')
+        for index in range(5):
+            image = Image.new('RGB', (40, 30), (index, 0, 0))
+            exif = image.getexif()
+            exif[EXIF_TAG_MAP['DateTime']] = '2024:01:01 12:00:00'
+            image.save(os.path.join(user_path, f'shot{index}.jpg'), exif=exif)
+            import_user_media(os.path.join(user_path, f'shot{index}.jpg'), False, User.query_user_media, User.add_user_media)
+        filenames = sorted(media.filename for media in Media.query.all())
+        self.assertEqual(filenames, [f'IMG_20240101_120000-{index}.jpg' for index in range(1, 6)])
+        with open(os.path.join(user_path, 'IMG_20240101_120000.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), b'not imported')
+        self.assertIsNone(Media.add_media(u.id, 'test/burst', filenames[0], datetime.datetime.now()))
+
+    def test_similar_media(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        user_path = os.path.join(self.media_dir, 'original', 'test', 'album')
+        os.makedirs(user_path)
+        pixels = np.random.default_rng(0).integers(0, 255, (6, 8, 3), dtype=np.uint8)
+        photo = Image.fromarray(pixels).resize((400, 300), Image.Resampling.BICUBIC)
+        photo.save(os.path.join(user_path, 'photo.jpg'), quality=95)
+        # A smaller re-encoded export is similar, a byte-identical copy is left to dedupe, a mirrored one is another picture.
+        photo.resize((200, 150)).save(os.path.join(user_path, 'export.jpg'), quality=50)
+        photo.save(os.path.join(user_path, 'copy.jpg'), quality=95)
+        photo.transpose(Image.Transpose.FLIP_LEFT_RIGHT).save(os.path.join(user_path, 'mirror.jpg'), quality=95)
+        hashes = {name: hash_file(os.path.join(user_path, f'{name}.jpg')) for name in ('photo', 'export', 'copy', 'mirror')}
+        self.assertEqual(User.import_medias('test', jobs=1), (4, 0))
+        ids = {name: Media.query.filter(Media.content_hash == content_hash).first().id for name, content_hash in hashes.items()}
+        ids['copy'] = Media.query.filter(Media.content_hash == hashes['copy'], Media.id != ids['photo']).first().id
+        pairs = Media.find_similar_media(u.id, 10)
+        self.assertEqual(sorted(tuple(sorted(pair[:2])) for pair in pairs),
+                         sorted(tuple(sorted((ids['export'], ids[name]))) for name in ('photo', 'copy')))
+        export = db.session.get(Media, ids['export'])
+        self.assertEqual(len(Media.find_similar_media(u.id, 10, export.uuidname)), 2)
+        self.assertEqual(Media.find_similar_media(u.id + 1, 10), [])
+
+    def test_watch_media(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        os.makedirs(os.path.join(self.media_dir, 'original', 'test'))
+        watcher = MediaWatcher(self.app.config['SYS_MEDIA_ORIGINAL'], 0.05)
+        try:
+            watcher.watch_tree(watcher.root)
+            album = os.path.join(self.media_dir, 'original', 'test', 'album')
+            os.makedirs(os.path.join(album, 'day1'))
+            Image.new('RGB', (40, 30)).save(os.path.join(album, 'day1', 'photo.jpg'))
+            Image.new('RGB', (40, 30)).save(os.path.join(album, '.partial.jpg'))
+            ready = []
+            for _ in range(50):
+                watcher.handle(watcher.inotify.read(0.05))
+                ready += watcher.due()
+                if not watcher.pending and ready:
+                    break
+            self.assertEqual(ready, [os.path.join(album, 'day1', 'photo.jpg')])
+        finally:
+            watcher.close()
+        self.assertIsNotNone(MediaFolder.get_folder(u.id, 'test/album/day1'))
+        uuidname = Media.sync_file(ready[0])
+        media = Media.query.filter(Media.uuidname == uuidname).first()
+        full_path_name = os.path.join(album, 'day1', media.filename)
+        self.assertIsNone(Media.sync_file(full_path_name))
+        # Changed in place, the row is refreshed and keeps its uuid.
+        content_hash = media.content_hash
+        Image.new('RGB', (40, 30), (255, 0, 0)).save(full_path_name)
+        self.assertEqual(Media.sync_file(full_path_name), uuidname)
+        self.assertEqual(Media.query.count(), 1)
+        self.assertNotEqual(Media.query.filter(Media.uuidname == uuidname).first().content_hash, content_hash)
+        # An upload is left to the worker.
+        Image.new('RGB', (40, 30), (0, 255, 0)).save(os.path.join(album, 'upload.jpg'))
+        MediaTask.add_task(u.id, 'test/album', 'upload.jpg')
+        self.assertIsNone(Media.sync_file(os.path.join(album, 'upload.jpg')))
+
+    def test_fill_uuidstems(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        uuidnames = [Media.add_media(u.id, 'test', f'{index}.jpg', datetime.datetime.now()).uuidname for index in range(3)]
+        # A database created before the column existed.
+        db.session.execute(db.text('DROP INDEX ix_medias_uuidstem'))
+        db.session.execute(db.text('ALTER TABLE medias DROP COLUMN uuidstem'))
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertEqual(Media.fill_uuidstems(batch_size=2), 3)
+        self.assertEqual(Media.fill_uuidstems(), 0)
+        for uuidname in uuidnames:
+            self.assertEqual(Media.get_file_record(os.path.splitext(uuidname)[0])['uuidname'], uuidname)
+        self.assertIn('ix_medias_uuidstem', [index['name'] for index in db.inspect(db.engine).get_indexes('medias')])
+
+    def test_sync_recorded_file(self):
+        u = User(name='test', email='test@test.com', password='pwd')
+        db.session.add(u)
+        db.session.commit()
+        for album in ('album1', 'album2'):
+            os.makedirs(os.path.join(self.media_dir, 'original', 'test', album))
+            Image.new('RGB', (40, 30)).save(os.path.join(self.media_dir, 'original', 'test', album, 'photo.jpg'))
+        uuidnames = [Media.sync_file(os.path.join(self.media_dir, 'original', 'test', album, 'photo.jpg')) for album in ('album1', 'album2')]
+        medias = [Media.query.filter(Media.uuidname == uuidname).first() for uuidname in uuidnames]
+        originals = [get_media_files(media.path, media.filename, media.media_type)[0] for media in medias]
+        self.assertTrue(os.path.samefile(*originals))
+        # The mtime is recorded at import, the events of the import itself do not read the files again.
+        with mock.patch('hallelujah.models.hash_file') as hash_mock:
+            for original in originals:
+                self.assertIsNone(Media.sync_file(original))
+        hash_mock.assert_not_called()
+        # A touch on a row recorded before content hashes existed backfills it, the row is kept.
+        Media.query.filter(Media.id == medias[0].id).update({'content_hash': None, 'file_mtime': None, 'is_public': True})
+        db.session.commit()
+        os.utime(originals[0], ns=(0, 10 ** 18))
+        self.assertIsNone(Media.sync_file(originals[0]))
+        media = Media.query.filter(Media.uuidname == uuidnames[0]).first()
+        self.assertEqual((media.content_hash, media.file_mtime, media.is_public), (hash_file(originals[0]), 10 ** 18, True))
+        self.assertEqual(Media.query.count(), 2)
+        # Size and mtime unchanged, as after a chmod, the file is not read.
+        with mock.patch('hallelujah.models.hash_file') as hash_mock:
+            self.assertIsNone(Media.sync_file(originals[0]))
+        hash_mock.assert_not_called()
+        # Edited in place through the shared inode, both rows are refreshed and the edited name gets its own inode.
+        Image.new('RGB', (40, 30), (255, 0, 0)).save(originals[0])
+        self.assertEqual(Media.sync_file(originals[0]), uuidnames[0])
+        self.assertFalse(os.path.samefile(*originals))
+        content_hash = hash_file(originals[0])
+        for uuidname in uuidnames:
+            media = Media.query.filter(Media.uuidname == uuidname).first()
+            self.assertEqual(media.content_hash, content_hash)
+            self.assertEqual(read_thumbnail_info(get_media_files(media.path, media.filename, media.media_type)[1])['dominant_color'], media.dominant_color)
+        self.assertTrue(Media.query.filter(Media.uuidname == uuidnames[0]).first().is_public)
+        Image.new('RGB', (40, 30), (0, 0, 255)).save(originals[0])
+        self.assertEqual(Media.sync_file(originals[0]), uuidnames[0])
+        self.assertNotEqual(Media.query.filter(Media.uuidname == uuidnames[1]).first().content_hash, hash_file(originals[0]))
+
 class ResourceModelTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app('testing')